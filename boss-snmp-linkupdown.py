@@ -2,29 +2,170 @@
 # User Script
 #
 # Script        : Configure SNMP linkUp and LinkDown
-# Revision      : 1.0
-# Last updated  : Feb/18/2022
+# Revision      : 2.0
+# Last updated  : Oct/18/2026
 # Purpose       : Enables SNMP linkUp and LinkDown for uplink ports (MLT member ports) and disables it for edge ports.
 #                 The scripts looks for active MLT ports with 'Uplink Core' as port name.
+#                 All MLT port ranges are collected first; the resulting config is then written to one script file
+#                 which the switch fetches from XMC's TFTP server and executes, after which the config is saved once.
+#                 When run against many stacks, these are worked on concurrently, with a result summary per switch.
+#                 On XMC this only happens if CliSessionFactory is set; XMC itself runs a separate instance of this
+#                 script for each selected switch, so XMC runs always work on the one launching switch, while
+#                 multi-switch runs (a JSON list of emc_vars dicts) are only available when run locally.
+#
+# 1.0   - Initial
+# 2.0   - Config is pushed in one go via TFTP and saved once per switch, instead of once per MLT
+#       - CLI command results are now checked
+#       - Can be run against many switches concurrently (locally, or on XMC with a CliSessionFactory)
 #
 ################################################################
+try:
+    emc_vars
+    execution = 'xmc'
+except: # If not running on XMC Jython...
+    # These lines only needed to run XMC Python script locally
+    import sys
+    import json
+    import emc_cli      # Own local replica
+    import emc_results  # Own local replica
+    execution = 'dev'
+    if len(sys.argv) > 1: # Json file as 1st argv
+        emc_vars = json.load(open(sys.argv[1]))
+    else:
+        emc_vars = json.load(open('emc_vars.json'))
+    if isinstance(emc_vars, list): # Json list of emc_vars dicts, to run against multiple devices
+        EmcVarsList = emc_vars
+        emc_vars = EmcVarsList[0]
+try:
+    EmcVarsList
+except: # On XMC we run against the one device we were launched on
+    EmcVarsList = [emc_vars]
+
 from device import api
 import re
+import os
+import time
+import threading
+import Queue
+
+XmcTftpRoot = '/tftpboot' # Where config script files are written, for switches to fetch them from XMC's TFTP server
+MaxThreads = 20 # Upper bound on the number of switches worked on concurrently
+CliSessionFactory = None # Callable(deviceIp) returning an emc_cli like session; needed to run against switches other than the launching one (not provided by XMC)
+RegexPrompt = re.compile('.*[\?\$%#>]\s?$')
+RegexUplink = re.compile('(Uplink Core\s+)(\d[\d/]*[,-]\d[\d,/]*)')
+RegexError  = re.compile(
+    '^%|\x07|error|invalid|cannot|unable|bad|not found|not exist|not allowed|no such|out of range|incomplete|failed|denied|can\'t|ambiguous|do not|unrecognized',
+    re.IGNORECASE | re.MULTILINE
+)
+
+def sendCommand(cli, cmd): # Sends a CLI command; raises RuntimeError if it failed or the switch returned an error
+    result = cli.send(cmd)
+    if not result.isSuccess():
+        raise RuntimeError("{}: {}".format(cmd, result.getError()))
+    output = str(result.getOutput())
+    outputLines = output.splitlines()[1:] # Skip the echoed command
+    if outputLines and RegexPrompt.match(outputLines[-1]):
+        outputLines.pop()
+    errorCheck = "\n".join(outputLines[:4]) # Error would be in 1st 4 lines of output
+    if RegexError.search(errorCheck):
+        raise RuntimeError("{}: {}".format(cmd, errorCheck.strip()))
+    return output
+
+def uplinkPorts(cli): # Returns the port ranges of all active 'Uplink Core' MLTs
+    portsList = []
+    for row in sendCommand(cli, "show mlt | match Enabled").splitlines():
+        match = RegexUplink.search(row)
+        if match:
+            portsList.append(match.group(2))
+    return portsList
+
+def configChain(portsList): # Returns the config commands for the given uplink port ranges
+    cmdList = [
+        "int fa all",
+        "no snmp-server notification-control linkDown ALL",
+        "no snmp-server notification-control linkUp ALL",
+    ]
+    for mlt_ports in portsList:
+        cmdList.append("snmp-server notification-control linkDown {0}".format(mlt_ports))
+        cmdList.append("snmp-server notification-control linkUp {0}".format(mlt_ports))
+    cmdList.append("exit")
+    return cmdList
+
+def stageFile(deviceIp, cmdList): # Writes the commands to a script file under XMC's TFTP root; returns its file name
+    # File name holds the switch IP, as concurrent script instances on XMC could otherwise write and delete the same file
+    fileName = "{}.boss-snmp-linkupdown.{}".format(emc_vars["userName"], deviceIp.replace('.', '_'))
+    with open(XmcTftpRoot + '/' + fileName, 'w') as f:
+        f.write("\n".join(cmdList) + "\n")
+    return fileName
+
+def unstageFile(fileName): # Deletes a script file written under XMC's TFTP root
+    try:
+        os.remove(XmcTftpRoot + '/' + fileName)
+    except OSError:
+        pass
+
+def configureSwitch(cli, deviceIp): # Pushes the linkUp/linkDown config in one go and saves it once; returns the uplink port ranges
+    sendCommand(cli, "enable")
+    portsList = uplinkPorts(cli)
+    fileName = stageFile(deviceIp, configChain(portsList))
+    try:
+        sendCommand(cli, "conf t")
+        sendCommand(cli, 'configure network address {0} filename "{1}"'.format(emc_vars["serverIP"], fileName))
+    finally: # The switch is done with the file once the command returns
+        unstageFile(fileName)
+    sendCommand(cli, "save config")
+    return portsList
+
+def newCliSession(deviceIp): # Returns the CLI session to use for the given switch
+    if deviceIp == emc_vars["deviceIP"]:
+        return emc_cli
+    if not CliSessionFactory:
+        raise RuntimeError("No CLI session factory available to connect to switch {}".format(deviceIp))
+    return CliSessionFactory(deviceIp)
+
+def switchWorker(deviceVars): # Configures one switch; returns a result dict
+    result = {'deviceIP': deviceVars["deviceIP"], 'status': 'SUCCESS', 'message': None, 'elapsed': None}
+    startTime = time.time()
+    try:
+        portsList = configureSwitch(newCliSession(deviceVars["deviceIP"]), deviceVars["deviceIP"])
+        result['message'] = "Uplink ports: {}".format("; ".join(portsList)) if portsList else "No active 'Uplink Core' MLTs"
+    except Exception as e: # Catch anything so that one switch cannot stop the others
+        result['status'] = 'ERROR'
+        result['message'] = str(e)
+    result['elapsed'] = time.time() - startTime
+    return result
+
+def runAll(deviceVarsList): # Configures all switches with a bounded pool of worker threads; prints a summary per switch
+    workQueue = Queue.Queue()
+    for deviceVars in deviceVarsList:
+        workQueue.put(deviceVars)
+    results = []
+    resultsLock = threading.Lock()
+
+    def worker():
+        while True:
+            try:
+                deviceVars = workQueue.get_nowait()
+            except Queue.Empty:
+                return
+            result = switchWorker(deviceVars)
+            with resultsLock:
+                results.append(result)
+
+    threads = [threading.Thread(target=worker, name="worker-{}".format(x)) for x in range(min(MaxThreads, len(deviceVarsList)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    print "\nResults for {} switches:".format(len(results))
+    for result in sorted(results, key=lambda x: x['deviceIP']):
+        print " - {:<16} {:<8} {:7.1f}s  {}".format(result['deviceIP'], result['status'], result['elapsed'], result['message'])
+    failed = [x['deviceIP'] for x in results if x['status'] != 'SUCCESS']
+    if failed:
+        print "{} of {} switches failed: {}".format(len(failed), len(results), ", ".join(failed))
+        emc_results.setStatus(emc_results.Status.ERROR)
+    else:
+        print "All {} switches completed successfully".format(len(results))
 
-cli_results1 = emc_cli.send("enable")
-cli_results1 = emc_cli.send("conf t")
-cli_results1 = emc_cli.send("int fa all")
-cli_results1 = emc_cli.send("no snmp-server notification-control linkDown ALL")
-cli_results1 = emc_cli.send("no snmp-server notification-control linkUp ALL")
-cli_results = emc_cli.send("show mlt | match Enabled")
-cli_output = str(cli_results.getOutput())
-cli_output_split = cli_output.splitlines()
-
-for row in cli_output_split:
-    match = re.search('(Uplink Core\s+)(\d[\d/]*[,-]\d[\d,/]*)', row)
-    if match:
-        mlt_ports = match.group(2)
-        cli_results = emc_cli.send("snmp-server notification-control linkDown {0}".format(mlt_ports))
-        cli_results = emc_cli.send("snmp-server notification-control linkUp {0}".format(mlt_ports))
-        cli_results = emc_cli.send("exit")
-        cli_results = emc_cli.send("save config")
+runAll(EmcVarsList)
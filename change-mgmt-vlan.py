@@ -49,6 +49,11 @@ __version__ = '2.0'
 # 1.9   - Above change was not working; not easy to reproduce and thus test...
 # --- end of original script by Ludovico
 # 2.0   - Initial changes to convert base script from CLIP mgmt to VLAN mgmt
+#
+# Multi-device runs are dev only: XMC runs a separate instance of this script for each selected device, with the one
+# emc_cli session of that device and no way to open sessions to other devices. So on XMC every instance runs main()
+# against its own device only. Working on many devices at once (threadPoolRun, preflightCheck, the shared discovery
+# poller) requires running the script locally, with a JSON list of emc_vars and a CliSessionFactory set.
 
 
 '''
@@ -176,6 +181,7 @@ __version__ = '2.0'
 ##########################################################
 Debug = False    # Enables debug messages
 Sanity = False   # If enabled, config commands are not sent to host (show commands are operational)
+ExitErrorSleep = 10
 
 ##########################################################
 try:
@@ -195,6 +201,13 @@ except: # If not running on XMC Jython...
         emc_vars = json.load(open(sys.argv[1]))
     else:
         emc_vars = json.load(open('emc_vars.json'))
+    if isinstance(emc_vars, list): # Json list of emc_vars dicts, to run against multiple devices
+        EmcVarsList = emc_vars
+        emc_vars = EmcVarsList[0]
+try:
+    EmcVarsList
+except: # On XMC we run against the one device we were launched on
+    EmcVarsList = [emc_vars]
 ##########################################################
 
 #
@@ -205,20 +218,12 @@ import re
 #
 # Base functions
 #
-import time                         # Used by exitError
-ExitErrorSleep = 10
 
 def debug(debugOutput): # v1 - Use function to include debugging in script; set above Debug variable to True or False to turn on or off debugging
     if Debug:
         print debugOutput
 
-def exitError(errorOutput, sleep=ExitErrorSleep): # v3 - Exit script with error message and setting status appropriately
-    if 'workflowMessage' in emc_vars: # Workflow
-        time.sleep(sleep) # When workflow run on multiple devices, want ones that error to be last to complete, so THEY set the workflow message
-        emc_results.put("deviceMessage", errorOutput)
-        emc_results.put("activityMessage", errorOutput)
-        emc_results.put("workflowMessage", errorOutput)
-    emc_results.setStatus(emc_results.Status.ERROR)
+def exitError(errorOutput): # v5 - Exit device run with error message; status & workflow messages are set by resultsPublish() once all devices are done
     raise RuntimeError(errorOutput)
 
 def abortError(cmd, errorOutput): # v1 - A CLI command failed, before bombing out send any rollback commands which may have been set
@@ -239,10 +244,150 @@ def scriptName(): # v1 - Returns the assigned name of the Script or Workflow
     return name
 
 
+#
+# Device context functions
+#
+import threading                    # Used by deviceContext, Threads, Save Config & Journal functions
+DeviceContext = threading.local()   # Per thread device state; the main thread defaults to the script's own emc_cli & emc_vars
+
+def deviceContextInit(cli, deviceVars, worker=False): # v5 - Bind a CLI session and emc_vars to calling thread, with fresh rollback/config/error/phase state
+    DeviceContext.cli = cli
+    DeviceContext.session = None
+    DeviceContext.vars = deviceVars
+    DeviceContext.worker = worker
+    DeviceContext.family = None
+    DeviceContext.rollbackStack = []
+    DeviceContext.configHistory = []
+    DeviceContext.warpBuffer = []
+    DeviceContext.deadmanArmed = False # Switch will revert a commit-confirm warp change by itself, see warpBuffer_execute()
+    DeviceContext.lastError = None
+    DeviceContext.lastNbiError = None
+    DeviceContext.phase = None      # Phase of main() being run
+    DeviceContext.phaseStart = None # Time that phase started
+    DeviceContext.phaseTimes = []   # (phase, secs) of completed phases
+    if cli:
+        cliSessionAttach(cli, deviceVars["deviceIP"])
+    return DeviceContext
+
+def deviceContext(): # v1 - Returns the device context of the calling thread
+    if not hasattr(DeviceContext, 'vars'):
+        deviceContextInit(emc_cli, emc_vars)
+    return DeviceContext
+
+
+#
+# Timing functions (requires Device context functions)
+#
+import time                         # Used by timingSpan, timingSleep & timingReport
+import os                           # Used by timingReport
+import json                         # Used by timingReport & resultsPublish
+import functools                    # Used by timed
+from contextlib import contextmanager # Used by timingSpan & saveSiteSlot
+TimingSpans = [] # (deviceIP, phase, secs) for all spans of this run, across all devices
+TimingSpansLock = threading.Lock()
+TimingStart = time.time()
+TimingReportFile = None     # If set, a JSON timing report of the run is written to this file
+TimingPrometheusFile = None # If set, Prometheus text format metrics of the run are written to this file (e.g. for node_exporter textfile collector)
+
+def percentile(sortedList, pct): # v1 - Returns the pct percentile (nearest rank) of an already sorted list
+    if not sortedList:
+        return None
+    return sortedList[max(0, min(len(sortedList) - 1, int(round(pct / 100.0 * len(sortedList))) - 1))]
+
+@contextmanager
+def timingSpan(phase): # v1 - Context manager recording time spent in the enclosed block, against calling thread's device
+    startTime = time.time()
+    try:
+        yield
+    finally:
+        elapsed = time.time() - startTime
+        with TimingSpansLock:
+            TimingSpans.append((deviceContext().vars["deviceIP"], phase, elapsed))
+
+def timed(phase): # v1 - Decorator recording time spent in the decorated function, as a timingSpan()
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timingSpan(phase):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def timingSleep(secs, phase='wait.sleep'): # v1 - time.sleep() recorded as a timingSpan()
+    with timingSpan(phase):
+        time.sleep(secs)
+
+def timingSummary(): # v1 - Returns dict of phase: count, total, p50, p95 & max secs, across all devices
+    phaseTimes = {}
+    with TimingSpansLock:
+        for deviceIp, phase, elapsed in TimingSpans:
+            phaseTimes.setdefault(phase, []).append(elapsed)
+    summary = {}
+    for phase, times in phaseTimes.items():
+        times.sort()
+        summary[phase] = {'count': len(times), 'total': sum(times), 'p50': percentile(times, 50), 'p95': percentile(times, 95), 'max': times[-1]}
+    return summary
+
+def timingReport(): # v3 - Prints time spent per phase, NBI cache & CLI show memo counters; also writes JSON report & Prometheus metrics files, if set
+    summary = timingSummary()
+    if not summary:
+        return
+    print "\nTime spent per phase ({} spans):".format(sum(x['count'] for x in summary.values()))
+    for phase in sorted(summary.keys()):
+        x = summary[phase]
+        print " - {:<16} count {:<5} total {:8.2f}s  p50 {:7.3f}s  p95 {:7.3f}s  max {:7.3f}s".format(phase, x['count'], x['total'], x['p50'], x['p95'], x['max'])
+    print "NBI: {} round-trips; cache {hits} hits, {misses} misses, {invalidations} invalidations".format(NbiRoundTrips, **NbiCacheStats)
+    print "CLI: {hits} show round-trips avoided by memo; {misses} misses, {invalidations} invalidations".format(**CliMemoStats)
+    if TimingReportFile:
+        devices = {}
+        with TimingSpansLock:
+            for deviceIp, phase, elapsed in TimingSpans:
+                devices.setdefault(deviceIp, {}).setdefault(phase, 0)
+                devices[deviceIp][phase] += elapsed
+        report = {
+            'script' : scriptName(),
+            'version': __version__,
+            'start'  : time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(TimingStart)),
+            'elapsed': time.time() - TimingStart,
+            'phases' : summary,
+            'devices': devices,
+            'nbi'    : dict(NbiCacheStats, roundTrips=NbiRoundTrips),
+            'cliMemo': dict(CliMemoStats),
+        }
+        with open(TimingReportFile, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        print "Timing report written to {}".format(TimingReportFile)
+    if TimingPrometheusFile:
+        script = (scriptName() or '').replace('"', '')
+        lines = [
+            '# HELP xmc_script_phase_seconds Time spent by XMC script per phase',
+            '# TYPE xmc_script_phase_seconds summary',
+        ]
+        for phase in sorted(summary.keys()):
+            x = summary[phase]
+            labels = 'script="{}",phase="{}"'.format(script, phase)
+            lines.append('xmc_script_phase_seconds{{{},quantile="0.5"}} {:.6f}'.format(labels, x['p50']))
+            lines.append('xmc_script_phase_seconds{{{},quantile="0.95"}} {:.6f}'.format(labels, x['p95']))
+            lines.append('xmc_script_phase_seconds_sum{{{}}} {:.6f}'.format(labels, x['total']))
+            lines.append('xmc_script_phase_seconds_count{{{}}} {}'.format(labels, x['count']))
+        lines.append('# HELP xmc_script_nbi_total NBI round-trips sent, and NBI cache lookups by result')
+        lines.append('# TYPE xmc_script_nbi_total counter')
+        lines.append('xmc_script_nbi_total{{script="{}",result="sent"}} {}'.format(script, NbiRoundTrips))
+        for key in sorted(NbiCacheStats.keys()):
+            lines.append('xmc_script_nbi_total{{script="{}",result="cache_{}"}} {}'.format(script, key, NbiCacheStats[key]))
+        lines.append('# HELP xmc_script_cli_memo_total CLI show command memo lookups by result, and memoized outputs invalidated')
+        lines.append('# TYPE xmc_script_cli_memo_total counter')
+        for key in sorted(CliMemoStats.keys()):
+            lines.append('xmc_script_cli_memo_total{{script="{}",result="{}"}} {}'.format(script, key, CliMemoStats[key]))
+        with open(TimingPrometheusFile + '.tmp', 'w') as f: # Written to temp file first, so a collector never reads a partial file
+            f.write("\n".join(lines) + "\n")
+        os.rename(TimingPrometheusFile + '.tmp', TimingPrometheusFile)
+        print "Prometheus metrics written to {}".format(TimingPrometheusFile)
+
+
 #
 # Family functions
 #
-Family = None # This needs to get set by setFamily()
 FamilyChildren = { # Children will be rolled into parent family for these scripts
     'Extreme Access Series' : 'VSP Series',
     'Unified Switching VOSS': 'VSP Series',
@@ -253,51 +398,54 @@ FamilyChildren = { # Children will be rolled into parent family for these script
     'Universal Platform Switch Engine': 'Summit Series',
 }
 
-def setFamily(cliDict={}, family=None): # v2 - Set global Family variable; automatically handles family children, as far as this script is concerned
-    global Family
+def setFamily(cliDict={}, family=None): # v3 - Set device context family; automatically handles family children, as far as this script is concerned
+    dc = deviceContext()
     if family:
-        Family = family
-    elif emc_vars["family"] in FamilyChildren:
-        Family = FamilyChildren[emc_vars["family"]]
+        dc.family = family
+    elif dc.vars["family"] in FamilyChildren:
+        dc.family = FamilyChildren[dc.vars["family"]]
     else:
-        Family = emc_vars["family"]
-    print "Using family type '{}' for this script".format(Family)
-    if cliDict and Family not in cliDict:
+        dc.family = dc.vars["family"]
+    print "Using family type '{}' for this script".format(dc.family)
+    if cliDict and dc.family not in cliDict:
         exitError('This scripts only supports family types: {}'.format(", ".join(list(cliDict.keys()))))
-    return Family
+    return dc.family
 
 
 #
 # CLI Rollback functions
 #
-RollbackStack = []
 
-def rollbackStack(): # v1 - Execute all commands on the rollback stack
-    if RollbackStack:
+def rollbackStack(): # v3 - Execute all commands on the rollback stack
+    dc = deviceContext()
+    if dc.rollbackStack and dc.deadmanArmed: # The switch reverts by itself, or already did; applying the rollback again would undo that
+        print "Switch deadman timer reverts the unconfirmed change; not applying rollback commands"
+        dc.rollbackStack = []
+    if dc.rollbackStack:
         print "Applying rollback commands to undo partial config and return device to initial state"
-        while RollbackStack:
-            sendCLI_configChain(RollbackStack.pop(), True)
-
-def rollbackCommand(cmd): # v1 - Add a command to the rollback stack; these commands will get popped and executed should we need to abort
-    RollbackStack.append(cmd)
-    cmdList = map(str.strip, re.split(r'[;\n]', cmd)) # cmd could be a configChain
-    cmdList = [x for x in cmdList if x] # Weed out empty elements 
-    cmdOneLiner = " / ".join(cmdList)
+        while dc.rollbackStack:
+            sendCLI_configChain(dc.rollbackStack.pop(), True)
+
+def rollbackCommand(cmd): # v3 - Add a command to the rollback stack; these commands will get popped and executed should we need to abort
+    deviceContext().rollbackStack.append(cmd)
+    cmdList = configChain(cmd) # cmd could be a configChain, or list of commands
+    cmdOneLiner = " / ".join(cmdList).replace("\n", " / ")
     print "Pushing onto rollback stack: {}\n".format(cmdOneLiner)
 
-def rollBackPop(number=0): # v1 - Remove entries from RollbackStack
-    global RollbackStack
+def rollBackPop(number=0): # v2 - Remove entries from the rollback stack
+    dc = deviceContext()
     if number == 0:
-        RollbackStack = []
+        dc.rollbackStack = []
         print "Rollback stack emptied"
     else:
-        del RollbackStack[-number:]
+        del dc.rollbackStack[-number:]
         print "Rollback stack popped last {} entries".format(number)
 
 
 #
 # CLI functions
 #
+import itertools                    # Used by sendCLI_showCommandStream
 RegexPrompt = re.compile('.*[\?\$%#>]\s?$')
 RegexError  = re.compile(
     '^%|\x07|error|invalid|cannot|unable|bad|not found|not exist|not allowed|no such|out of range|incomplete|failed|denied|can\'t|ambiguous|do not|unrecognized',
@@ -316,8 +464,22 @@ RegexContextPatterns = { # Ported from acli.pl
 }
 RegexExitInstance = re.compile('^ *(?:exit|back|end)(?:\s|$)')
 Indent = 3 # Number of space characters for each indentation
-LastError = None
-ConfigHistory = []
+StreamFirstMatchModes = ['bool', 'str', 'str-lower', 'str-upper', 'int', 'tuple'] # Modes which only need the 1st regex match
+CliPipeline = True # sendCLI_showCommands() sends many commands in one emc_cli round-trip; falls back to one by one if output does not split
+CliResyncTries = 3 # Empty lines sent to get the session back in sync after pipelined output could not be split, before giving up
+CliPrefetchConfig = False # If True, phaseValidate() also fetches the running config in its round-trip; saves one, but is wasted if validation fails
+CliShowMemo = True # Show command outputs are memoized per session, until a config command touches the config area they read
+CliMemoAreas = { # Config area: (regex of show commands reading it, regex of config commands changing it)
+    'mgmt': (re.compile(r'^show (?:mgmt|ip route|ip interface)\b'), re.compile(r'^(?:no |default )?(?:mgmt|ip route|ip address)\b')),
+    'vlan': (re.compile(r'^show (?:vlan|i-sid)\b'),                re.compile(r'^(?:no |default )?(?:vlan|i-sid)\b')),
+    'isis': (re.compile(r'^show (?:isis|spbm)\b'),                 re.compile(r'^(?:no |default )?(?:router isis|isis|spbm|sys-name)\b')),
+    'boot': (re.compile(r'^show boot config\b'),                   re.compile(r'^(?:no |default )?boot config\b')),
+} # Show commands reading no listed area (i.e. show running-config) go stale with any config change
+RegexMemoShow = re.compile(r'^show ') # Only these are memoized
+RegexMemoNoChange = re.compile(r'^(?:copy|delete|ping|save config|tftp get)\b') # Commands sent as config which change no config
+RegexMemoSource = re.compile(r'^(?:source|run script|configure network address)\b') # Commands sourcing a script file, as warpBuffer_execute() does
+CliMemoStats = {'hits': 0, 'misses': 0, 'invalidations': 0}
+CliMemoLock = threading.Lock()
 
 def cleanOutput(outputStr): # v2 - Remove echoed command and final prompt from output
     if RegexError.match(outputStr): # Case where emc_cli.send timesout: "Error: session exceeded timeout: 30 secs"
@@ -329,11 +491,63 @@ def cleanOutput(outputStr): # v2 - Remove echoed command and final prompt from o
         lines = outputStr.splitlines()[1:]
     return '\n'.join(lines)
 
-def configChain(chainStr): # v1 - Produces a list of a set of concatenated commands (either with ';' or newlines)
-    chainStr = re.sub(r'\n(\w)(\n|\s*;|$)', chr(0) + r'\1\2', chainStr) # Mask trailing "\ny" or "\nn" on commands before making list
-    cmdList = map(str.strip, re.split(r'[;\n]', chainStr))
-    cmdList = filter(None, cmdList) # Filter out empty lines, if any
-    cmdList = [re.sub(r'\x00(\w)(\n|$)', r'\n\1\2', x) for x in cmdList] # Unmask after list made
+def outputLines(outputStr): # v1 - Generator yielding lines of output, without splitting the whole output into a list
+    start = 0
+    while start < len(outputStr):
+        end = outputStr.find('\n', start)
+        if end < 0:
+            end = len(outputStr)
+        yield outputStr[start:end].rstrip('\r')
+        start = end + 1
+
+def cleanOutputLines(outputStr): # v1 - Same as cleanOutput() but as a line generator
+    lines = outputLines(outputStr)
+    firstLine = next(lines, None)
+    if firstLine == None:
+        return
+    if RegexError.match(firstLine): # Case where emc_cli.send timesout: "Error: session exceeded timeout: 30 secs"
+        yield firstLine
+        for line in lines:
+            yield line
+        return
+    previousLine = None # Hold back one line, so that the final prompt can be dropped
+    for line in lines:
+        if previousLine != None:
+            yield previousLine
+        previousLine = line
+    if previousLine != None and not RegexPrompt.match(previousLine):
+        yield previousLine
+
+RegexChainSplit = re.compile(r'([;\n])') # Config chain separators, kept in the split output
+RegexChainAnswer = re.compile(r'\w\s*$') # Confirm answer ("y" or "n") on its own line, following the command it answers
+
+def configChainAnswerEnds(pieces, i): # v1 - For configChain(); whether answer pieces[i] ends at a separator, or only has whitespace up to the next ';'
+    if len(pieces[i]) == 1:
+        return True
+    i += 1
+    while i < len(pieces) and pieces[i] == '\n' and not pieces[i + 1].strip(): # Whitespace only lines
+        i += 2
+    return pieces[i:i + 1] == [';']
+
+def configChain(chainStr): # v2 - Produces a list of a set of concatenated commands (either with ';' or newlines), in a single pass
+    # A trailing "\ny" or "\nn" stays on the command it answers; a list (i.e. a rendered ChainTemplate) is already a list of commands
+    if isinstance(chainStr, list):
+        return chainStr
+    pieces = RegexChainSplit.split(chainStr) # [cmd, separator, cmd, separator, .., cmd]
+    cmdList = []
+    lastCmd = None # Previous command, while it can still take a confirm answer
+    for i in xrange(0, len(pieces), 2):
+        piece = pieces[i]
+        if lastCmd is not None and pieces[i - 1] == '\n' and RegexChainAnswer.match(piece) and configChainAnswerEnds(pieces, i):
+            if lastCmd:
+                cmdList[-1] = lastCmd + '\n' + piece[0]
+            else:
+                cmdList.append('\n' + piece[0])
+            lastCmd = None
+            continue
+        lastCmd = piece.strip()
+        if lastCmd:
+            cmdList.append(lastCmd)
     return cmdList
 
 def parseRegexInput(cmdRegexStr): # v1 - Parses input command regex for both sendCLI_showRegex() and xmcLinuxCommand()
@@ -346,6 +560,86 @@ def parseRegexInput(cmdRegexStr): # v1 - Parses input command regex for both sen
     cmdList = map(str.strip, cmd.split('&'))
     return mode, cmdList, regex
 
+import string                       # Used by templateNumbered
+RegexCache = {} # (regex, flags): compiled regex
+CliSpecCache = {} # cmdRegexStr: CliSpec
+
+def regexCompile(regex, flags=re.MULTILINE): # v1 - Returns compiled regex, compiling it only once
+    key = (regex, flags)
+    if key not in RegexCache:
+        RegexCache[key] = re.compile(regex, flags)
+    return RegexCache[key]
+
+class CliSpec(object): # v1 - A "<type>://<cmd> [& <cmd>]||<regex>" string parsed once, for sendCLI_showRegex()
+    def __init__(self, cmdRegexStr):
+        self.template = cmdRegexStr
+        self.mode, self.cmdList, self.regex = parseRegexInput(cmdRegexStr)
+        self.formatted = {} # Specs already produced by format(), keyed by args
+
+    @property
+    def regexObj(self): # Compiled on first use, as templates with {} placeholders only ever get used formatted
+        return regexCompile(self.regex)
+
+    def format(self, *args): # Same as str.format() on the template, but returns a (cached) spec
+        if args not in self.formatted:
+            self.formatted[args] = CliSpec(self.template.format(*args))
+        return self.formatted[args]
+
+    def __str__(self):
+        return self.template
+
+def templateNumbered(template): # v1 - Returns a str.format() template with its auto-numbered "{}" fields made explicit ("{0}", "{1}", ..)
+    partList = []
+    index = 0
+    for literal, field, spec, conversion in string.Formatter().parse(template):
+        partList.append(literal.replace('{', '{{').replace('}', '}}'))
+        if field is None:
+            continue
+        if field == '':
+            field = str(index)
+            index += 1
+        partList.append('{' + field + ('!' + conversion if conversion else '') + (':' + spec if spec else '') + '}')
+    return ''.join(partList)
+
+class ChainTemplate(object): # v1 - A config chain template with {} placeholders split into its commands once, rendered by format()
+    def __init__(self, template):
+        self.template = template
+        # Commands are rendered one by one, so "{}" fields must not depend on their position in the whole template
+        self.cmdList = [(x, '{' in x or '}' in x) for x in configChain(templateNumbered(template))]
+
+    def format(self, *args, **kwargs): # Same as configChain(template.format()), but returns the list of rendered commands
+        cmdList = []
+        for cmd, hasFields in self.cmdList:
+            if not hasFields:
+                cmdList.append(cmd)
+                continue
+            cmd = cmd.format(*args, **kwargs).strip()
+            if ';' in cmd or '\n' in cmd: # Parameter holding more commands, like the ip route lines of revert_mgmt_vlan
+                cmdList.extend(configChain(cmd))
+            elif cmd: # Parameter can also be empty
+                cmdList.append(cmd)
+        return cmdList
+
+    def __str__(self):
+        return self.template
+
+def cliSpec(cmdRegexStr): # v1 - Returns the CliSpec for a cmdRegexStr, parsing it only once
+    if isinstance(cmdRegexStr, CliSpec):
+        return cmdRegexStr
+    if cmdRegexStr not in CliSpecCache:
+        CliSpecCache[cmdRegexStr] = CliSpec(cmdRegexStr)
+    return CliSpecCache[cmdRegexStr]
+
+def compileCliDict(cliDict): # v2 - Replaces all show regex entries ("<type>://<cmd>||<regex>") of CLI_Dict with CliSpec objects and config templates with ChainTemplate objects
+    for family in cliDict:
+        for key, value in cliDict[family].items():
+            if not isinstance(value, basestring):
+                continue
+            if '||' in value:
+                cliDict[family][key] = cliSpec(value)
+            elif '{' in value:
+                cliDict[family][key] = ChainTemplate(value)
+
 def formatOutputData(data, mode): # v2 - Formats output data for both sendCLI_showRegex() and xmcLinuxCommand()
     if not mode                 : value = data                                   # Legacy behaviour same as list
     elif mode == 'bool'         : value = bool(data)                             # No regex capturing brackets required
@@ -366,35 +660,100 @@ def formatOutputData(data, mode): # v2 - Formats output data for both sendCLI_sh
         RuntimeError("formatOutputData: invalid scheme type '{}'".format(mode))
     return value
 
-def sendCLI_showCommand(cmd, returnCliError=False, msgOnError=None): # v1 - Send a CLI show command; return output
-    global LastError
-    resultObj = emc_cli.send(cmd)
+def sendCLI_showCommand(cmd, returnCliError=False, msgOnError=None, memo=True): # v6 - Send a CLI show command; return output
+    # With memo=False the show command is sent even if its output is memoized on the session (the memo is then refreshed)
+    dc = deviceContext()
+    prefetched = cliPrefetchPop(cmd)
+    if prefetched != None: # Already fetched by sendCLI_showPlan()
+        dc.lastError = None
+        return prefetched
+    memoized = cliMemoGet(cmd) if memo else None
+    if memoized != None:
+        dc.lastError = None
+        return cleanOutput(memoized)
+    with timingSpan('cli.show'):
+        resultObj = dc.cli.send(cmd)
     if resultObj.isSuccess():
-        outputStr = cleanOutput(resultObj.getOutput())
+        rawOutput = resultObj.getOutput()
+        outputStr = cleanOutput(rawOutput)
         if outputStr and RegexError.search("\n".join(outputStr.split("\n")[:4])): # If there is output, check for error in 1st 4 lines only (timestamp banner might shift it by 3 lines)
-            if returnCliError: # If we asked to return upon CLI error, then the error message will be held in LastError
-                LastError = outputStr
+            if returnCliError: # If we asked to return upon CLI error, then the error message will be held in context lastError
+                dc.lastError = outputStr
                 if msgOnError:
                     print "==> Ignoring above error: {}\n\n".format(msgOnError)
                 return None
             abortError(cmd, outputStr)
-        LastError = None
+        dc.lastError = None
+        cliContextTrack(cmd)
+        cliMemoStore(cmd, rawOutput)
         return outputStr
     else:
         exitError(resultObj.getError())
 
-def sendCLI_showRegex(cmdRegexStr, debugKey=None, returnCliError=False, msgOnError=None): # v1 - Send show command and extract values from output using regex
+def sendCLI_showCommandStream(cmd, returnCliError=False, msgOnError=None, memo=True): # v4 - Send a CLI show command; return output as a line iterator (None if no output)
+    dc = deviceContext()
+    prefetched = cliPrefetchPop(cmd)
+    if prefetched != None: # Already fetched by sendCLI_showPlan()
+        dc.lastError = None
+        return outputLines(prefetched) if prefetched else None
+    memoized = cliMemoGet(cmd) if memo else None
+    if memoized != None:
+        dc.lastError = None
+        outputStr = cleanOutput(memoized)
+        return outputLines(outputStr) if outputStr else None
+    with timingSpan('cli.show'):
+        resultObj = dc.cli.send(cmd)
+    if resultObj.isSuccess():
+        rawOutput = resultObj.getOutput() # emc_cli returns the whole output anyway, so holding on to it for the memo is free
+        lines = cleanOutputLines(rawOutput)
+        headLines = list(itertools.islice(lines, 4))
+        if not headLines:
+            dc.lastError = None
+            cliContextTrack(cmd)
+            cliMemoStore(cmd, rawOutput)
+            return None
+        if RegexError.search("\n".join(headLines)): # Check for error in 1st 4 lines only (timestamp banner might shift it by 3 lines)
+            outputStr = "\n".join(itertools.chain(headLines, lines))
+            if returnCliError: # If we asked to return upon CLI error, then the error message will be held in context lastError
+                dc.lastError = outputStr
+                if msgOnError:
+                    print "==> Ignoring above error: {}\n\n".format(msgOnError)
+                return None
+            abortError(cmd, outputStr)
+        dc.lastError = None
+        cliContextTrack(cmd)
+        cliMemoStore(cmd, rawOutput)
+        return itertools.chain(headLines, lines)
+    else:
+        exitError(resultObj.getError())
+
+def sendCLI_showRegex(cmdRegexStr, debugKey=None, returnCliError=False, msgOnError=None, stream=False, memo=True): # v4 - Send show command and extract values from output using regex
     # Regex is by default case-sensitive; for case-insensitive include (?i) at beginning of regex on input string
-    mode, cmdList, regex = parseRegexInput(cmdRegexStr)
+    # cmdRegexStr can be either a string or a CliSpec; strings are parsed and compiled only once, on first use
+    # With stream=True output is consumed line by line and the regex is applied to each line, so it must not span lines;
+    # for modes which only need the 1st match (StreamFirstMatchModes) we stop reading output as soon as we have it
+    # With memo=False the show command is sent even if its output is memoized; use it when polling for a change
+    spec = cliSpec(cmdRegexStr)
+    mode, cmdList = spec.mode, spec.cmdList
+    sendFunction = sendCLI_showCommandStream if stream else sendCLI_showCommand
     for cmd in cmdList:
         # If cmdList we try each command in turn until one works; we don't want to bomb out on cmds before the last one in the list
         ignoreCliError = True if len(cmdList) > 1 and cmd != cmdList[-1] else returnCliError
-        outputStr = sendCLI_showCommand(cmd, ignoreCliError, msgOnError)
-        if outputStr:
+        output = sendFunction(cmd, ignoreCliError, msgOnError, memo)
+        if output:
             break
-    if not outputStr: # returnCliError true
+    if not output: # returnCliError true
         return None
-    data = re.findall(regex, outputStr, re.MULTILINE)
+    if stream:
+        data = []
+        for line in output:
+            lineData = spec.regexObj.findall(line)
+            if lineData:
+                data.extend(lineData)
+                if mode in StreamFirstMatchModes:
+                    break
+    else:
+        data = spec.regexObj.findall(output)
     debug("sendCLI_showRegex() raw data = {}".format(data))
     # Format we return data in depends on what '<type>://' was pre-pended to the cmd & regex
     value = formatOutputData(data, mode)
@@ -403,26 +762,143 @@ def sendCLI_showRegex(cmdRegexStr, debugKey=None, returnCliError=False, msgOnErr
         else: debug("sendCLI_showRegex OUT = {}".format(value))
     return value
 
-def sendCLI_configCommand(cmd, returnCliError=False, msgOnError=None, waitForPrompt=True): # v2 - Send a CLI config command
-    global LastError
+def cliOutputSplit(outputStr, cmdList): # v1 - Splits output of pipelined commands into one output per command, as emc_cli would have returned each; None if it cannot
+    lines = outputStr.splitlines()
+    starts = [] # (line index, prompt preceding the echoed command)
+    for index, line in enumerate(lines):
+        if len(starts) == len(cmdList):
+            break
+        cmd = cmdList[len(starts)]
+        line = line.rstrip()
+        if line == cmd and not starts:
+            starts.append((index, None))
+        elif line.endswith(cmd) and RegexPrompt.match(line[:-len(cmd)]):
+            starts.append((index, line[:-len(cmd)].rstrip()))
+    if len(starts) != len(cmdList):
+        return None
+    segments = []
+    for number, (index, prompt) in enumerate(starts):
+        if number + 1 < len(starts):
+            nextIndex, nextPrompt = starts[number + 1]
+            segments.append("\n".join(lines[index:nextIndex] + [nextPrompt]))
+        else:
+            segments.append("\n".join(lines[index:]))
+    return segments
+
+def cliResync(): # v1 - Sends empty lines until one returns just the prompt, so that no output of earlier commands is still pending; False if it never does
+    dc = deviceContext()
+    for _ in range(CliResyncTries):
+        with timingSpan('cli.show'):
+            resultObj = dc.cli.send('')
+        if not resultObj.isSuccess():
+            return False
+        if not [x for x in resultObj.getOutput().splitlines() if x.strip() and not RegexPrompt.match(x)]:
+            return True
+        debug("cliResync: discarding pending output:\n{}".format(resultObj.getOutput()))
+    return False
+
+def sendCLI_showCommands(cmdList, returnCliError=False, msgOnError=None, memo=True, noMemoList=[]): # v3 - Sends many show commands in one pipelined CLI round-trip; returns dict of cmd: output, as from sendCLI_showCommand()
+    # If the output cannot be split back into each command's output, the session is resynced and commands are sent again one by one
+    # Commands with memoized output are not sent, unless memo=False; outputs of commands in noMemoList are not memoized
+    dc = deviceContext()
+    cmdList = [x for index, x in enumerate(cmdList) if x not in cmdList[:index]] # De-duplicate, keeping order
+    outputDict = {}
+    if memo:
+        for cmd in cmdList:
+            memoized = cliMemoGet(cmd)
+            if memoized != None:
+                outputDict[cmd] = cleanOutput(memoized)
+        cmdList = [x for x in cmdList if x not in outputDict]
+        dc.lastError = None
+    if len(cmdList) <= 1 or not CliPipeline or (dc.session and not dc.session['pipeline']):
+        outputDict.update((x, sendCLI_showCommand(x, returnCliError, msgOnError, False)) for x in cmdList)
+        return outputDict
+    with timingSpan('cli.show'):
+        resultObj = dc.cli.send("\n".join(cmdList))
+    if not resultObj.isSuccess():
+        exitError(resultObj.getError())
+    segments = cliOutputSplit(resultObj.getOutput(), cmdList)
+    if not segments:
+        debug("sendCLI_showCommands: unable to split pipelined output; sending commands one by one")
+        if dc.session: # Don't try again on this session
+            dc.session['pipeline'] = False
+        if not cliResync(): # Output we could not split might only be part of it, with the rest still to come
+            exitError("Unable to resync CLI session after sending pipelined show commands: {}".format(", ".join(cmdList)))
+        outputDict.update((x, sendCLI_showCommand(x, returnCliError, msgOnError, False)) for x in cmdList)
+        return outputDict
+    lastError = None
+    for cmd, segment in zip(cmdList, segments):
+        outputStr = cleanOutput(segment)
+        if outputStr and RegexError.search("\n".join(outputStr.split("\n")[:4])): # If there is output, check for error in 1st 4 lines only
+            if returnCliError: # If we asked to return upon CLI error, then the error message will be held in context lastError
+                lastError = outputStr
+                if msgOnError:
+                    print "==> Ignoring above error: {}\n\n".format(msgOnError)
+                outputDict[cmd] = None
+                continue
+            abortError(cmd, outputStr)
+        cliContextTrack(cmd)
+        if cmd not in noMemoList:
+            cliMemoStore(cmd, segment)
+        outputDict[cmd] = outputStr
+    dc.lastError = lastError
+    return outputDict
+
+def sendCLI_showPlan(cmdRegexList, debugKey=None, returnCliError=False, msgOnError=None, prefetchList=[], memo=True, memoPrefetch=False): # v3 - Same as sendCLI_showRegex() for many cmdRegexStr at once; returns list of values
+    # Commands needed are de-duplicated and sent in one pipelined round-trip, then each regex is applied to its command's output
+    # For specs with alternative commands ("<cmd1> & <cmd2>") only the 1st is planned; if it fails, sendCLI_showRegex() tries the others
+    # Commands (or cmdRegexStr specs) in prefetchList are fetched in the same round-trip, and held (once) for the next
+    # sendCLI_showCommand() or sendCLI_showCommandStream() of them, until a config command is sent; they are only also
+    # memoized with memoPrefetch=True, as a prefetch can be a large output (i.e. show running-config) which is read only once
+    dc = deviceContext()
+    specList = [cliSpec(x) for x in cmdRegexList]
+    specCmds = [x.cmdList[0] for x in specList]
+    prefetchCmds = [cliSpec(x).cmdList[0] if '://' in str(x) else x for x in prefetchList if x != True]
+    noMemoList = [] if memoPrefetch else [x for x in prefetchCmds if x not in specCmds]
+    outputDict = sendCLI_showCommands(specCmds + prefetchCmds, True, memo=memo, noMemoList=noMemoList)
+    for cmd in prefetchCmds:
+        if outputDict[cmd] != None and dc.session:
+            dc.session['prefetch'][cmd] = outputDict[cmd]
+    valueList = []
+    for spec in specList:
+        output = outputDict[spec.cmdList[0]]
+        if output: # Same as sendCLI_showRegex() does
+            data = spec.regexObj.findall(output)
+            debug("sendCLI_showPlan() raw data = {}".format(data))
+            value = formatOutputData(data, spec.mode)
+            if Debug:
+                if debugKey: debug("{} = {}".format(debugKey, value))
+                else: debug("sendCLI_showPlan OUT = {}".format(value))
+        else: # Error, or no output; the usual way, trying alternative commands
+            value = sendCLI_showRegex(spec, debugKey, returnCliError, msgOnError, memo=memo)
+        valueList.append(value)
+    return valueList
+
+def sendCLI_configCommand(cmd, returnCliError=False, msgOnError=None, waitForPrompt=True): # v7 - Send a CLI config command
+    dc = deviceContext()
     cmdStore = re.sub(r'\n.+$', '', cmd) # Strip added CR+y or similar
+    if not RegexContextChange.match(cmdStore): # Prefetched show outputs could now be stale
+        cliPrefetchClear()
+    cliMemoConfig(cmdStore)
     if Sanity:
         print "SANITY> {}".format(cmd)
-        ConfigHistory.append(cmdStore)
-        LastError = None
+        dc.configHistory.append(cmdStore)
+        dc.lastError = None
         return True
-    resultObj = emc_cli.send(cmd, waitForPrompt)
+    with timingSpan('cli.config'):
+        resultObj = dc.cli.send(cmd, waitForPrompt)
     if resultObj.isSuccess():
         outputStr = cleanOutput(resultObj.getOutput())
         if outputStr and RegexError.search("\n".join(outputStr.split("\n")[:4])): # If there is output, check for error in 1st 4 lines only
-            if returnCliError: # If we asked to return upon CLI error, then the error message will be held in LastError
-                LastError = outputStr
+            if returnCliError: # If we asked to return upon CLI error, then the error message will be held in context lastError
+                dc.lastError = outputStr
                 if msgOnError:
                     print "==> Ignoring above error: {}\n\n".format(msgOnError)
                 return False
             abortError(cmd, outputStr)
-        ConfigHistory.append(cmdStore)
-        LastError = None
+        dc.configHistory.append(cmdStore)
+        dc.lastError = None
+        cliContextTrack(cmdStore)
         return True
     else:
         exitError(resultObj.getError())
@@ -442,19 +918,20 @@ def sendCLI_configChain(chainStr, returnCliError=False, msgOnError=None, waitFor
         return False
     return successStatus
 
-def printConfigSummary(): # v1 - Print summary of all config commands executed with context indentation
-    emc_cli.close()
-    if not len(ConfigHistory):
+def printConfigSummary(): # v3 - Print summary of all config commands executed with context indentation
+    dc = deviceContext()
+    cliSessionClose()
+    if not len(dc.configHistory):
         print "No configuration was performed"
         return
     print "The following configuration was successfully performed on switch:"
     indent = ''
     level = 0
-    if Family in RegexContextPatterns:
-        maxLevel = len(RegexContextPatterns[Family])
-    for cmd in ConfigHistory:
-        if Family in RegexContextPatterns:
-            if RegexContextPatterns[Family][level].match(cmd):
+    if dc.family in RegexContextPatterns:
+        maxLevel = len(RegexContextPatterns[dc.family])
+    for cmd in dc.configHistory:
+        if dc.family in RegexContextPatterns:
+            if RegexContextPatterns[dc.family][level].match(cmd):
                 print "-> {}{}".format(indent, cmd)
                 if level + 1 < maxLevel:
                     level += 1
@@ -467,34 +944,307 @@ def printConfigSummary(): # v1 - Print summary of all config commands executed w
         print "-> {}{}".format(indent, cmd)
 
 
+#
+# CLI session functions (requires CLI functions)
+#
+CliSessions = {} # Device IP: session dict; sessions are kept open and reused until closed with cliSessionClose()
+CliSessionsLock = threading.Lock()
+CliContextCommands = { # Commands to move between CLI contexts: exec -> privExec -> config
+    'VSP Series'    : {'noPaging': 'terminal more disable', 'privExec': 'enable', 'config': 'config term', 'endConfig': 'end', 'disable': 'disable'},
+    'ERS Series'    : {'noPaging': 'terminal length 0',     'privExec': 'enable', 'config': 'config term', 'endConfig': 'end', 'disable': 'disable'},
+    'Summit Series' : {'noPaging': 'disable clipaging'}, # No contexts on EXOS
+}
+RegexContextChange = re.compile(r'^ *(?:(enable)|(disable)|(conf(?:ig(?:ure)?)? t(?:erm(?:inal)?)?)|(end)|(exit)|(terminal more disable|terminal length 0|disable clipaging))\s*$')
+
+def cliSessionAttach(cli, deviceIp): # v3 - Registers CLI session for deviceIp, or returns the one already registered, and makes it the calling thread's session
+    dc = deviceContext()
+    with CliSessionsLock:
+        if deviceIp not in CliSessions or CliSessions[deviceIp]['cli'] is not cli:
+            CliSessions[deviceIp] = {
+                'cli'         : cli,
+                'ip'          : deviceIp,
+                'context'     : None, # None until established; then 'exec', 'privExec' or 'config'
+                'configDepth' : 0,    # Number of config sub-contexts entered (interface, router isis, etc..)
+                'paging'      : True,
+                'prefetch'    : {},   # Show cmd: output, fetched ahead by sendCLI_showPlan()
+                'pipeline'    : True, # False once pipelined output could not be split
+                'memo'        : {},   # Normalized show cmd: (raw output, config areas it reads)
+                'memoScope'   : frozenset(), # Config areas of the config sub-context we are in; None if not known
+                'memoSource'  : None, # Config areas changed by the script file sourced next, set by warpBuffer_execute()
+            }
+        session = CliSessions[deviceIp]
+    dc.session = session
+    dc.cli = cli
+    return session
+
+def cliPrefetchPop(cmd): # v1 - Returns (once) the output prefetched for a show command on calling thread's session, or None
+    session = deviceContext().session
+    if not session:
+        return None
+    return session['prefetch'].pop(cmd, None)
+
+def cliPrefetchClear(): # v1 - Drops all outputs prefetched on calling thread's session
+    session = deviceContext().session
+    if session:
+        session['prefetch'].clear()
+
+def cliMemoKey(cmd): # v1 - Returns the normalized show command output is memoized under, or None if not memoized
+    key = " ".join(cmd.split())
+    return key if RegexMemoShow.match(key) else None
+
+def cliMemoGet(cmd): # v1 - Returns the raw output memoized for a show command on calling thread's session, or None
+    session = deviceContext().session
+    key = cliMemoKey(cmd)
+    if not CliShowMemo or not session or not key:
+        return None
+    entry = session['memo'].get(key)
+    with CliMemoLock:
+        CliMemoStats['hits' if entry else 'misses'] += 1
+    return entry[0] if entry else None
+
+def cliMemoStore(cmd, rawOutput): # v1 - Memoizes the raw output of a show command on calling thread's session
+    session = deviceContext().session
+    key = cliMemoKey(cmd)
+    if CliShowMemo and session and key:
+        session['memo'][key] = (rawOutput, frozenset(x for x in CliMemoAreas if CliMemoAreas[x][0].match(key)))
+
+def cliMemoAreas(cmdList, scope=frozenset()): # v1 - Returns the CliMemoAreas a list of config commands changes (None if it could be any) & the sub-context areas it leaves us in
+    # Commands inside a config sub-context (i.e. "mgmt vlan 20", "router isis") change the areas of that sub-context
+    contextRegex = RegexContextPatterns.get(deviceContext().family, [None])[0]
+    areas = set()
+    for cmd in cmdList:
+        cmd = cmd.split('\n', 1)[0].strip()
+        if RegexExitInstance.match(cmd):
+            scope = frozenset()
+            continue
+        if RegexMemoNoChange.match(cmd) or (scope == frozenset() and RegexContextChange.match(cmd)):
+            continue
+        cmdAreas = frozenset(x for x in CliMemoAreas if CliMemoAreas[x][1].match(cmd)) or scope
+        if contextRegex and contextRegex.match(cmd):
+            scope = cmdAreas or None
+        if not cmdAreas:
+            areas = None
+        elif areas != None:
+            areas |= cmdAreas
+    return areas, scope
+
+def cliMemoInvalidate(areas=None): # v1 - Drops memoized show outputs of calling thread's session which read any of the config areas; all if None
+    session = deviceContext().session
+    if not session or not session['memo'] or (areas != None and not areas):
+        return
+    staleList = [x for x, (_, readAreas) in session['memo'].items() if areas == None or not readAreas or readAreas & areas]
+    for key in staleList:
+        del session['memo'][key]
+    if staleList:
+        with CliMemoLock:
+            CliMemoStats['invalidations'] += len(staleList)
+
+def cliMemoConfig(cmd): # v1 - Drops the memoized show outputs a config command, about to be sent on calling thread's session, can make stale
+    session = deviceContext().session
+    if not session:
+        return
+    if session['memoSource'] != None and RegexMemoSource.match(cmd.strip()): # Script file staged by warpBuffer_execute()
+        areas = session['memoSource']
+        session['memoSource'] = None
+    else:
+        areas, session['memoScope'] = cliMemoAreas([cmd], session['memoScope'])
+    cliMemoInvalidate(areas)
+
+def cliContextTrack(cmd): # v1 - Updates the session CLI context following a successfully sent command
+    dc = deviceContext()
+    session = dc.session
+    if not session:
+        return
+    match = RegexContextChange.match(cmd)
+    if match:
+        enable, disable, configTerm, end, exit, noPaging = match.groups()
+        if noPaging:
+            session['paging'] = False
+            if not session['context']:
+                session['context'] = 'exec'
+        elif enable and session['context'] in (None, 'exec'):
+            session['context'] = 'privExec'
+        elif disable:
+            session['context'] = 'exec'
+        elif configTerm:
+            session['context'] = 'config'
+            session['configDepth'] = 0
+        elif end and session['context'] == 'config':
+            session['context'] = 'privExec'
+        elif exit and session['context'] == 'config':
+            if session['configDepth'] > 0:
+                session['configDepth'] -= 1
+            else:
+                session['context'] = 'privExec'
+    elif session['context'] == 'config' and dc.family in RegexContextPatterns and RegexContextPatterns[dc.family][0].match(cmd):
+        session['configDepth'] += 1
+
+def cliContext(target): # v1 - Moves session to CLI context target: 'exec', 'privExec' or 'config'; only sends the commands needed
+    dc = deviceContext()
+    session = dc.session
+    commands = CliContextCommands.get(dc.family, {})
+    if session['paging'] and 'noPaging' in commands:
+        sendCLI_showCommand(commands['noPaging'])
+    if not commands.get('privExec') or session['context'] == target:
+        return
+    if session['context'] == 'config' and (target != 'config' or session['configDepth']): # Leave config, or get back to its top level
+        sendCLI_configCommand(commands['endConfig'])
+    if target in ('privExec', 'config') and session['context'] in (None, 'exec'):
+        sendCLI_showCommand(commands['privExec'])
+    if target == 'config' and session['context'] != 'config':
+        sendCLI_configCommand(commands['config'])
+    elif target == 'exec' and session['context'] == 'privExec':
+        sendCLI_showCommand(commands['disable'])
+
+def cliSessionReconnect(newIp, context='privExec'): # v4 - Re-points calling thread's session to the device's new IP, and enters context
+    # Returns False if no session could be established on the new IP, in which case the error is held in context lastError
+    dc = deviceContext()
+    session = dc.session
+    with CliSessionsLock:
+        if CliSessions.get(session['ip']) is session:
+            del CliSessions[session['ip']]
+        session['ip'] = newIp
+        CliSessions[newIp] = session
+    if Sanity:
+        print "SANITY> re-connect CLI session to {}".format(newIp)
+        return True
+    session['cli'].close()
+    session['cli'].setIpAddress(newIp)
+    session.update({'context': None, 'configDepth': 0, 'paging': True, 'prefetch': {}, 'memo': {}, 'memoScope': frozenset(), 'memoSource': None})
+    commands = CliContextCommands.get(dc.family, {})
+    with timingSpan('cli.connect'):
+        resultObj = session['cli'].send(commands.get('noPaging', ''))
+    if not resultObj.isSuccess():
+        dc.lastError = resultObj.getError()
+        print "Unable to establish CLI session on {}: {}".format(newIp, dc.lastError)
+        return False
+    cliContextTrack(commands.get('noPaging', ''))
+    cliContext(context)
+    dc.lastError = None
+    return True
+
+def cliSessionClose(): # v3 - Closes and unregisters calling thread's session
+    dc = deviceContext()
+    session = dc.session
+    if not session:
+        return
+    with CliSessionsLock:
+        if CliSessions.get(session['ip']) is session:
+            del CliSessions[session['ip']]
+    session['cli'].close()
+    session.update({'context': None, 'configDepth': 0, 'paging': True, 'prefetch': {}, 'memo': {}, 'memoScope': frozenset(), 'memoSource': None})
+
+
 #
 # CLI warp buffer functions (requires CLI functions)
 #
 import os                           # Used by warpBuffer_execute
-WarpBuffer = []
-
-def warpBuffer_add(chainStr): # v1 - Preload WarpBuffer with config or configChains; buffer can then be executed with warpBuffer_execute()
-    global WarpBuffer
+WarpRollbackStage = { # XMC server IP (TFTP server), Script file to fetch and leave on switch, to be sourced there if ever needed
+    'VSP Series':    'copy "{0}:{1}" /intflash/.rollback.src -y',
+    'Summit Series': 'tftp get {0} "{1}" .rollback.xsf',
+}
+WarpRollbackUnstage = { # Deleting the staged rollback script is also what disarms the deadman timer; the deadman deletes it once fired
+    'VSP Series':    'delete /intflash/.rollback.src -y',
+    'Summit Series': 'rm .rollback.xsf',
+}
+WarpDeadmanArm = { # Switch's own new IP, Timer secs; appended to the warp script in commit-confirm mode
+    # VOSS has no CLI scheduler, so the sourced script itself is the timer: it pings the switch's own new IP, count times one sec apart;
+    # it then sources the staged rollback, unless warpBuffer_confirm() deleted it in the meantime, and deletes it, so that the deadman
+    # can only fire once. This relies on VOSS running a sourced script to its end once the CLI session which launched it is gone, and
+    # on a nested source; neither is documented, so warpDeadmanTest() checks both on the switch before a commit-confirm change
+    'VSP Series':    'ping {0} count {1} -I 1 -t 1; source .rollback.src; delete /intflash/.rollback.src -y',
+}
+WarpDeadmanFlag = { # Flag file created by the staged rollback of the deadman self-test, once the deadman fires; and its deletion
+    'VSP Series':    ('copy /intflash/.rollback.src /intflash/.deadman.flag -y', 'delete /intflash/.deadman.flag -y'),
+}
+DeadmanTestTimer = 3 # Timer secs of the deadman armed by warpDeadmanTest()
+DeadmanTestGrace = 5 # Secs given on top of the timer, for the deadman self-test to fire
+DeadmanTimer = 300 # Secs given to XMC to confirm a commit-confirm warp change, before the switch reverts it
+# Must cover the reachability wait, the XMC & NAC deletes, the re-add and up to two discovery waits (see phaseConfirm)
+XmcTftpRoot = '/tftpboot' # Where warp script files are written, for switches to fetch them from XMC's TFTP server
+WarpTftpCheck = { # Whether switch can fetch warp scripts from XMC
+    'VSP Series':    'bool://show boot config flags||^flags tftpd true',
+    'Summit Series': 'bool://show process tftpd||Ready',
+    'ERS Series':    True, # Always enabled
+}
+import hashlib                      # Used by warpStageFile
+import uuid                         # Used by warpStageFile
+WarpStaged = {} # File name: number of switches still to fetch it; script files are named after a hash of their content
+WarpStagedToken = uuid.uuid4().hex[:8] # Unique to this script instance; XMC runs concurrent instances, whose files must not collide
+WarpStagedLock = threading.Lock()
+WarpStagedBatch = [False] # While True, files no longer referenced are only deleted by warpStagingCleanup(), as other switches may want them
+
+def warpBuffer_add(chainStr): # v3 - Preload warp buffer with config or configChains; buffer can then be executed with warpBuffer_execute()
+    dc = deviceContext()
     cmdList = configChain(chainStr)
     for cmd in cmdList:
-        cmdAdd = re.sub(r'\n.+$', '', cmd) # Strip added CR+y or similar (these are not required when sourcing from file on VOSS and do not work on ERS anyway)
-        WarpBuffer.append(cmdAdd)
+        # Strip added CR+y or similar (these are not required when sourcing from file on VOSS and do not work on ERS anyway)
+        dc.warpBuffer.append(cmd.split('\n', 1)[0] if '\n' in cmd else cmd)
+
+def warpBuffer_writeFile(tftpFilePath, cmdList, family): # v1 - Writes a list of commands to a script file under XMC's TFTP root directory
+    try:
+        with open(tftpFilePath, 'w') as f:
+            if family == 'VSP Series': # Always add these 2 lines, as VSP source command does not inherit current context
+                f.write("enable\n")
+                f.write("config term\n")
+            for cmd in cmdList:
+                f.write(cmd + "\n")
+            f.write("\n") # Make sure we have an empty line at the end, or VSP sourcing won't process last line...
+            debug("warpBuffer - write of TFTP config file : {}".format(tftpFilePath))
+    except Exception as e: # Expect IOError
+        print "{}: {}".format(type(e).__name__, str(e))
+        exitError("Unable to write to TFTP file '{}'".format(tftpFilePath))
 
-def warpBuffer_execute(chainStr=None, returnCliError=False, msgOnError=None, waitForPrompt=True): # v3 - Appends to existing WarpBuffer and then executes it
+def warpStageFile(cmdList, family): # v2 - Writes a script file under XMC's TFTP root, unless one with same content is already there; returns its file name
+    # All switches of this script instance needing the same script share one file; each call takes a reference to be released with
+    # warpUnstageFile(). The references only count within this instance, so the file name also holds WarpStagedToken: another instance
+    # staging the same content, e.g. XMC running this script against another switch, writes and deletes its own file
+    dc = deviceContext()
+    content = "\n".join([family] + cmdList)
+    fileName = dc.vars["userName"] + '.' + scriptName().replace(' ', '_') + '.' + WarpStagedToken + '.' + hashlib.sha1(content if isinstance(content, str) else content.encode('utf-8')).hexdigest()[:16]
+    with WarpStagedLock:
+        if fileName not in WarpStaged:
+            warpBuffer_writeFile(XmcTftpRoot + '/' + fileName, cmdList, family)
+            WarpStaged[fileName] = 0
+        WarpStaged[fileName] += 1
+    return fileName
+
+def warpUnstageFile(fileName): # v1 - Releases a reference to a staged script file; deletes it once unreferenced, unless in batch mode
+    with WarpStagedLock:
+        WarpStaged[fileName] -= 1
+        if WarpStaged[fileName] > 0 or WarpStagedBatch[0]:
+            return
+        del WarpStaged[fileName]
+    os.remove(XmcTftpRoot + '/' + fileName)
+    debug("warpBuffer - delete of TFTP config file : {}".format(fileName))
+
+def warpStagingBatch(): # v1 - Enters batch mode: staged script files are kept until warpStagingCleanup(), so they are written once for all switches
+    WarpStagedBatch[0] = True
+
+def warpStagingCleanup(): # v1 - Leaves batch mode, deleting all staged script files no longer referenced
+    with WarpStagedLock:
+        WarpStagedBatch[0] = False
+        fileList = [x for x in WarpStaged if WarpStaged[x] <= 0]
+        for fileName in fileList:
+            del WarpStaged[fileName]
+    for fileName in fileList:
+        os.remove(XmcTftpRoot + '/' + fileName)
+    debug("warpStagingCleanup - deleted {} TFTP config files".format(len(fileList)))
+
+@timed('warp')
+def warpBuffer_execute(chainStr=None, returnCliError=False, msgOnError=None, waitForPrompt=True, rollbackChain=None, commitConfirm=None, deadmanIp=None): # v12 - Appends to existing warp buffer and then executes it
     # Same as sendCLI_configChain() but all commands are placed in a script file on the switch and then sourced there
     # Apart from being fast, this approach can be used to make config changes which would otherwise result in the switch becomming unreachable
     # Use of this function assumes that the connected device (VSP) is already in privExec + config mode
-    global WarpBuffer
-    global LastError
-    xmcTftpRoot = '/tftpboot'
-    xmcServerIP = emc_vars["serverIP"]
-    switchIP = emc_vars["deviceIP"]
-    userName = emc_vars["userName"]
-    tftpCheck = {
-        'VSP Series':    'bool://show boot config flags||^flags tftpd true',
-        'Summit Series': 'bool://show process tftpd||Ready',
-        'ERS Series':    True, # Always enabled
-    }
+    # If a rollbackChain is provided, it is pre-staged on the switch as a 2nd script file before the warp buffer is sourced; should the
+    # switch become unreachable, that file can be sourced on the switch itself (see WarpRollbackStage) to undo the change
+    # The rollbackChain is also pushed onto the rollback stack, but only once the warp script was fetched, right before it is sourced
+    # With commitConfirm = <secs> (requires rollbackChain) the switch sources the staged rollback by itself after that many secs, unless
+    # the change was confirmed with warpBuffer_confirm() in the meantime; deadmanIp is the switch's own IP once the change is made,
+    # which it pings as its timer (see WarpDeadmanArm); until confirmed, rollbackStack() leaves the revert to the switch
+    dc = deviceContext()
+    family = dc.family
+    xmcServerIP = dc.vars["serverIP"]
     tftpActivate = {
         'VSP Series':    'boot config flags tftpd',
         'Summit Series': 'start process tftpd',
@@ -511,65 +1261,205 @@ def warpBuffer_execute(chainStr=None, returnCliError=False, msgOnError=None, wai
 
     if chainStr:
         warpBuffer_add(chainStr)
-    if Family not in tftpCheck:
-        exitError('Sourcing commands via TFTP only supported in family types: {}'.format(", ".join(list(tftpCheck.keys()))))
+    if family not in WarpTftpCheck:
+        exitError('Sourcing commands via TFTP only supported in family types: {}'.format(", ".join(list(WarpTftpCheck.keys()))))
+    if rollbackChain and family not in WarpRollbackStage:
+        exitError('Staging rollback commands via TFTP only supported in family types: {}'.format(", ".join(list(WarpRollbackStage.keys()))))
+    if commitConfirm and not rollbackChain:
+        exitError('Commit-confirm warp execution requires rollback commands')
+    if commitConfirm and family not in WarpDeadmanArm:
+        exitError('Commit-confirm warp execution only supported in family types: {}'.format(", ".join(list(WarpDeadmanArm.keys()))))
+    if commitConfirm and not deadmanIp:
+        exitError('Commit-confirm warp execution requires the IP the switch will have after the change')
+    rollbackList = [x.split('\n', 1)[0] for x in configChain(rollbackChain)] if rollbackChain else []
+    deadmanList = configChain(WarpDeadmanArm[family].format(deadmanIp, commitConfirm)) if commitConfirm else []
 
     # Determine whether switch can do TFTP
-    if tftpCheck[Family] == True:
+    if WarpTftpCheck[family] == True:
         tftpEnabled = True
     else:
-        tftpEnabled = sendCLI_showRegex(tftpCheck[Family])
+        tftpEnabled = sendCLI_showRegex(WarpTftpCheck[family], stream=True)
     if not tftpEnabled:
         if Sanity:
-            print "SANITY> {}".format(tftpActivate[Family])
-            ConfigHistory.append(tftpActivate[Family])
+            print "SANITY> {}".format(tftpActivate[family])
+            dc.configHistory.append(tftpActivate[family])
         else:
-            sendCLI_configCommand(tftpActivate[Family], returnCliError, msgOnError) # Activate TFTP now
-        warpBuffer_add(tftpDeactivate[Family])      # Restore TFTP state on completion
+            sendCLI_configCommand(tftpActivate[family], returnCliError, msgOnError) # Activate TFTP now
+        warpBuffer_add(tftpDeactivate[family])      # Restore TFTP state on completion
 
     if Sanity:
-        for cmd in WarpBuffer:
+        for cmd in rollbackList:
+            print "SANITY(warp rollback)> {}".format(cmd)
+        for cmd in dc.warpBuffer:
             print "SANITY(warp)> {}".format(cmd)
-            ConfigHistory.append(cmd)
-        LastError = None
+            dc.configHistory.append(cmd)
+        for cmd in deadmanList:
+            print "SANITY(warp deadman)> {}".format(cmd)
+        dc.warpBuffer = []
+        dc.lastError = None
         return True
 
-    # Write the commands to a file under XMC's TFTP root directory
-    tftpFileName = userName + '.' + scriptName().replace(' ', '_') + '.' + switchIP.replace('.', '_')
-    tftpFilePath = xmcTftpRoot + '/' + tftpFileName
-    try:
-        with open(tftpFilePath, 'w') as f:
-            if Family == 'VSP Series': # Always add these 2 lines, as VSP source command does not inherit current context
-                f.write("enable\n")
-                f.write("config term\n")
-            for cmd in WarpBuffer:
-                f.write(cmd + "\n")
-            f.write("\n") # Make sure we have an empty line at the end, or VSP sourcing won't process last line...
-            debug("warpBuffer - write of TFTP config file : {}".format(tftpFilePath))
-    except Exception as e: # Expect IOError
-        print "{}: {}".format(type(e).__name__, str(e))
-        exitError("Unable to write to TFTP file '{}'".format(tftpFilePath))
+    # Write the commands to a file under XMC's TFTP root directory, or re-use the one with same commands
+    tftpFileName = warpStageFile(dc.warpBuffer + deadmanList, family)
 
-    # Make the switch fetch the file and execute it
-    success = sendCLI_configChain(tftpExecute[Family].format(xmcServerIP, tftpFileName), returnCliError, msgOnError, waitForPrompt)
-    # Clean up by deleting the file from XMC TFTP directory
-    os.remove(tftpFilePath)
-    debug("warpBuffer - delete of TFTP config file : {}".format(tftpFilePath))
+    # Sourcing the file only makes the memoized show outputs reading the config areas it changes stale; the deadman sources the rollback
+    memoAreas = cliMemoAreas(dc.warpBuffer + rollbackList)[0]
+    if memoAreas != None and dc.session:
+        dc.session['memoSource'] = memoAreas
 
-    if not success: # In this case some commands might have executed, before the error; these won't be captured in ConfigHistory
-        WarpBuffer = []
+    # Pre-stage the rollback script on the switch, before anything gets changed
+    if rollbackList:
+        rollbackFileName = warpStageFile(rollbackList, family)
+        success = sendCLI_configCommand(WarpRollbackStage[family].format(xmcServerIP, rollbackFileName), returnCliError, msgOnError)
+        warpUnstageFile(rollbackFileName)
+        if not success:
+            warpUnstageFile(tftpFileName)
+            dc.warpBuffer = []
+            if dc.session:
+                dc.session['memoSource'] = None
+            return False
+
+    # Make the switch fetch the file and execute it; until it is executed nothing has changed on the switch, so should fetching it
+    # fail we abort without rolling back; the rollback only becomes valid once the file gets sourced
+    cmdList = configChain(tftpExecute[family].format(xmcServerIP, tftpFileName))
+    success = sendCLI_configChain(cmdList[:-1], returnCliError, msgOnError) if len(cmdList) > 1 else True
+    if success:
+        if rollbackChain:
+            rollbackCommand(rollbackChain)
+        dc.deadmanArmed = bool(commitConfirm) # From here on the switch may revert by itself
+        success = sendCLI_configChain(cmdList[-1:], returnCliError, msgOnError, waitForPrompt)
+    # Clean up by releasing the file from XMC TFTP directory
+    warpUnstageFile(tftpFileName)
+
+    if not success: # In this case some commands might have executed, before the error; these won't be captured in configHistory
+        dc.warpBuffer = []
         return False
-    ConfigHistory.extend(WarpBuffer)
-    WarpBuffer = []
-    LastError = None
+    dc.configHistory.extend(dc.warpBuffer)
+    dc.warpBuffer = []
+    dc.lastError = None
     return True
 
+def warpBuffer_confirm(): # v3 - Confirms a warpBuffer_execute(commitConfirm=<secs>) change, by deleting the staged rollback on the switch
+    # Must be called over a privExec session to the switch on its new IP (see cliSessionReconnect), before the deadman timer expires
+    # Returns False if the switch could not be reached or the staged rollback could not be deleted; the latter also happens if the
+    # deadman already fired, as it deletes the rollback once sourced; either way the switch reverts, or has reverted, the change
+    dc = deviceContext()
+    cmdList = configChain(WarpRollbackUnstage[dc.family])
+    if Sanity:
+        for cmd in cmdList:
+            print "SANITY> {}".format(cmd)
+        dc.deadmanArmed = False
+        dc.lastError = None
+        return True
+    for cmd in cmdList:
+        with timingSpan('cli.config'):
+            resultObj = dc.cli.send(cmd)
+        if not resultObj.isSuccess():
+            dc.lastError = resultObj.getError()
+            return False
+        outputStr = cleanOutput(resultObj.getOutput())
+        if outputStr and RegexError.search("\n".join(outputStr.split("\n")[:4])):
+            dc.lastError = outputStr
+            return False
+    print "Change confirmed; switch deadman timer disarmed"
+    dc.deadmanArmed = False
+    dc.lastError = None
+    return True
+
+def warpDeadmanTest(deviceIp): # v2 - Checks that the switch fires a commit-confirm deadman timer launched from a CLI session which then goes away
+    # Arms a short deadman whose staged rollback only creates a flag file, closes the session that launched it, and checks over a new
+    # session to deviceIp that the flag is there; i.e. the same warp script, nested source and session loss as in a real change
+    # The flag must be created by the rollback: were the script to die with the session before it even started, no flag would show
+    # Must be called in privExec, and leaves the session in privExec; returns True if the deadman fired, False if it did not, or None
+    # if the test could not be run, in which case the error is held in context lastError
+    dc = deviceContext()
+    flagCopy, flagDelete = WarpDeadmanFlag[dc.family]
+    if Sanity:
+        print "SANITY> deadman self-test on {}".format(deviceIp)
+        return True
+    print "Checking that switch deadman timer fires once the CLI session is gone ({}secs)".format(DeadmanTestTimer + DeadmanTestGrace)
+    configHistoryLength = len(dc.configHistory)
+    rollbackLength = len(dc.rollbackStack)
+    try:
+        cliContext('config')
+        if not warpBuffer_execute(flagDelete, returnCliError=True, waitForPrompt=False, rollbackChain=flagCopy, commitConfirm=DeadmanTestTimer, deadmanIp=deviceIp):
+            return None # The warp script itself only deletes any flag left by an earlier self-test
+        dc.session['cli'].close() # As the session is cut by a mgmt IP change
+        timingSleep(DeadmanTestTimer + DeadmanTestGrace, 'wait.deadman-test')
+        if not cliSessionReconnect(deviceIp):
+            return None
+        if sendCLI_configCommand(flagDelete, returnCliError=True): # Flag there, so the deadman fired
+            return True
+        sendCLI_configCommand(WarpRollbackUnstage[dc.family], returnCliError=True)
+        return False
+    finally: # Nothing was changed on the switch
+        del dc.rollbackStack[rollbackLength:]
+        dc.deadmanArmed = False
+        del dc.configHistory[configHistoryLength:]
+
 
 #
 # XMC GraphQl NBI functions
 #
 from java.util import LinkedHashMap # Used by nbiQuery
-LastNbiError = None
+NbiRoundTrips = 0 # Number of queries actually sent to emc_nbi
+NbiBatchSize = 100 # Max number of aliased fields merged in one query or mutation
+import collections                  # Used by nbiCache functions & resultOutcome
+NbiCache = collections.OrderedDict() # Rendered query: (expiry time, response); least recently used first
+NbiCacheSize = 1000 # Max number of cached responses
+NbiCacheLock = threading.Lock()
+NbiCacheStats = {'hits': 0, 'misses': 0, 'invalidations': 0}
+NbiRoundTripsLock = threading.Lock()
+
+def nbiSend(jsonQuery): # v1 - Sends a query to emc_nbi, keeping count of round-trips; used by all nbi functions
+    global NbiRoundTrips
+    with NbiRoundTripsLock:
+        NbiRoundTrips += 1
+    return emc_nbi.query(jsonQuery)
+
+def nbiCacheGet(jsonQueryDict, jsonQuery): # v1 - Returns cached response of a read-only query (NBI_Query entry with a 'ttl'), or None
+    if 'ttl' not in jsonQueryDict:
+        return None
+    with NbiCacheLock:
+        entry = NbiCache.pop(jsonQuery, None)
+        if entry and entry[0] > time.time():
+            NbiCache[jsonQuery] = entry # Now most recently used
+            NbiCacheStats['hits'] += 1
+            return entry[1]
+        NbiCacheStats['misses'] += 1
+        return None
+
+def nbiCachePut(jsonQueryDict, jsonQuery, response): # v1 - Caches the response of a read-only query for its 'ttl' secs; least recently used ones are evicted
+    if 'ttl' not in jsonQueryDict or 'errors' in response:
+        return
+    with NbiCacheLock:
+        NbiCache.pop(jsonQuery, None)
+        NbiCache[jsonQuery] = (time.time() + jsonQueryDict['ttl'], response)
+        while len(NbiCache) > NbiCacheSize:
+            NbiCache.popitem(last=False)
+
+def nbiCacheInvalidate(jsonQueryDict, kwargs): # v1 - Drops the cached responses of the NBI_Query names listed in a mutation's 'invalidates', for the same kwargs
+    for name in jsonQueryDict.get('invalidates', []):
+        jsonQuery = nbiQueryRender(NBI_Query[name], kwargs)
+        with NbiCacheLock:
+            if NbiCache.pop(jsonQuery, None):
+                NbiCacheStats['invalidations'] += 1
+
+def compileNbiQuery(nbiQueryDict): # v1 - Pre-splits NBI_Query json templates on their <PLACEHOLDER> tags, for nbiQueryRender()
+    for jsonQueryDict in nbiQueryDict.values():
+        jsonQueryDict['template'] = re.split(r'<(\w+)>', jsonQueryDict['json']) # [literal, name, literal, name, ..., literal]
+
+def nbiQueryRender(jsonQueryDict, kwargs): # v1 - Returns the json query with <PLACEHOLDER> tags replaced by kwargs values
+    if 'template' not in jsonQueryDict: # Not compiled with compileNbiQuery()
+        jsonQuery = jsonQueryDict['json']
+        for key in kwargs:
+            jsonQuery = jsonQuery.replace('<'+key+'>', kwargs[key])
+        return jsonQuery
+    template = jsonQueryDict['template']
+    parts = template[:]
+    for index in range(1, len(template), 2):
+        parts[index] = kwargs[template[index]] if template[index] in kwargs else '<' + template[index] + '>'
+    return ''.join(parts)
 
 def recursionKeySearch(nestedDict, returnKey): # v1 - Used by both nbiQuery() and nbiMutation()
     for key, value in nestedDict.iteritems():
@@ -582,20 +1472,22 @@ def recursionKeySearch(nestedDict, returnKey): # v1 - Used by both nbiQuery() an
                 return True, foundValue
         return [None, None] # If we find nothing
 
-def nbiQuery(jsonQueryDict, debugKey=None, returnKeyError=False, **kwargs): # v4 - Makes a GraphQl query of XMC NBI; if returnKey provided returns that key value, else return whole response
-    global LastNbiError
-    jsonQuery = jsonQueryDict['json']
-    for key in kwargs:
-        jsonQuery = jsonQuery.replace('<'+key+'>', kwargs[key])
+def nbiQuery(jsonQueryDict, debugKey=None, returnKeyError=False, **kwargs): # v8 - Makes a GraphQl query of XMC NBI, or gets it from cache; if returnKey provided returns that key value, else return whole response
+    dc = deviceContext()
+    jsonQuery = nbiQueryRender(jsonQueryDict, kwargs)
     returnKey = jsonQueryDict['key'] if 'key' in jsonQueryDict else None
-    response = emc_nbi.query(jsonQuery)
+    response = nbiCacheGet(jsonQueryDict, jsonQuery)
+    if response == None:
+        with timingSpan('nbi.query'):
+            response = nbiSend(jsonQuery)
+        nbiCachePut(jsonQueryDict, jsonQuery, response)
     debug("nbiQuery response = {}".format(response))
     if 'errors' in response: # Query response contains errors
-        if returnKeyError: # If we asked to return upon NBI error, then the error message will be held in LastNbiError
-            LastNbiError = response['errors'][0].message
+        if returnKeyError: # If we asked to return upon NBI error, then the error message will be held in context lastNbiError
+            dc.lastNbiError = response['errors'][0].message
             return None
         abortError("nbiQuery for\n{}".format(jsonQuery), response['errors'][0].message)
-    LastNbiError = None
+    dc.lastNbiError = None
 
     if returnKey: # If a specific key requested, we find it
         foundKey, returnValue = recursionKeySearch(response, returnKey)
@@ -615,22 +1507,22 @@ def nbiQuery(jsonQueryDict, debugKey=None, returnKeyError=False, **kwargs): # v4
         else: debug("nbiQuery response = {}".format(response))
     return response
 
-def nbiMutation(jsonQueryDict, returnKeyError=False, debugKey=None, **kwargs): # v4 - Makes a GraphQl mutation query of XMC NBI; returns true on success
-    global LastNbiError
-    jsonQuery = jsonQueryDict['json']
-    for key in kwargs:
-        jsonQuery = jsonQuery.replace('<'+key+'>', kwargs[key])
+def nbiMutation(jsonQueryDict, returnKeyError=False, debugKey=None, **kwargs): # v8 - Makes a GraphQl mutation query of XMC NBI; returns true on success
+    dc = deviceContext()
+    jsonQuery = nbiQueryRender(jsonQueryDict, kwargs)
     returnKey = jsonQueryDict['key'] if 'key' in jsonQueryDict else None
     if Sanity:
         print "SANITY - NBI Mutation:\n{}\n".format(jsonQuery)
-        LastNbiError = None
+        dc.lastNbiError = None
         return True
     print "NBI Mutation Query:\n{}\n".format(jsonQuery)
-    response = emc_nbi.query(jsonQuery)
+    with timingSpan('nbi.mutation'):
+        response = nbiSend(jsonQuery)
+    nbiCacheInvalidate(jsonQueryDict, kwargs)
     debug("nbiQuery response = {}".format(response))
     if 'errors' in response: # Query response contains errors
-        if returnKeyError: # If we asked to return upon NBI error, then the error message will be held in LastNbiError
-            LastNbiError = response['errors'][0].message
+        if returnKeyError: # If we asked to return upon NBI error, then the error message will be held in context lastNbiError
+            dc.lastNbiError = response['errors'][0].message
             return None
         abortError("nbiQuery for\n{}".format(jsonQuery), response['errors'][0].message)
 
@@ -656,7 +1548,7 @@ def nbiMutation(jsonQueryDict, returnKeyError=False, debugKey=None, **kwargs): #
         abortError("nbiMutation for\n{}".format(jsonQuery), 'Key "status" was not found in query response')
 
     if returnStatus == "SUCCESS":
-        LastNbiError = None
+        dc.lastNbiError = None
         if returnKey: # If a specific key requested, we find it
             foundKey, returnValue = recursionKeySearch(response, returnKey)
             if foundKey:
@@ -670,108 +1562,599 @@ def nbiMutation(jsonQueryDict, returnKeyError=False, debugKey=None, **kwargs): #
             abortError("nbiMutation for\n{}".format(jsonQuery), 'Key "{}" was not found in mutation response'.format(returnKey))
         return True
     else:
-        LastNbiError = returnMessage
+        dc.lastNbiError = returnMessage
         return False
 
+def nbiQuerySplit(jsonQuery): # v1 - Splits a single field GraphQl query into: root field, inner field name, inner field text
+    # '{ network { device(ip:"x") { id } } }' => ('network', 'device', 'device(ip:"x") { id }')
+    match = re.match(r'^\s*(?:mutation\s*)?\{\s*(\w+)\s*\{(.*)\}\s*\}\s*$', jsonQuery, re.DOTALL)
+    if not match:
+        return None
+    rootField, innerText = match.group(1), match.group(2).strip()
+    innerField = re.match(r'\w+', innerText).group(0)
+    return rootField, innerField, innerText
+
+def nbiBatchQuery(queryList, debugKey=None, returnKeyError=False): # v3 - Merges many NBI_Query templates into one aliased GraphQl query; returns dict of callerKey: value
+    # queryList = [(callerKey, NBI_Query[<name>], {'IP': ip, ...}), ...]; callerKeys are any unique strings chosen by caller
+    # Templates must hold a single field under their root field; each one gets aliased, so the same field can be queried for many IPs
+    # Returned values are the same that nbiQuery() would have returned for each template on its own; cached ones are not queried
+    dc = deviceContext()
+    rootOrder = []
+    rootFields = {}
+    aliasMap = {}
+    innerResponses = {}
+    for index, (callerKey, jsonQueryDict, kwargs) in enumerate(queryList):
+        jsonQuery = nbiQueryRender(jsonQueryDict, kwargs)
+        rootField, innerField, innerText = nbiQuerySplit(jsonQuery)
+        cachedResponse = nbiCacheGet(jsonQueryDict, jsonQuery)
+        if cachedResponse != None:
+            innerResponses[callerKey] = (cachedResponse[rootField], jsonQueryDict.get('key'))
+            continue
+        alias = 'q{}'.format(index)
+        if rootField not in rootFields:
+            rootOrder.append(rootField)
+            rootFields[rootField] = []
+        rootFields[rootField].append("{}: {}".format(alias, innerText))
+        aliasMap[callerKey] = (rootField, innerField, alias, jsonQueryDict, jsonQuery)
+    jsonQuery = "{\n" + "\n".join(["  {} {{\n    {}\n  }}".format(x, "\n    ".join(rootFields[x])) for x in rootOrder]) + "\n}"
+    if aliasMap:
+        debug("nbiBatchQuery query = {}".format(jsonQuery))
+        with timingSpan('nbi.batch'):
+            response = nbiSend(jsonQuery)
+        debug("nbiBatchQuery response = {}".format(response))
+        if 'errors' in response: # Query response contains errors
+            if returnKeyError: # If we asked to return upon NBI error, then the error message will be held in context lastNbiError
+                dc.lastNbiError = response['errors'][0].message
+                return None
+            abortError("nbiBatchQuery for\n{}".format(jsonQuery), response['errors'][0].message)
+        for callerKey, (rootField, innerField, alias, jsonQueryDict, singleQuery) in aliasMap.items():
+            innerResponse = {innerField: response[rootField][alias]} # Un-alias, so the key search behaves as with nbiQuery()
+            nbiCachePut(jsonQueryDict, singleQuery, {rootField: innerResponse}) # Same response as if queried on its own
+            innerResponses[callerKey] = (innerResponse, jsonQueryDict.get('key'))
+    dc.lastNbiError = None
+
+    returnDict = {}
+    for callerKey, (innerResponse, returnKey) in innerResponses.items():
+        if returnKey:
+            foundKey, returnValue = recursionKeySearch(innerResponse, returnKey)
+            if not foundKey and not returnKeyError:
+                abortError("nbiBatchQuery for\n{}".format(jsonQuery), 'Key "{}" was not found in query response'.format(returnKey))
+            returnDict[callerKey] = returnValue
+        else:
+            returnDict[callerKey] = innerResponse
+    if Debug:
+        if debugKey: debug("{} = {}".format(debugKey, returnDict))
+        else: debug("nbiBatchQuery = {}".format(returnDict))
+    return returnDict
+
+def nbiBatchMutation(mutationList, debugKey=None, batchSize=None): # v2 - Merges many NBI_Query mutation templates into aliased GraphQl mutations; returns dict of callerKey: (success, message)
+    # mutationList = [(callerKey, NBI_Query[<name>], {'IP': ip, ...}), ...]; callerKeys are any unique strings chosen by caller
+    # Sent as one mutation, or one per batchSize entries; a response with errors still holds the results of the mutations which went
+    # through, so every callerKey gets its own result; those without one failed with the NBI error, also held in context lastNbiError
+    dc = deviceContext()
+    batchSize = batchSize or NbiBatchSize
+    returnDict = {}
+    dc.lastNbiError = None
+    for start in range(0, len(mutationList), batchSize):
+        batchList = mutationList[start:start + batchSize]
+        rootOrder = []
+        rootFields = {}
+        aliasMap = {}
+        for index, (callerKey, jsonQueryDict, kwargs) in enumerate(batchList):
+            rootField, innerField, innerText = nbiQuerySplit(nbiQueryRender(jsonQueryDict, kwargs))
+            alias = 'm{}'.format(index)
+            if rootField not in rootFields:
+                rootOrder.append(rootField)
+                rootFields[rootField] = []
+            rootFields[rootField].append("{}: {}".format(alias, innerText))
+            aliasMap[callerKey] = (rootField, alias)
+        jsonQuery = "mutation {\n" + "\n".join(["  {} {{\n    {}\n  }}".format(x, "\n    ".join(rootFields[x])) for x in rootOrder]) + "\n}"
+        if Sanity:
+            print "SANITY - NBI Mutation:\n{}\n".format(jsonQuery)
+            returnDict.update((x, (True, None)) for x in aliasMap)
+            continue
+        print "NBI Mutation Query:\n{}\n".format(jsonQuery)
+        with timingSpan('nbi.mutation'):
+            response = nbiSend(jsonQuery)
+        for callerKey, jsonQueryDict, kwargs in batchList:
+            nbiCacheInvalidate(jsonQueryDict, kwargs)
+        debug("nbiBatchMutation response = {}".format(response))
+        errorMessage = None
+        if 'errors' in response: # Some or all of the mutations failed
+            errorMessage = dc.lastNbiError = response['errors'][0].message
+        for callerKey, (rootField, alias) in aliasMap.items():
+            result = (response.get(rootField) or {}).get(alias)
+            if result:
+                returnDict[callerKey] = (result.get('status') == "SUCCESS", result.get('message'))
+            else:
+                returnDict[callerKey] = (False, errorMessage)
+    if Debug:
+        if debugKey: debug("{} = {}".format(debugKey, returnDict))
+        else: debug("nbiBatchMutation = {}".format(returnDict))
+    return returnDict
+
+
+#
+# NAC location group functions (requires NBI functions)
+#
+NacLocationIndex = {} # IP: list of NAC LOCATION groups holding that IP as entry
+NacLocationIndexLock = threading.Lock()
+NacLocationIndexBuilt = [False]
+
+def nacLocationGroupIndex(refresh=False): # v1 - Returns dict of IP: [LOCATION groups]; built once for all devices, with batched NBI queries
+    # Returns None if the index could not be built, with error held in context lastNbiError
+    with NacLocationIndexLock:
+        if NacLocationIndexBuilt[0] and not refresh:
+            return NacLocationIndex
+        groupList = nbiQuery(NBI_Query['getNacLocationGroups'], returnKeyError=True)
+        if groupList == None:
+            return None
+        index = {}
+        for start in range(0, len(groupList), NbiBatchSize):
+            batchList = groupList[start:start + NbiBatchSize]
+            valuesDict = nbiBatchQuery([(x, NBI_Query['getNacGroupValues'], {'LOCATIONGROUP': x}) for x in batchList], returnKeyError=True)
+            if valuesDict == None:
+                return None
+            for group in batchList:
+                for value in valuesDict[group] or []:
+                    index.setdefault(value, []).append(group)
+        NacLocationIndex.clear()
+        NacLocationIndex.update(index)
+        NacLocationIndexBuilt[0] = True
+        debug("nacLocationGroupIndex = {} IPs over {} groups".format(len(index), len(groupList)))
+        return NacLocationIndex
+
+def nacLocationGroups(ip): # v1 - Returns list of NAC LOCATION groups holding the IP, or None if that could not be determined
+    index = nacLocationGroupIndex()
+    if index == None:
+        return None
+    with NacLocationIndexLock:
+        return list(index.get(ip, []))
+
+def nacLocationGroupsRemove(ip, groupList): # v2 - Removes IP from all NAC LOCATION groups in list, with batched mutations; returns (groups it was removed from, dict of group: error)
+    # A group where the removal failed is only in error if it still holds the IP; so when all groups are tried, those which never held it are fine
+    if not groupList:
+        return [], {}
+    resultDict = nbiBatchMutation([(x, NBI_Query['accessControlRemoveSwitchFromLocation'], {'LOCATIONGROUP': x, 'IP': ip}) for x in groupList])
+    removedList = [x for x in groupList if resultDict[x][0]]
+    failedList = [x for x in groupList if not resultDict[x][0]]
+    errorDict = {}
+    for start in range(0, len(failedList), NbiBatchSize): # Check which of the failed groups still hold the IP
+        batchList = failedList[start:start + NbiBatchSize]
+        valuesDict = nbiBatchQuery([(x, NBI_Query['getNacGroupValues'], {'LOCATIONGROUP': x}) for x in batchList], returnKeyError=True)
+        for group in batchList:
+            if valuesDict == None:
+                errorDict[group] = "{}; unable to check group: {}".format(resultDict[group][1], deviceContext().lastNbiError)
+            elif ip in (valuesDict[group] or []):
+                errorDict[group] = resultDict[group][1] or "removal failed"
+    with NacLocationIndexLock:
+        if ip in NacLocationIndex:
+            NacLocationIndex[ip] = [x for x in NacLocationIndex[ip] if x not in removedList]
+    return removedList, errorDict
+
 
 #
 # IP address processing functions
 #
 
-def ipToNumber(dottedDecimalStr): # v1 - Method to convert an IP/Mask dotted decimal address into a long number; can also use for checking validity of IP addresses
-    try: # bytearray ensures that IP bytes are valid (1-255)
-        ipByte = list(bytearray([int(byte) for byte in dottedDecimalStr.split('.')]))
-    except:
+import array                        # Used by IPv4 toolkit functions
+import bisect                       # Used by IPv4 toolkit functions
+MaskNumbers = [(2**32-1) ^ (2**(32-x)-1) for x in range(33)] # Cidr length: mask number
+MaskCidrs = dict((y, x) for x, y in enumerate(MaskNumbers))   # Mask number: Cidr length (valid masks only)
+
+def ipParse(dottedDecimalStr): # v1 - Fast conversion of dotted decimal IP into a number; None if invalid
+    try:
+        a, b, c, d = [int(byte) for byte in dottedDecimalStr.split('.')]
+    except (ValueError, AttributeError):
         return None
-    if len(ipByte) != 4:
+    if a >> 8 or b >> 8 or c >> 8 or d >> 8 or min(a, b, c, d) < 0:
         return None
-    debug("ipByte = {}".format(ipByte))
-    ipNumber = (ipByte[0]<<24) + (ipByte[1]<<16) + (ipByte[2]<<8) + ipByte[3]
-    debug("dottedDecimalStr {} = ipNumber {}".format(dottedDecimalStr, hex(ipNumber)))
-    return ipNumber
-
-def numberToIp(ipNumber): # v1 - Method to convert a long number into an IP/Mask dotted decimal address
-    dottedDecimalStr = '.'.join( [ str(ipNumber >> (i<<3) & 0xFF) for i in range(4)[::-1] ] )
-    debug("ipNumber {} = dottedDecimalStr {}".format(hex(ipNumber), dottedDecimalStr))
-    return dottedDecimalStr
-
-def maskToNumber(mask): # v1 - Method to convert a mask (dotted decimal or Cidr number) into a long number
-    if isinstance(mask, int) or re.match(r'^\d+$', mask): # Mask as number
-        if int(mask) > 0 and int(mask) <= 32:
-            maskNumber = (2**32-1) ^ (2**(32-int(mask))-1)
-        else:
-            maskNumber = None
-    else:
-        maskNumber = ipToNumber(mask)
-    if maskNumber:
-        debug("maskNumber = {}".format(hex(maskNumber)))
-    return maskNumber
+    return (a << 24) | (b << 16) | (c << 8) | d
 
-def subnetMask(ip, mask): # v1 - Return the IP subnet and Mask in dotted decimal and cidr formats for the provided IP address and mask
-    ipNumber = ipToNumber(ip)
+def prefixParse(prefix, mask=None): # v1 - Converts 'ip/len' (or ip and mask, dotted or cidr) into (first, last) IP numbers of the subnet; None if invalid
+    if mask == None:
+        if '/' not in prefix:
+            return None
+        prefix, mask = prefix.split('/', 1)
+    ipNumber = ipParse(prefix)
+    maskNumber = maskToNumber(mask)
+    if ipNumber == None or maskNumber == None:
+        return None
+    first = ipNumber & maskNumber
+    return first, first | (~maskNumber & 0xFFFFFFFF)
+
+def ipArray(ipList): # v1 - Returns sorted array of IP numbers, from list of dotted decimal IPs (invalid ones skipped)
+    return array.array('L', sorted(x for x in (ipParse(y) for y in ipList) if x != None))
+
+class SubnetIndex(object): # v1 - Sorted interval index of many subnets; finds which (most specific) subnet an IP falls in, with a binary search
+    def __init__(self, prefixList):
+        # prefixList = list of 'ip/len' strings, or (ip, mask) tuples; invalid ones are skipped
+        entries = []
+        for prefix in prefixList:
+            interval = prefixParse(*prefix) if isinstance(prefix, tuple) else prefixParse(prefix)
+            if interval:
+                entries.append((interval[0], -interval[1], prefix)) # Same start: larger subnet first, so it encloses the smaller
+        entries.sort()
+        self.starts = array.array('L', [x[0] for x in entries])
+        self.ends = array.array('L', [-x[1] for x in entries])
+        self.prefixes = [x[2] for x in entries]
+        self.parents = array.array('l', [-1] * len(entries)) # Index of the enclosing subnet, or -1
+        stack = []
+        for index in range(len(entries)):
+            while stack and self.ends[stack[-1]] < self.starts[index]:
+                stack.pop()
+            if stack:
+                self.parents[index] = stack[-1]
+            stack.append(index)
+
+    def __len__(self):
+        return len(self.prefixes)
+
+    def lookupNumber(self, ipNumber): # Returns index of most specific subnet holding IP number, or -1
+        index = bisect.bisect_right(self.starts, ipNumber) - 1
+        while index >= 0 and self.ends[index] < ipNumber:
+            index = self.parents[index]
+        return index
+
+    def lookup(self, ip): # Returns the most specific subnet (as given) holding the IP, or None
+        ipNumber = ipParse(ip)
+        index = self.lookupNumber(ipNumber) if ipNumber != None else -1
+        return self.prefixes[index] if index >= 0 else None
+
+    def lookupMany(self, ipList): # Returns list of most specific subnets (or None) for the list of IPs
+        return [self.lookup(x) for x in ipList]
+
+def subnetContains(prefixList, ipList): # v1 - Many-to-many containment; returns dict of prefix: list of IPs of ipList inside it
+    ipNumbers = ipArray(ipList)
+    containDict = {}
+    for prefix in prefixList:
+        interval = prefixParse(*prefix) if isinstance(prefix, tuple) else prefixParse(prefix)
+        if not interval:
+            continue
+        lo = bisect.bisect_left(ipNumbers, interval[0])
+        hi = bisect.bisect_right(ipNumbers, interval[1])
+        containDict[prefix] = [numberToIp(x) for x in ipNumbers[lo:hi]]
+    return containDict
+
+def subnetOverlaps(prefixList): # v1 - Returns list of (prefix, prefix) pairs of subnets which overlap (identical subnets included)
+    entries = []
+    for prefix in prefixList:
+        interval = prefixParse(*prefix) if isinstance(prefix, tuple) else prefixParse(prefix)
+        if interval:
+            entries.append((interval[0], interval[1], prefix))
+    entries.sort()
+    overlapList = []
+    active = [] # Entries whose end is not yet passed
+    for start, end, prefix in entries:
+        active = [x for x in active if x[1] >= start]
+        overlapList.extend((x[2], prefix) for x in active)
+        active.append((start, end, prefix))
+    return overlapList
+
+def ipToNumber(dottedDecimalStr): # v2 - Method to convert an IP/Mask dotted decimal address into a long number; can also use for checking validity of IP addresses
+    return ipParse(dottedDecimalStr)
+
+def numberToIp(ipNumber): # v2 - Method to convert a long number into an IP/Mask dotted decimal address
+    return "{}.{}.{}.{}".format(ipNumber >> 24 & 0xFF, ipNumber >> 16 & 0xFF, ipNumber >> 8 & 0xFF, ipNumber & 0xFF)
+
+def maskToNumber(mask): # v2 - Method to convert a mask (dotted decimal or Cidr number) into a long number
+    if isinstance(mask, (int, long)) or mask.isdigit(): # Mask as number
+        return MaskNumbers[int(mask)] if 0 < int(mask) <= 32 else None
+    return ipParse(mask)
+
+def subnetMask(ip, mask): # v2 - Return the IP subnet and Mask in dotted decimal and cidr formats for the provided IP address and mask
     maskNumber = maskToNumber(mask)
-    subnetNumber = ipNumber & maskNumber
-    ipSubnet = numberToIp(subnetNumber)
-    ipDottedMask = numberToIp(maskNumber)
-    ipCidrMask = bin(maskNumber).count('1')
-    debug("ipSubnet = {} / ipDottedMask = {} / ipCidrMask = {}".format(ipSubnet, ipDottedMask, ipCidrMask))
-    return ipSubnet, ipDottedMask, ipCidrMask
+    ipCidrMask = MaskCidrs[maskNumber] if maskNumber in MaskCidrs else bin(maskNumber).count('1')
+    return numberToIp(ipParse(ip) & maskNumber), numberToIp(maskNumber), ipCidrMask
 
 
 #
 # Save Config functions (requires CLI functions)
 #
 import time                         # Used by vossSaveConfigRetry & vossWaitNoUsersConnected
+import random                       # Used by vossSaveConfigRetry
+SaveBackoffMax = 60      # Max secs to back off between save config retries; backoff doubles from waitTime on each retry, with jitter
+SaveUsersPoll = 2        # Secs between "show users" polls, while waiting for other CLI sessions to disconnect
+SaveSiteConcurrency = 4  # Max devices of the same XMC site saving config at the same time; None for no limit
+SaveSiteSlots = {}       # Site path: semaphore limiting concurrent saves on that site
+SaveSiteLock = threading.Lock()
+
+@contextmanager
+def saveSiteSlot(site): # v1 - Holds one of the SaveSiteConcurrency save slots of a site for the duration of the with block
+    if not site or not SaveSiteConcurrency:
+        yield
+        return
+    with SaveSiteLock:
+        if site not in SaveSiteSlots:
+            SaveSiteSlots[site] = threading.BoundedSemaphore(SaveSiteConcurrency)
+        slot = SaveSiteSlots[site]
+    with timingSpan('wait.save-slot'):
+        slot.acquire()
+    try:
+        yield
+    finally:
+        slot.release()
 
-def vossSaveConfigRetry(waitTime=10, retries=3, returnCliError=False): # v2 - On VOSS a save config can fail, if another CLI session is doing "show run", so we need to be able to backoff and retry
+def vossWaitNoUsersConnected(timeout, pollInterval=SaveUsersPoll): # v2 - Waits until no other CLI session is connected to the switch; returns secs waited (0 if none was), or None on timeout
+    # Another session doing "show run" or "save config" (like an NMS config backup) is what makes a VOSS save config fail
     # Only supported for family = 'VSP Series'
-    global LastError
+    cmd = 'list://show users||^((?:Telnet|SSH)\d+) +(\S+) +\S+ +(\S+)(?!.*\(current\))' # Our own session is flagged (current)
+    startTime = time.time()
+    polls = 0
+    while True:
+        userList = sendCLI_showRegex(cmd, returnCliError=True, memo=False)
+        polls += 1
+        if not userList:
+            return time.time() - startTime if polls > 1 else 0
+        remaining = startTime + timeout - time.time()
+        if remaining <= 0:
+            return None
+        print "==> Waiting for other CLI session(s) to disconnect: {}".format(", ".join("{} {}@{}".format(*x) for x in userList))
+        timingSleep(min(pollInterval, remaining), 'wait.sessions')
+
+@timed('save')
+def vossSaveConfigRetry(waitTime=10, retries=3, returnCliError=False, site=None): # v5 - On VOSS a save config can fail, if another CLI session is doing "show run", so we need to be able to backoff and retry
+    # Only supported for family = 'VSP Series'
+    # On failure, waits for any other CLI session to disconnect; if there is none, backs off with a jittered exponential delay
+    # With site set, no more than SaveSiteConcurrency devices of that site save at the same time
+    dc = deviceContext()
     cmd = 'save config'
     if Sanity:
         print "SANITY> {}".format(cmd)
-        ConfigHistory.append(cmd)
-        LastError = None
+        dc.configHistory.append(cmd)
+        dc.lastError = None
         return True
 
-    retryCount = 0
-    while retryCount <= retries:
-        resultObj = emc_cli.send(cmd, True)
-        if resultObj.isSuccess():
-            outputStr = cleanOutput(resultObj.getOutput())
-            if outputStr and re.search(r'Save config to file \S+ successful', outputStr): # Check for message indicating successful save
-                ConfigHistory.append(cmd)
-                LastError = None
-                return True
-            # If we get here, then the save did not happen, possibly because: "Another show or save in progress.  Please try the command later."
-            retryCount += 1
-            if retries > 0:
-                print "==> Save config did not happen. Waiting {} seconds before retry...".format(waitTime)
-                time.sleep(waitTime)
-                print "==> Retry {}\n".format(retryCount)
-        else:
-            exitError(resultObj.getError())
-
-    if returnCliError: # If we asked to return upon CLI error, then the error message will be held in LastError
-        LastError = outputStr
+    with saveSiteSlot(site):
+        retryCount = 0
+        while retryCount <= retries:
+            resultObj = dc.cli.send(cmd, True)
+            if resultObj.isSuccess():
+                outputStr = cleanOutput(resultObj.getOutput())
+                if outputStr and re.search(r'Save config to file \S+ successful', outputStr): # Check for message indicating successful save
+                    dc.configHistory.append(cmd)
+                    dc.lastError = None
+                    return True
+                # If we get here, then the save did not happen, possibly because: "Another show or save in progress.  Please try the command later."
+                retryCount += 1
+                if retryCount <= retries:
+                    backoff = min(waitTime * 2 ** (retryCount - 1), SaveBackoffMax)
+                    print "==> Save config did not happen. Waiting up to {} seconds before retry...".format(backoff)
+                    waited = vossWaitNoUsersConnected(backoff)
+                    if waited == None:
+                        print "==> Other CLI session(s) still connected"
+                    elif waited:
+                        timingSleep(random.uniform(0, SaveUsersPoll)) # Other sessions retrying just now as well, so spread out
+                    else: # No session to wait for, so wait blindly; jitter keeps devices from retrying in lockstep
+                        timingSleep(random.uniform(backoff / 2.0, backoff))
+                    print "==> Retry {}\n".format(retryCount)
+            else:
+                exitError(resultObj.getError())
+
+    if returnCliError: # If we asked to return upon CLI error, then the error message will be held in context lastError
+        dc.lastError = outputStr
         return False
     exitError(outputStr)
 
-
 #
 # Syslog functions
 #
-import socket                       # Used by addXmcSyslogEvent
-
-def addXmcSyslogEvent(severity, message, ip=None): # v1 - Adds a syslog event to XMC (only needed for Scripts)
-    severityHash = {'emerg': 0, 'alert': 1, 'crit': 2, 'err': 3, 'warning': 4, 'notice': 5, 'info': 6, 'debug': 7}
-    severityLevel = severityHash[severity] if severity in severityHash else 6
-    session = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, 0)
-    session.connect(('127.0.0.1', 514))
-    if ip:
-        session.send("<{}> XMC Script {} / Device: {} / {}".format(severityLevel,scriptName(),ip,message))
+import socket                       # Used by syslogSenderRun
+import Queue                        # Used by addXmcSyslogEvent & syslogSenderRun
+SyslogServer = ('127.0.0.1', 514) # Where events are sent; XMC's own syslog receiver
+SyslogQueueSize = 10000           # Max events waiting to be sent; beyond that, events are dropped rather than delaying the device runs
+SyslogJsonFile = None             # If set, every event is also appended to this file as a JSON line
+SyslogSdId = 'xmcScript@1916'     # RFC 5424 structured data ID, under Extreme Networks' enterprise number
+SyslogQueue = Queue.Queue(SyslogQueueSize)
+SyslogStats = {'sent': 0, 'dropped': 0, 'errors': 0}
+SyslogLock = threading.Lock()
+SyslogSender = [None] # Sender thread, once started
+
+def syslogFormat(event): # v1 - Returns an event as an RFC 5424 syslog message, with device, phase, duration & outcome as structured data
+    sdParams = "".join(' {}="{}"'.format(x, re.sub(r'(["\\\]])', r'\\\1', str(event[x]))) for x in ('device', 'phase', 'duration', 'outcome') if event[x] != None)
+    if event['device']:
+        message = "XMC Script {} / Device: {} / {}".format(event['script'], event['device'], event['message'])
     else:
-        session.send("<{}> XMC Script {} / {}".format(severityLevel,scriptName(),ip,message))
-    session.close()
+        message = "XMC Script {} / {}".format(event['script'], event['message'])
+    return "<{}>1 {}.{:03d}Z {} {} - audit [{}{}] {}".format(
+        8 + event['severity'], # Facility user
+        time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(event['time'])), int(event['time'] * 1000) % 1000,
+        event['host'] or '-', re.sub(r'\s', '_', event['script'] or '-')[:48], SyslogSdId, sdParams, message)
+
+def syslogSenderRun(): # v1 - Drains the event queue over one long-lived UDP socket, and into the JSON lines file if set
+    session = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    jsonFile = open(SyslogJsonFile, 'a') if SyslogJsonFile else None
+    while True:
+        event = SyslogQueue.get()
+        try:
+            session.sendto(syslogFormat(event), SyslogServer)
+            if jsonFile:
+                jsonFile.write(json.dumps(event) + "\n")
+                jsonFile.flush()
+            SyslogStats['sent'] += 1
+        except Exception as e: # Never let one event stop the sender
+            SyslogStats['errors'] += 1
+            debug("syslogSenderRun error: {}".format(e))
+        finally:
+            SyslogQueue.task_done()
+
+def addXmcSyslogEvent(severity, message, ip=None, outcome='success', phase=None, duration=None): # v3 - Queues a syslog event to XMC; never blocks
+    # Phase & duration (secs into phase) default to those of calling thread's device
+    dc = deviceContext()
+    severityHash = {'emerg': 0, 'alert': 1, 'crit': 2, 'err': 3, 'warning': 4, 'notice': 5, 'info': 6, 'debug': 7}
+    now = time.time()
+    if phase == None:
+        phase = dc.phase
+        if duration == None and dc.phaseStart:
+            duration = round(now - dc.phaseStart, 3)
+    event = {
+        'time'    : now,
+        'severity': severityHash[severity] if severity in severityHash else 6,
+        'host'    : dc.vars["serverIP"],
+        'script'  : scriptName(),
+        'device'  : ip,
+        'phase'   : phase,
+        'duration': duration,
+        'outcome' : outcome,
+        'message' : message,
+    }
+    with SyslogLock:
+        if not SyslogSender[0]:
+            SyslogSender[0] = threading.Thread(target=syslogSenderRun, name="syslog-sender")
+            SyslogSender[0].daemon = True
+            SyslogSender[0].start()
+    try:
+        SyslogQueue.put_nowait(event)
+    except Queue.Full:
+        with SyslogLock: # Any device thread may be dropping an event at the same time
+            SyslogStats['dropped'] += 1
+
+def syslogFlush(timeout=5): # v1 - Waits up to timeout secs for queued events to be sent, as the sender thread dies with the script
+    deadline = time.time() + timeout
+    while SyslogQueue.unfinished_tasks and time.time() < deadline:
+        time.sleep(0.05)
+    if SyslogStats['dropped'] or SyslogQueue.unfinished_tasks:
+        print "Syslog: {} events dropped, {} not sent".format(SyslogStats['dropped'], SyslogQueue.unfinished_tasks)
+
+
+#
+# Reachability probe functions
+#
+import errno                        # Used by reachabilityProbe
+import os                           # Used by reachabilityProbe
+import select                       # Used by reachabilityProbe
+import socket                       # Used by icmpEchoSocket & reachabilityProbe
+import struct                       # Used by icmpEchoPacket & reachabilityProbe
+ProbeTcpPorts = [22, 23] # SSH & Telnet; a refused connection proves the IP is up just as well as an accepted one
+ProbeMaxSockets = 400    # Max TCP connects in flight at once; select() cannot handle file descriptors above FD_SETSIZE (1024)
+ProbeConnectTimeout = 3  # Secs after which a TCP connect in flight is dropped, freeing its socket for other IPs
+
+def icmpEchoPacket(ident, seq): # v1 - Returns an ICMP echo request packet
+    header = struct.pack('!BBHHH', 8, 0, 0, ident, seq)
+    payload = 'xmc-probe'
+    data = header + payload
+    if len(data) % 2:
+        data += '\x00'
+    checksum = sum(struct.unpack('!{}H'.format(len(data) // 2), data))
+    checksum = (checksum >> 16) + (checksum & 0xFFFF)
+    checksum = ~(checksum + (checksum >> 16)) & 0xFFFF
+    return struct.pack('!BBHHH', 8, 0, checksum, ident, seq) + payload
+
+def icmpEchoSocket(): # v1 - Returns a non-blocking ICMP socket, or None if not permitted (Jython, or no privileges and not in ping_group_range)
+    for sockType in (socket.SOCK_DGRAM, socket.SOCK_RAW): # Unprivileged ping socket first, then raw socket
+        try:
+            icmpSocket = socket.socket(socket.AF_INET, sockType, socket.IPPROTO_ICMP)
+            icmpSocket.setblocking(0)
+            return icmpSocket
+        except Exception: # Includes AttributeError on Jython, which has no IPPROTO_ICMP
+            pass
+    debug("icmpEchoSocket() no ICMP socket available; will only use TCP connect")
+    return None
+
+@timed('wait.probe')
+def reachabilityProbe(ipList, deadline=10, interval=0.25, maxInterval=2, tcpPorts=ProbeTcpPorts): # v2 - Probes many IPs at once; returns dict of IP: latency in secs, or None if no reply within deadline
+    # Each round sends an ICMP echo to every IP still pending and opens a TCP connect to the SSH/Telnet ports where none is in flight
+    # Rounds are spaced with exponential backoff (interval doubling up to maxInterval); replies are handled as they arrive,
+    # and we return as soon as every IP has replied
+    # At most ProbeMaxSockets connects are in flight, so that select() works with any number of IPs; connects older than
+    # ProbeConnectTimeout are dropped, and IPs probed least recently get the free sockets first
+    # Echo replies only count if their ident & sequence number are those of an echo we sent to that IP
+    startTime = time.time()
+    endTime = startTime + deadline
+    latency = dict((ip, None) for ip in ipList)
+    pending = set(ipList)
+    icmpSocket = icmpEchoSocket()
+    icmpIdent = os.getpid() & 0xFFFF
+    icmpKernelIdent = icmpSocket and icmpSocket.type == socket.SOCK_DGRAM # Ping socket; kernel sets ident and only passes us our replies
+    icmpSeq = 0
+    icmpSent = {}   # IP: {sequence number: time echo was sent}
+    tcpSockets = {} # socket: (IP, port, time connect was started)
+    tcpTried = {}   # IP: time of last round it got TCP connects
+    nextRound = startTime
+
+    def gotReply(ip, seconds):
+        if ip in pending:
+            pending.discard(ip)
+            latency[ip] = seconds
+            debug("reachabilityProbe() reply from {} in {:.3f} secs".format(ip, seconds))
+            for tcpSocket, (tcpIp, _, _) in tcpSockets.items(): # No longer need any other connects to this IP
+                if tcpIp == ip:
+                    del tcpSockets[tcpSocket]
+                    tcpSocket.close()
+
+    while pending:
+        now = time.time()
+        if now >= endTime:
+            break
+        if now >= nextRound:
+            icmpSeq = (icmpSeq + 1) & 0xFFFF
+            for tcpSocket, (_, _, connectTime) in tcpSockets.items():
+                if now - connectTime > ProbeConnectTimeout:
+                    del tcpSockets[tcpSocket]
+                    tcpSocket.close()
+            inFlight = set((ip, port) for ip, port, _ in tcpSockets.values())
+            for ip in sorted(pending, key=lambda x: tcpTried.get(x, 0)):
+                if icmpSocket:
+                    try:
+                        icmpSocket.sendto(icmpEchoPacket(icmpIdent, icmpSeq), (ip, 0))
+                        icmpSent.setdefault(ip, {})[icmpSeq] = now
+                    except socket.error:
+                        pass
+                for port in tcpPorts:
+                    if (ip, port) in inFlight:
+                        continue
+                    if len(tcpSockets) >= ProbeMaxSockets: # Next round then
+                        break
+                    tcpTried[ip] = now
+                    tcpSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                    tcpSocket.setblocking(0)
+                    result = tcpSocket.connect_ex((ip, port))
+                    if result in (0, errno.ECONNREFUSED):
+                        tcpSocket.close()
+                        gotReply(ip, time.time() - now)
+                        break
+                    elif result in (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY):
+                        tcpSockets[tcpSocket] = (ip, port, now)
+                    else: # Unreachable for now; retry on next round
+                        tcpSocket.close()
+            nextRound = now + interval
+            interval = min(interval * 2, maxInterval)
+            continue
+        readList = [icmpSocket] if icmpSocket else []
+        writeList = list(tcpSockets)
+        waitTime = max(min(nextRound, endTime) - time.time(), 0)
+        if not readList and not writeList:
+            time.sleep(waitTime)
+            continue
+        readable, writable, _ = select.select(readList, writeList, [], waitTime)
+        now = time.time()
+        if readable:
+            while True:
+                try:
+                    data, address = icmpSocket.recvfrom(1024)
+                except socket.error:
+                    break
+                if data and ord(data[0]) >> 4 == 4: # Raw socket; skip the IP header
+                    data = data[(ord(data[0]) & 0x0F) * 4:]
+                if len(data) < 8 or address[0] not in icmpSent:
+                    continue
+                icmpType, _, _, ident, seq = struct.unpack('!BBHHH', data[:8])
+                if icmpType == 0 and (icmpKernelIdent or ident == icmpIdent) and seq in icmpSent[address[0]]: # Reply to our echo
+                    gotReply(address[0], now - icmpSent[address[0]][seq])
+        for tcpSocket in writable:
+            if tcpSocket not in tcpSockets: # Already closed by gotReply()
+                continue
+            ip, port, connectTime = tcpSockets.pop(tcpSocket)
+            result = tcpSocket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            tcpSocket.close()
+            if result in (0, errno.ECONNREFUSED):
+                gotReply(ip, now - connectTime)
+
+    for tcpSocket in tcpSockets:
+        tcpSocket.close()
+    if icmpSocket:
+        icmpSocket.close()
+    return latency
 
 
 #
@@ -793,7 +2176,562 @@ except:
     pass
 
 
-# --> Insert Ludo Threads library here if required <--
+#
+# Result collector functions (requires Device context & Syslog functions)
+#
+ResultsFile = None # If set, the outcomes of all devices are written to this file as JSON once the run is done
+
+def resultOutcome(deviceIp, error, elapsed): # v1 - Returns the structured outcome of calling thread's device run
+    dc = deviceContext()
+    return {
+        'deviceIP': deviceIp,
+        'status'  : 'ERROR' if error else 'SUCCESS',
+        'phase'   : dc.phase,              # Phase which failed, or last phase run
+        'message' : error,
+        'elapsed' : elapsed,
+        'timings' : collections.OrderedDict(dc.phaseTimes), # Secs taken by each completed phase
+    }
+
+def resultsCompose(results): # v1 - Returns the error message for the outcomes of all devices, or None if all succeeded; independent of completion order
+    failed = sorted([x for x in results if x['status'] != 'SUCCESS'], key=lambda x: x['deviceIP'])
+    if not failed:
+        return None
+    if len(results) == 1:
+        return failed[0]['message']
+    return "{} of {} devices failed: {}".format(len(failed), len(results), "; ".join(
+        "{} ({}): {}".format(x['deviceIP'], x['phase'], x['message']) if x['phase'] else "{}: {}".format(x['deviceIP'], x['message']) for x in failed))
+
+def resultsPublish(results): # v3 - Sets script status and workflow messages from the outcomes of all devices, once all are done; audits each outcome
+    # Devices run by the same script instance no longer need to race to complete last in order to own the workflow message
+    if ResultsFile:
+        with open(ResultsFile, 'w') as f:
+            json.dump(sorted(results, key=lambda x: x['deviceIP']), f, indent=2)
+    for result in results: # One audit event per device outcome
+        addXmcSyslogEvent('info' if result['status'] == 'SUCCESS' else 'err', result['message'] or "Completed", result['deviceIP'],
+                          outcome=result['status'].lower(), phase=result['phase'] or '-', duration=round(result['elapsed'], 3))
+    syslogFlush()
+    errorOutput = resultsCompose(results)
+    if not errorOutput:
+        return
+    if 'workflowMessage' in emc_vars: # Workflow
+        if execution == 'xmc' and len(EmcVarsList) == 1: # XMC runs a separate script instance per device, which this collector cannot see
+            timingSleep(ExitErrorSleep, 'wait.exit-error') # So want ones that error to be last to complete, so THEY set the workflow message
+        emc_results.put("deviceMessage", errorOutput)
+        emc_results.put("activityMessage", errorOutput)
+        emc_results.put("workflowMessage", errorOutput)
+    emc_results.setStatus(emc_results.Status.ERROR)
+
+
+#
+# Threads functions (requires Result collector functions)
+#
+import Queue                        # Used by threadPoolRun
+MaxThreads = 100 # Upper bound on the number of devices worked on concurrently
+CliSessionFactory = None # Callable(deviceIp) returning an emc_cli like session; needed to run against devices other than the launching one (not provided by XMC)
+
+def newCliSession(deviceIp): # v1 - Returns the CLI session a pool worker should use for the given device
+    if deviceIp == emc_vars["deviceIP"]:
+        return emc_cli
+    if not CliSessionFactory:
+        exitError("No CLI session factory available to connect to device {}".format(deviceIp))
+    return CliSessionFactory(deviceIp)
+
+def threadWorker(deviceVars, func, sessionFactory): # v2 - Runs func() for one device in its own device context; returns its outcome
+    error = None
+    startTime = time.time()
+    try:
+        deviceContextInit(None, deviceVars, worker=True)
+        cliSessionAttach(sessionFactory(deviceVars["deviceIP"]), deviceVars["deviceIP"])
+        func()
+    except Exception as e: # exitError() raises RuntimeError, but we catch anything so that one device cannot take down the pool
+        error = str(e)
+    return resultOutcome(deviceVars["deviceIP"], error, time.time() - startTime)
+
+def threadPoolRun(deviceVarsList, func, maxThreads=MaxThreads, sessionFactory=newCliSession): # v5 - Runs func() against all devices with a bounded pool of worker threads
+    # With a single device func() runs in the main thread, exactly as if there was no pool
+    if len(deviceVarsList) == 1 and deviceVarsList[0] is emc_vars:
+        error = None
+        startTime = time.time()
+        try:
+            func()
+        except Exception as e:
+            error = str(e)
+            raise
+        finally:
+            journalCleanup()
+            inventorySave()
+            resultsPublish([resultOutcome(emc_vars["deviceIP"], error, time.time() - startTime)])
+            timingReport()
+        return
+    workQueue = Queue.Queue()
+    for deviceVars in deviceVarsList:
+        workQueue.put(deviceVars)
+    results = []
+    resultsLock = threading.Lock()
+
+    def worker():
+        while True:
+            try:
+                deviceVars = workQueue.get_nowait()
+            except Queue.Empty:
+                return
+            result = threadWorker(deviceVars, func, sessionFactory)
+            with resultsLock:
+                results.append(result)
+
+    threads = [threading.Thread(target=worker, name="worker-{}".format(x)) for x in range(min(maxThreads, len(deviceVarsList)))]
+    print "Running against {} devices with {} threads".format(len(deviceVarsList), len(threads))
+    warpStagingBatch() # Devices needing the same warp script all fetch the one file, deleted once all devices are done
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        warpStagingCleanup()
+        journalCleanup()
+        inventorySave()
+    threadPoolReport(results)
+    timingReport()
+    return results
+
+def threadPoolReport(results): # v3 - Prints one merged report of all device results and sets script status accordingly
+    print "\nResults for {} devices:".format(len(results))
+    for result in sorted(results, key=lambda x: x['deviceIP']):
+        print " - {:<16} {:<8} {:7.1f}s  {:<20} {}".format(result['deviceIP'], result['status'], result['elapsed'], result['phase'] or '', result['message'] or '')
+    failed = [x['deviceIP'] for x in results if x['status'] != 'SUCCESS']
+    if failed:
+        print "{} of {} devices failed: {}".format(len(failed), len(results), ", ".join(sorted(failed)))
+    else:
+        print "All {} devices completed successfully".format(len(results))
+    resultsPublish(results)
+    stats = discoveryStats()
+    if stats:
+        print "XMC discovery times for {} devices: p10 {:.0f}s, p50 {:.0f}s, p90 {:.0f}s, max {:.0f}s".format(stats['count'], stats['p10'], stats['p50'], stats['p90'], stats['max'])
+
+
+#
+# Discovery waiter functions (requires NBI & Threads functions)
+#
+DiscoveryTimeout = 105    # Max secs to wait for a device (re-)added to XMC to be discovered and come up
+DiscoveryMinInterval = 1  # Min secs between NBI polls
+DiscoveryMaxInterval = 10 # Max secs between NBI polls
+DiscoveryMinSamples = 3   # Observed discovery times needed before polling is tuned from them; until then exponential backoff is used
+DiscoveryPending = {} # IP: {'event': threading.Event, 'start': time added, 'elapsed': secs to come up or None, 'error': poller failure or None}
+DiscoveryTimes = []   # Observed secs for devices to come up in XMC after being added, across all devices of this run
+DiscoveryLock = threading.Lock()
+DiscoveryPoller = [None] # Poller thread, while one is running
+
+def discoveryStats(): # v1 - Returns dict of observed discovery time percentiles, or None if no devices were discovered yet
+    with DiscoveryLock:
+        times = sorted(DiscoveryTimes)
+    if not times:
+        return None
+    return {'count': len(times), 'p10': percentile(times, 10), 'p50': percentile(times, 50), 'p90': percentile(times, 90), 'max': times[-1]}
+
+def discoveryInterval(waited, tick): # v1 - Returns secs to sleep before the next poll, for a device added waited secs ago
+    with DiscoveryLock:
+        times = sorted(DiscoveryTimes)
+    if len(times) < DiscoveryMinSamples: # Not enough history; exponential backoff
+        return min(DiscoveryMinInterval * 2 ** tick, DiscoveryMaxInterval)
+    p10, p90 = percentile(times, 10), percentile(times, 90)
+    if waited < p10: # Devices hardly ever come up this early; sleep until they might
+        return min(max(p10 - waited, DiscoveryMinInterval), DiscoveryMaxInterval)
+    return min(max((p90 - p10) / 10.0, DiscoveryMinInterval), DiscoveryMaxInterval) # Poll finely over the window most devices come up in
+
+def discoveryPollerRun(): # v2 - Polls NBI for all pending IPs with one batched query per tick, and wakes each waiter as soon as its device is up
+    # Should polling fail, all waiters are woken with the error and the poller slot is freed, so that the next waiter starts a new poller
+    tick = 0
+    try:
+        while True:
+            with DiscoveryLock:
+                pending = dict((x, y) for x, y in DiscoveryPending.items() if not y['event'].is_set())
+                if not pending:
+                    DiscoveryPoller[0] = None
+                    return
+            now = time.time()
+            time.sleep(min([discoveryInterval(now - x['start'], tick) for x in pending.values()]))
+            tick += 1
+            ipList = sorted(pending.keys())
+            deviceDict = nbiBatchQuery([(x, NBI_Query['check_device'], {'IP': x}) for x in ipList], returnKeyError=True)
+            if deviceDict == None: # NBI error; try again next tick
+                debug("discoveryPollerRun NBI error: {}".format(deviceContext().lastNbiError))
+                continue
+            now = time.time()
+            with DiscoveryLock:
+                for ip in ipList:
+                    # We get back either "device": {"down": false} or null
+                    if deviceDict.get(ip) and not deviceDict[ip]['down']:
+                        pending[ip]['elapsed'] = now - pending[ip]['start']
+                        DiscoveryTimes.append(pending[ip]['elapsed'])
+                        pending[ip]['event'].set()
+    except Exception as e: # Waiters must not wait out their timeout on a poller which is gone
+        print "Discovery poller failed: {}".format(e)
+        with DiscoveryLock:
+            if DiscoveryPoller[0] is threading.current_thread():
+                DiscoveryPoller[0] = None
+            for waiter in DiscoveryPending.values():
+                if not waiter['event'].is_set():
+                    waiter['error'] = str(e)
+                    waiter['event'].set()
+
+@timed('wait.discovery')
+def discoveryWait(deviceIp, timeout=DiscoveryTimeout): # v2 - Waits for a device just added to XMC to come up; returns secs it took, or None on timeout
+    # All devices waiting at the same time share a single poller thread, making one NBI query per tick for all of them
+    with DiscoveryLock:
+        waiter = {'event': threading.Event(), 'start': time.time(), 'elapsed': None, 'error': None}
+        DiscoveryPending[deviceIp] = waiter
+        if not DiscoveryPoller[0]:
+            DiscoveryPoller[0] = threading.Thread(target=discoveryPollerRun, name="discovery-poller")
+            DiscoveryPoller[0].daemon = True
+            DiscoveryPoller[0].start()
+    waiter['event'].wait(timeout)
+    with DiscoveryLock:
+        if DiscoveryPending.get(deviceIp) is waiter:
+            del DiscoveryPending[deviceIp]
+        waiter['event'].set() # On timeout, so that the poller stops polling for it
+    if waiter['error']:
+        exitError("Unable to poll XMC for discovery of device {}: {}".format(deviceIp, waiter['error']))
+    return waiter['elapsed']
+
+
+#
+# Journal functions (requires Device context functions)
+#
+import hashlib                      # Used by journalInputs & journalBatch
+import glob                         # Used by journalLoad
+JournalDir = '/tmp' # Where the journal of device phase checkpoints is kept, so that an interrupted run can resume; None to disable
+JournalMaxAge = 86400 # Secs after which a journal record is deleted, rather than resumed
+JournalEntries = {} # Current IP: last checkpoint record of device; phase 'done' once completed
+JournalLock = threading.Lock()
+JournalLoaded = [False]
+JournalBatch = [None] # ID of the batch of devices this run is against
+
+def journalPath(deviceIp): # v2 - Returns the path of the journal file of a device; every device has its own file, which only holds its last record
+    return "{}/{}.{}.{}.journal".format(JournalDir, emc_vars["userName"], scriptName().replace(' ', '_'), deviceIp)
+
+def journalInputs(deviceVars): # v1 - Returns a hash of the user inputs of a device; a journal record is only resumed with the same inputs
+    inputList = sorted((x, deviceVars[x].strip()) for x in deviceVars if x.startswith('userInput_'))
+    return hashlib.md5(json.dumps(inputList)).hexdigest()[:16]
+
+def journalBatch(): # v1 - Returns the ID of the batch this run is against, a hash of its devices and their inputs; the same on a re-run
+    if not JournalBatch[0]:
+        batchList = sorted((x["deviceIP"], journalInputs(x)) for x in EmcVarsList)
+        JournalBatch[0] = hashlib.md5(json.dumps(batchList)).hexdigest()[:16]
+    return JournalBatch[0]
+
+def journalLoad(): # v2 - Reads the journal files once, deleting expired ones; must be called with JournalLock held
+    if JournalLoaded[0] or not JournalDir:
+        return
+    JournalLoaded[0] = True
+    for filePath in glob.glob(journalPath('*')):
+        try:
+            with open(filePath) as f:
+                record = json.load(f)
+        except (IOError, ValueError): # Deleted by another run in the meantime
+            continue
+        if record['time'] + JournalMaxAge < time.time():
+            debug("journalLoad - deleting expired journal record of device {}".format(record['deviceIP']))
+            journalDelete(record['deviceIP'])
+            continue
+        JournalEntries[record['deviceIP']] = record
+    interrupted = sorted(x for x in JournalEntries if JournalEntries[x]['phase'] != 'done')
+    if interrupted:
+        print "Journal in {} holds {} interrupted device(s): {}".format(JournalDir, len(interrupted), ", ".join(interrupted))
+
+def journalWrite(record): # v2 - Writes the record of a device to its journal file, atomically; must be called with JournalLock held
+    tmpPath = "{}.{}.tmp".format(journalPath(record['deviceIP']), os.getpid())
+    with open(tmpPath, 'w') as f: # Written to temp file first, so an interrupted run never leaves a partial file
+        json.dump(record, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmpPath, journalPath(record['deviceIP']))
+
+def journalDelete(deviceIp): # v1 - Deletes the journal file of a device, if still there; must be called with JournalLock held
+    try:
+        os.remove(journalPath(deviceIp))
+    except OSError: # Already deleted by another run
+        pass
+
+def journalEntry(deviceVars): # v2 - Returns the last checkpoint record of a device, looked up by current IP or new IP; None if not in journal
+    # Records of an earlier run with other inputs are ignored; a completed device is only skipped by a re-run of the same batch
+    if not JournalDir:
+        return None
+    with JournalLock:
+        journalLoad()
+        deviceIp = deviceVars["deviceIP"]
+        record = JournalEntries.get(deviceIp)
+        if not record:
+            record = ([x for x in JournalEntries.values() if x['state']['newIp'] == deviceIp] or [None])[0] # Launched on the new IP
+        if not record or record['inputs'] != journalInputs(deviceVars):
+            return None
+        if record['phase'] == 'done' and record['batch'] != journalBatch():
+            return None
+        return record
+
+def journalCheckpoint(phase, state): # v2 - Records that calling thread's device completed a phase, with the state later phases need
+    dc = deviceContext()
+    if Sanity or not JournalDir: # Nothing changed on the device, so nothing to resume
+        return
+    record = {'deviceIP': dc.vars["deviceIP"], 'phase': phase, 'state': state, 'time': time.time(),
+              'batch': journalBatch(), 'inputs': journalInputs(dc.vars)}
+    with JournalLock:
+        journalLoad()
+        JournalEntries[dc.vars["deviceIP"]] = record
+        journalWrite(record)
+
+def journalDone(): # v2 - Records that calling thread's device completed; should the run get interrupted, a re-run of the same batch skips it
+    dc = deviceContext()
+    if Sanity or not JournalDir:
+        return
+    with JournalLock:
+        journalLoad()
+        if dc.vars["deviceIP"] not in JournalEntries:
+            return
+        record = dict(JournalEntries[dc.vars["deviceIP"]], phase='done', time=time.time(), batch=journalBatch())
+        JournalEntries[dc.vars["deviceIP"]] = record
+        journalWrite(record)
+
+def journalClear(): # v2 - Drops calling thread's device from the journal, as if it was never run
+    dc = deviceContext()
+    if Sanity or not JournalDir:
+        return
+    with JournalLock:
+        journalLoad()
+        if JournalEntries.pop(dc.vars["deviceIP"], None) == None:
+            return
+        journalDelete(dc.vars["deviceIP"])
+
+def journalCleanup(): # v2 - Deletes the records of all devices done, at the end of a run; only interrupted devices are kept, to resume
+    with JournalLock:
+        if not JournalLoaded[0]:
+            return
+        for deviceIp in [x for x in JournalEntries if JournalEntries[x]['phase'] == 'done']:
+            del JournalEntries[deviceIp]
+            journalDelete(deviceIp)
+
+
+#
+# Inventory functions (requires Device context, CLI, NBI & Threads functions)
+#
+import Queue                        # Used by inventoryRefresh
+import errno                        # Used by fileLock
+from contextlib import contextmanager # Used by fileLock
+InventoryDir = '/tmp'   # Where device facts are kept across runs, so that runs can plan against them; None to disable
+InventoryMaxAge = 86400 # Secs after which device facts get read again, even if the probes show no change
+InventoryThreads = 10   # Max devices having their facts read at the same time
+InventoryRecords = {}   # Device IP: {'time': when facts were read, 'sysUpTime': secs up then, 'facts': {fact: value}}
+InventoryLock = threading.Lock()
+InventoryLoaded = [False]
+InventoryChanged = set() # IPs this run stored, updated or dropped facts of, since the inventory file was last saved
+InventoryLockTimeout = 10 # Max secs to wait for another run to release the inventory file lock
+InventoryLockStale = 60   # Secs after which a lock file is taken to be left by a run which got killed, and is broken
+RegexUptime = re.compile(r'(?:(\d+) days?,? *)?(\d+):(\d\d):(\d\d)')
+
+def inventoryPath(): # v1 - Returns the path of the inventory file
+    return "{}/{}.inventory.json".format(InventoryDir, emc_vars["userName"])
+
+@contextmanager
+def fileLock(path, timeout=InventoryLockTimeout, stale=InventoryLockStale): # v1 - Context manager holding an exclusive lock file next to path, across concurrent runs; raises RuntimeError on timeout
+    lockPath = path + '.lock'
+    deadline = time.time() + timeout
+    while True:
+        try:
+            lockFd = os.open(lockPath, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        try:
+            if time.time() - os.path.getmtime(lockPath) > stale:
+                os.remove(lockPath) # Left by a run which got killed
+                continue
+        except OSError: # Released in the meantime
+            continue
+        if time.time() > deadline:
+            raise RuntimeError("timed out waiting for lock file {}".format(lockPath))
+        time.sleep(0.05)
+    try:
+        yield
+    finally:
+        os.close(lockFd)
+        os.remove(lockPath)
+
+def inventoryRead(): # v1 - Returns the records in the inventory file; empty dict if none or unreadable
+    if not os.path.exists(inventoryPath()):
+        return {}
+    try:
+        with open(inventoryPath()) as f:
+            return json.load(f)
+    except (IOError, ValueError): # Facts will just be read again
+        print "Ignoring unreadable inventory file {}".format(inventoryPath())
+        return {}
+
+def inventoryLoad(): # v2 - Reads the inventory file once; must be called with InventoryLock held
+    if InventoryLoaded[0] or not InventoryDir:
+        return
+    InventoryLoaded[0] = True
+    InventoryRecords.update(inventoryRead())
+
+def inventorySave(): # v2 - Merges the facts this run changed into the inventory file, so that concurrent runs keep each other's facts
+    # The file is re-read and written under a lock file, and written to a temp file renamed into place, so it is never left partial
+    if not InventoryDir:
+        return
+    with InventoryLock:
+        if not InventoryChanged:
+            return
+        try:
+            with fileLock(inventoryPath()):
+                diskRecords = inventoryRead()
+                for deviceIp in InventoryChanged:
+                    if deviceIp in InventoryRecords:
+                        diskRecords[deviceIp] = InventoryRecords[deviceIp]
+                    else: # Dropped
+                        diskRecords.pop(deviceIp, None)
+                tmpPath = "{}.{}.tmp".format(inventoryPath(), os.getpid())
+                with open(tmpPath, 'w') as f:
+                    json.dump(diskRecords, f, indent=2, sort_keys=True)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.rename(tmpPath, inventoryPath())
+        except RuntimeError as e: # Facts will just be read again by the next run
+            print "Inventory not saved: {}".format(e)
+            return
+        InventoryChanged.clear()
+
+def inventoryFacts(deviceIp): # v1 - Returns the facts held for a device; empty dict if none
+    if not InventoryDir:
+        return {}
+    with InventoryLock:
+        inventoryLoad()
+        record = InventoryRecords.get(deviceIp)
+        return dict(record['facts']) if record else {}
+
+def inventoryStore(deviceIp, facts, upTime): # v2 - Records all facts of a device, as just read
+    if not InventoryDir:
+        return
+    with InventoryLock:
+        inventoryLoad()
+        InventoryRecords[deviceIp] = {'time': time.time(), 'sysUpTime': upTime, 'facts': facts}
+        InventoryChanged.add(deviceIp)
+
+def inventoryUpdate(deviceIp, **facts): # v2 - Updates some facts of a device already in inventory, as read live by a run
+    if not InventoryDir:
+        return
+    with InventoryLock:
+        inventoryLoad()
+        record = InventoryRecords.get(deviceIp)
+        if not record or all(record['facts'].get(x) == y for x, y in facts.items()):
+            return
+        record['facts'].update(facts)
+        InventoryChanged.add(deviceIp)
+
+def inventoryDrop(deviceIp): # v2 - Drops a device from inventory, i.e. once it no longer has that IP
+    if not InventoryDir:
+        return
+    with InventoryLock:
+        inventoryLoad()
+        if InventoryRecords.pop(deviceIp, None) != None:
+            InventoryChanged.add(deviceIp)
+
+def uptimeSecs(sysUpTime): # v1 - Converts a sysUpTime, as timeticks or as "12 days, 3:04:05.67", to secs; None if not known
+    if sysUpTime == None:
+        return None
+    if isinstance(sysUpTime, (int, long, float)) or re.match(r'^\d+$', str(sysUpTime)):
+        return int(sysUpTime) / 100.0
+    match = RegexUptime.search(str(sysUpTime))
+    if not match:
+        return None
+    days, hours, mins, secs = match.groups()
+    return int(days or 0) * 86400 + int(hours) * 3600 + int(mins) * 60 + int(secs)
+
+def inventoryStale(deviceVars, upTime): # v1 - Returns why the facts held for a device are stale, or None if they are not; must be called with InventoryLock held
+    record = InventoryRecords.get(deviceVars["deviceIP"])
+    if not record:
+        return 'not in inventory'
+    if record['facts'].get('version') != deviceVars["deviceSoftwareVer"]:
+        return 'software version changed'
+    if upTime != None and record['sysUpTime'] != None and upTime < record['sysUpTime']:
+        return 'rebooted'
+    if time.time() - record['time'] > InventoryMaxAge:
+        return 'expired'
+    return None
+
+def inventoryCollect(): # v1 - Reads the facts of calling thread's device, from its emc_vars & in one CLI round-trip
+    dc = deviceContext()
+    family = FamilyChildren.get(dc.vars["family"], dc.vars["family"])
+    facts = {'family': family, 'version': dc.vars["deviceSoftwareVer"]}
+    if family != 'VSP Series': # Only family this script reads the other facts of
+        return facts
+    dc.family = family
+    cliContext('privExec')
+    facts['mgmtMask'], facts['dvrRole'] = sendCLI_showPlan(
+        [CLI_Dict[family]['get_mgmt_ip_mask'].format(dc.vars["deviceIP"]), CLI_Dict[family]['get_dvr_type']],
+        returnCliError=True, prefetchList=['show isis spbm'] # For extractSpbmGlobal()
+    )
+    facts['spbm'] = extractSpbmGlobal()
+    return facts
+
+def inventoryRefresh(deviceVarsList, sessionFactory=newCliSession): # v2 - Brings the facts of all devices up to date, reading stale ones in parallel; returns dict of IP: facts
+    # All devices are probed with one batched NBI query, which also returns their site path & admin profile; the facts of a device
+    # are stale if not in inventory, if its software version changed, if its sysUpTime went back (rebooted), or after InventoryMaxAge
+    if not InventoryDir:
+        return {}
+    queryList = []
+    for deviceVars in deviceVarsList:
+        currentIp = deviceVars["deviceIP"]
+        queryList.append((currentIp + ' sysUpTime',    NBI_Query['getDeviceSysUpTime'],    {'IP': currentIp}))
+        queryList.append((currentIp + ' sitePath',     NBI_Query['getSitePath'],           {'IP': currentIp}))
+        queryList.append((currentIp + ' adminProfile', NBI_Query['getDeviceAdminProfile'], {'IP': currentIp}))
+    probeDict = {}
+    for start in range(0, len(queryList), NbiBatchSize):
+        probeDict.update(nbiBatchQuery(queryList[start:start + NbiBatchSize], returnKeyError=True) or {}) # On NBI error, only stale by age
+    workQueue = Queue.Queue()
+    with InventoryLock:
+        inventoryLoad()
+        for deviceVars in deviceVarsList:
+            reason = inventoryStale(deviceVars, uptimeSecs(probeDict.get(deviceVars["deviceIP"] + ' sysUpTime')))
+            if reason:
+                workQueue.put((deviceVars, reason))
+    print "Inventory: facts of {} of {} devices up to date; reading {}".format(len(deviceVarsList) - workQueue.qsize(), len(deviceVarsList), workQueue.qsize())
+    failedList = []
+
+    def worker():
+        while True:
+            try:
+                deviceVars, reason = workQueue.get_nowait()
+            except Queue.Empty:
+                return
+            currentIp = deviceVars["deviceIP"]
+            try:
+                deviceContextInit(None, deviceVars, worker=True)
+                cli = sessionFactory(currentIp)
+                cliSessionAttach(cli, currentIp)
+                try:
+                    facts = inventoryCollect()
+                finally:
+                    if cli is not emc_cli: # The launching device's session is the script's own, and still needed by its run
+                        cliSessionClose()
+            except Exception as e: # One device cannot stop the others; its facts just stay unknown
+                debug("inventoryRefresh {} ({}) failed: {}".format(currentIp, reason, e))
+                failedList.append(currentIp)
+                continue
+            inventoryStore(currentIp, facts, uptimeSecs(probeDict.get(currentIp + ' sysUpTime')))
+            debug("inventoryRefresh {} ({}) = {}".format(currentIp, reason, facts))
+
+    threads = [threading.Thread(target=worker, name="inventory-{}".format(x)) for x in range(min(InventoryThreads, workQueue.qsize()))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if failedList:
+        print "Inventory: unable to read facts of {} devices: {}".format(len(failedList), ", ".join(sorted(failedList)))
+    for deviceVars in deviceVarsList: # Taken from the probe, as fresh as it gets
+        currentIp = deviceVars["deviceIP"]
+        if probeDict.get(currentIp + ' sitePath') and probeDict.get(currentIp + ' adminProfile'):
+            inventoryUpdate(currentIp, sitePath=probeDict[currentIp + ' sitePath'], adminProfile=probeDict[currentIp + ' adminProfile'])
+    inventorySave()
+    return dict((x["deviceIP"], inventoryFacts(x["deviceIP"])) for x in deviceVarsList)
 
 
 # --> XMC Python script actually starts here <--
@@ -805,10 +2743,8 @@ except:
 
 CLI_Dict = {
     'VSP Series': {
-        'disable_more_paging'        : 'terminal more disable',
-        'enable_context'             : 'enable',
-        'config_context'             : 'config term',
         'end_config'                 : 'end',
+        'get_running_config'         : 'show running-config',
         'get_mgmt_ip_mask'           : 'int://show mgmt ip||{}\/(\d\d?) ', # IP address
         'get_dvr_type'               : 'str-lower://show dvr||^Role\s+:\s+(Leaf|Controller)',
         'check_vrf_exists'           : 'bool://show ip vrf||^{} ', # VRF name
@@ -850,11 +2786,23 @@ CLI_Dict = {
                                        '''
                                        snmp-server location "{0}"
                                        ''',
+        'delete_snmp_loc'            : 'no snmp-server location',
+        'delete_vlan'                : 'vlan delete {0}', # VLAN ID
+        'set_vlan_isid'              : 'vlan i-sid {0} {1}', # VLAN ID, I-SID
+        'delete_vlan_isid'           : 'no vlan i-sid {0}', # VLAN ID
+        'revert_mgmt_vlan'           : # VLAN ID, IP address, mask, ip route lines
+                                       '''
+                                       mgmt vlan {0}
+                                          ip address {1}/{2}
+                                          {3}
+                                          enable
+                                       exit
+                                       ''',
     },
 }
 
 
-NBI_Query = { # GraphQl query / NBI_Query['key'].replace('<IP>', var)
+NBI_Query = { # GraphQl query / NBI_Query['key'].replace('<IP>', var); 'ttl' secs to cache read-only query responses; 'invalidates' cached queries on mutation
     'nbiAccess': {
         'json': '''
                 {
@@ -865,7 +2813,8 @@ NBI_Query = { # GraphQl query / NBI_Query['key'].replace('<IP>', var)
                   }
                 }
                 ''',  
-        'key': 'version'
+        'key': 'version',
+        'ttl': 600,
     },
     'checkSwitchXmcDb': {
         'json': '''
@@ -877,7 +2826,8 @@ NBI_Query = { # GraphQl query / NBI_Query['key'].replace('<IP>', var)
                   }
                 }
                 ''',
-        'key': 'device'
+        'key': 'device',
+        'ttl': 60,
     },
     'getSitePath': {
         'json': '''
@@ -889,7 +2839,8 @@ NBI_Query = { # GraphQl query / NBI_Query['key'].replace('<IP>', var)
                   }
                 }
                 ''',
-        'key': 'sitePath'
+        'key': 'sitePath',
+        'ttl': 300,
     },
     'getDeviceAdminProfile': {
         'json': '''
@@ -903,7 +2854,20 @@ NBI_Query = { # GraphQl query / NBI_Query['key'].replace('<IP>', var)
                   }
                 }
                 ''',
-        'key': 'profileName'
+        'key': 'profileName',
+        'ttl': 300,
+    },
+    'getDeviceSysUpTime': { # Not cached, as used to probe for reboots
+        'json': '''
+                {
+                  network {
+                    device(ip:"<IP>") {
+                      sysUpTime
+                    }
+                  }
+                }
+                ''',
+        'key': 'sysUpTime',
     },
     'delete_device': {
         'json': '''
@@ -921,6 +2885,7 @@ NBI_Query = { # GraphQl query / NBI_Query['key'].replace('<IP>', var)
                   }
                 }
                 ''',
+        'invalidates': ['checkSwitchXmcDb', 'getSitePath', 'getDeviceAdminProfile'],
     },
     'checkSwitchNacConfig': {
         'json': '''
@@ -932,7 +2897,8 @@ NBI_Query = { # GraphQl query / NBI_Query['key'].replace('<IP>', var)
                   }
                 }
                 ''',
-        'key': 'switch'
+        'key': 'switch',
+        'ttl': 60,
     },
     'getNacLocationGroups': {
         'json': '''
@@ -942,7 +2908,8 @@ NBI_Query = { # GraphQl query / NBI_Query['key'].replace('<IP>', var)
                   }
                 }
                 ''',
-        'key': 'groupNamesByType'
+        'key': 'groupNamesByType',
+        'ttl': 300,
     },
     'accessControlDeleteSwitch': {
         'json': '''
@@ -957,6 +2924,20 @@ NBI_Query = { # GraphQl query / NBI_Query['key'].replace('<IP>', var)
                   }
                 }
                 ''',
+        'invalidates': ['checkSwitchNacConfig'],
+    },
+    'getNacGroupValues': {
+        'json': '''
+                {
+                  accessControl {
+                    group(name: "<LOCATIONGROUP>") {
+                      values
+                    }
+                  }
+                }
+                ''',
+        'key': 'values',
+        'ttl': 300,
     },
     'accessControlRemoveSwitchFromLocation': {
         'json': '''
@@ -972,6 +2953,7 @@ NBI_Query = { # GraphQl query / NBI_Query['key'].replace('<IP>', var)
                   }
                 }
                 ''',
+        'invalidates': ['getNacGroupValues'],
     },
     'create_device': {
         'json': '''
@@ -990,6 +2972,7 @@ NBI_Query = { # GraphQl query / NBI_Query['key'].replace('<IP>', var)
                   }
                 }
                 ''',
+        'invalidates': ['checkSwitchXmcDb', 'getSitePath', 'getDeviceAdminProfile'],
     },
     'check_device': {
         'json': '''
@@ -1005,6 +2988,9 @@ NBI_Query = { # GraphQl query / NBI_Query['key'].replace('<IP>', var)
     },
 }
 
+compileCliDict(CLI_Dict)
+compileNbiQuery(NBI_Query)
+
 
 #
 # Other Custom Functions:
@@ -1048,160 +3034,379 @@ def extractSpbmGlobal(): # v1 - Tricky command to extract from, as it is differe
     debug("extractSpbmGlobal() = {}".format(dataDict))
     return dataDict
 
+def extractMgmtState(): # v1 - Snapshot of current mgmt config: VLAN, I-SID, IP/mask, routes, sys-names & SNMP location, in one CLI round-trip
+    # Only supported for family = 'VSP Series'
+    dataDict = {
+        'Vlans'        : {},   # All VLANs: I-SID (or None)
+        'MgmtVlan'     : None,
+        'MgmtIsid'     : None,
+        'MgmtIp'       : None,
+        'MgmtMask'     : None,
+        'MgmtRoutes'   : [],   # 'ip route' lines under mgmt vlan context
+        'DhcpClient'   : [],   # 'mgmt dhcp-client' context lines, as they appear in config
+        'SnmpName'     : None,
+        'IsisSysName'  : None,
+        'SnmpLocation' : None,
+    }
+    context = None
+    for line in sendCLI_showCommandStream(CLI_Dict['VSP Series']['get_running_config']) or []:
+        line = line.strip()
+        if context == 'mgmt dhcp-client':
+            dataDict['DhcpClient'].append(line)
+            if line == 'exit':
+                context = None
+            continue
+        if line == 'exit':
+            context = None
+            continue
+        if context == 'mgmt vlan':
+            match = regexCompile(r'^ip address (\d+\.\d+\.\d+\.\d+)/(\d+)').match(line)
+            if match:
+                dataDict['MgmtIp'], dataDict['MgmtMask'] = match.group(1), match.group(2)
+            elif line.startswith('ip route '):
+                dataDict['MgmtRoutes'].append(line)
+            continue
+        if context == 'router isis':
+            match = regexCompile(r'^sys-name "?([^"]+)"?$').match(line)
+            if match:
+                dataDict['IsisSysName'] = match.group(1)
+            continue
+        match = regexCompile(r'^(?:vlan create (\d+) |vlan i-sid (\d+) (\d+)$|mgmt vlan (\d+)$|(mgmt dhcp-client)|(router isis)$|snmp-server (name|location) "?([^"]*)"?$)').match(line)
+        if not match:
+            continue
+        vlanCreate, isidVlan, isid, mgmtVlan, dhcpClient, routerIsis, snmpKey, snmpValue = match.groups()
+        if vlanCreate:
+            dataDict['Vlans'].setdefault(vlanCreate, None)
+        elif isidVlan:
+            dataDict['Vlans'][isidVlan] = isid
+        elif mgmtVlan:
+            dataDict['MgmtVlan'] = mgmtVlan
+            context = 'mgmt vlan'
+        elif dhcpClient:
+            dataDict['DhcpClient'].append(line)
+            context = 'mgmt dhcp-client' if line == 'mgmt dhcp-client' else None # Else a one line command
+        elif routerIsis:
+            context = 'router isis'
+        elif snmpKey == 'name':
+            dataDict['SnmpName'] = snmpValue
+        elif snmpKey == 'location':
+            dataDict['SnmpLocation'] = snmpValue
+    if dataDict['MgmtVlan']:
+        dataDict['MgmtIsid'] = dataDict['Vlans'].get(dataDict['MgmtVlan'])
+    debug("extractMgmtState() = {}".format(dataDict))
+    return dataDict
 
-#
-# Main:
-#
-def main():
-    print "{} version {} on XMC version {}".format(scriptName(), __version__, emc_vars["serverVersion"])
-    nbiAccess = nbiQuery(NBI_Query['nbiAccess'], returnKeyError=True)
-    if nbiAccess == None:
-        exitError('This XMC Script requires access to the GraphQl North Bound Interface (NBI). Make sure that XMC is running with an Advanced license and that your user profile is authorized for Northbound API.')
-
-    #
-    # Obtain Info on switch and from XMC
-    #
-    setFamily() # Sets global Family variable
-    currentIp           = emc_vars["deviceIP"]
-    newIp               = emc_vars["userInput_ip"].strip()
-    newSysName          = emc_vars["userInput_sysname"].strip()
-    newVlanID           = emc_vars["userInput_vid"].strip()
-    newVlanISID         = emc_vars["userInput_isid"].strip()
-    newVlanDGW          = emc_vars["userInput_dgw"].strip()
-    snmpLoc             = emc_vars["userInput_snmpLoc"].strip()
-    subnet              = emc_vars["userInput_subnet"].strip()
-    
-    print "Information provided by User:"
-    print " - New VLAN IP = {}".format(newIp)
-    print " - Subnetmask = {}".format(subnet)
-    print " - New VLAN ID = {}".format(newVlanID)
-    print " - New VLAN I-SID = {}".format(newVlanISID)
-    print " - New VLAN Gateway = {}".format(newVlanDGW)
-    print " - New System Name = {}".format(newSysName)
-    print " - SNMP Location = {}".format(snmpLoc)
-    
-
-    vossVersion = emc_vars["deviceSoftwareVer"]
-
-    print "Switch information:"
-    print " - VOSS software version = {}".format(vossVersion)
-    print
-
-    # VOSS version validation
-    if re.match(r'(?:[1-7]\.|8\.[01]\.)', vossVersion):
-        exitError('This script only works on VSPs running VOSS 8.2 or later')
+def mgmtRollbackChain(stateDict, newVlanID, newSysName, snmpLoc): # v2 - Returns the list of config commands undoing change_mgmt_vlan, change_sys_name & set_snmp_loc
+    # stateDict as returned by extractMgmtState() before the change
+    family = deviceContext().family
+    cmdList = configChain(CLI_Dict[family]['delete_mgmt_vlan'])
+    if newVlanID not in stateDict['Vlans']:
+        cmdList.extend(CLI_Dict[family]['delete_vlan'].format(newVlanID))
+    elif stateDict['Vlans'][newVlanID]:
+        cmdList.extend(CLI_Dict[family]['set_vlan_isid'].format(newVlanID, stateDict['Vlans'][newVlanID]))
+    else:
+        cmdList.extend(CLI_Dict[family]['delete_vlan_isid'].format(newVlanID))
+    cmdList.extend(configChain("\n".join(stateDict['DhcpClient'])))
+    if stateDict['MgmtVlan'] and stateDict['MgmtIp']:
+        cmdList.extend(CLI_Dict[family]['revert_mgmt_vlan'].format(stateDict['MgmtVlan'], stateDict['MgmtIp'], stateDict['MgmtMask'], "\n".join(stateDict['MgmtRoutes'])))
+    if newSysName and stateDict['SnmpName']:
+        cmdList.extend(CLI_Dict[family]['change_sys_name'].format('"{}"'.format(stateDict['SnmpName'])))
+        if stateDict['IsisSysName'] and stateDict['IsisSysName'] != stateDict['SnmpName']:
+            cmdList.extend(configChain('router isis; sys-name "{}"; exit'.format(stateDict['IsisSysName'])))
+    if snmpLoc:
+        if stateDict['SnmpLocation']:
+            cmdList.extend(CLI_Dict[family]['set_snmp_loc'].format(stateDict['SnmpLocation']))
+        else:
+            cmdList.extend(configChain(CLI_Dict[family]['delete_snmp_loc']))
+    debug("mgmtRollbackChain() = {}".format(cmdList))
+    return cmdList
 
-    # IP validation
+def validateDeviceInput(deviceVars): # v1 - Validates the user inputs for one device, without touching it; returns list of error messages
+    errorList = []
+    currentIp = deviceVars["deviceIP"]
+    newIp     = deviceVars["userInput_ip"].strip()
+    subnet    = deviceVars["userInput_subnet"].strip()
+    vlanId    = deviceVars["userInput_vid"].strip()
+    isid      = deviceVars["userInput_isid"].strip()
+    gateway   = deviceVars["userInput_dgw"].strip()
+    sysName   = deviceVars["userInput_sysname"].strip()
+    if re.match(r'(?:[1-7]\.|8\.[01]\.)', deviceVars["deviceSoftwareVer"]):
+        errorList.append('This script only works on VSPs running VOSS 8.2 or later')
     if not ipToNumber(newIp):
-        exitError('Invalid VLAN IP address {}'.format(newIp))
-    if newIp == currentIp:
-        exitError('Given IP {} is already used to manange the switch'.format(newIp))
+        errorList.append('Invalid VLAN IP address {}'.format(newIp))
+    elif newIp == currentIp:
+        errorList.append('Given IP {} is already used to manange the switch'.format(newIp))
+    if re.search(r'\s', sysName):
+        errorList.append('System Name provided must not contain any spaces: "{}"'.format(sysName))
+    if not maskToNumber(subnet):
+        errorList.append('Invalid subnet mask {}'.format(subnet))
+    if not re.match(r'^\d+$', vlanId) or not 2 <= int(vlanId) <= 4059:
+        errorList.append('Invalid VLAN ID {}; must be 2-4059'.format(vlanId))
+    if not re.match(r'^\d+$', isid) or not 1 <= int(isid) <= 15999999:
+        errorList.append('Invalid I-SID {}; must be 1-15999999'.format(isid))
+    if not ipToNumber(gateway):
+        errorList.append('Invalid gateway IP address {}'.format(gateway))
+    elif ipToNumber(newIp) and maskToNumber(subnet):
+        if gateway == newIp:
+            errorList.append('Gateway {} is the same as the new VLAN IP'.format(gateway))
+        elif subnetMask(gateway, subnet)[0] != subnetMask(newIp, subnet)[0]:
+            errorList.append('Gateway {} is outside of new VLAN IP subnet {}/{}'.format(gateway, *subnetMask(newIp, subnet)[0::2]))
+    return errorList
+
+def preflightCheck(deviceVarsList): # v5 - Validates the inputs of all devices before any device is touched; prints a go/no-go report and returns True on go
+    resumeList = [x["deviceIP"] for x in deviceVarsList if journalEntry(x)]
+    if resumeList: # Already changed by an earlier run, so would fail the checks; they resume where they were, or are skipped if done
+        print "Not checking {} devices already in journal of an earlier run: {}".format(len(resumeList), ", ".join(resumeList))
+        deviceVarsList = [x for x in deviceVarsList if x["deviceIP"] not in resumeList]
+    print "Pre-flight check of {} devices".format(len(deviceVarsList))
+    errorDict = collections.OrderedDict((x["deviceIP"], validateDeviceInput(x)) for x in deviceVarsList)
+    validList = [x for x in deviceVarsList if not errorDict[x["deviceIP"]]]
+
+    # Inputs which clash across devices
+    newIpDevices = {}
+    for deviceVars in deviceVarsList:
+        newIpDevices.setdefault(deviceVars["userInput_ip"].strip(), []).append(deviceVars["deviceIP"])
+    for newIp, ipList in newIpDevices.items():
+        if len(ipList) > 1:
+            for ip in ipList:
+                errorDict[ip].append('New IP {} also given for device(s) {}'.format(newIp, ", ".join([x for x in ipList if x != ip])))
+        if newIp in errorDict:
+            for ip in ipList:
+                errorDict[ip].append('New IP {} is the current IP of another device of this batch'.format(newIp))
+    subnetDevices = {}
+    vlanIsids = {}
+    for deviceVars in validList:
+        newIpSubnet = "{}/{}".format(*subnetMask(deviceVars["userInput_ip"].strip(), deviceVars["userInput_subnet"].strip())[0::2])
+        vlanIsid = (deviceVars["userInput_vid"].strip(), deviceVars["userInput_isid"].strip())
+        subnetDevices.setdefault(newIpSubnet, []).append((deviceVars["deviceIP"], vlanIsid, deviceVars["userInput_dgw"].strip()))
+        vlanIsids.setdefault(vlanIsid[0], set()).add(vlanIsid[1])
+    for newIpSubnet, deviceList in subnetDevices.items():
+        if len(set(x[1] for x in deviceList)) > 1:
+            mismatch = ", ".join(sorted(set("VLAN {} I-SID {}".format(*x[1]) for x in deviceList)))
+            for ip, vlanIsid, gateway in deviceList:
+                errorDict[ip].append('Devices in subnet {} have mismatching VLAN/I-SID: {}'.format(newIpSubnet, mismatch))
+        if len(set(x[2] for x in deviceList)) > 1:
+            for ip, vlanIsid, gateway in deviceList:
+                errorDict[ip].append('Devices in subnet {} have mismatching gateways: {}'.format(newIpSubnet, ", ".join(sorted(set(x[2] for x in deviceList)))))
+    for subnetA, subnetB in subnetOverlaps(subnetDevices.keys()): # Same subnet given with different masks
+        for ip, vlanIsid, gateway in subnetDevices[subnetA] + subnetDevices[subnetB]:
+            errorDict[ip].append('New subnets {} and {} given for different devices overlap'.format(subnetA, subnetB))
+    for deviceVars in validList:
+        vlanId = deviceVars["userInput_vid"].strip()
+        if len(vlanIsids[vlanId]) > 1:
+            errorDict[deviceVars["deviceIP"]].append('VLAN {} is given with different I-SIDs: {}'.format(vlanId, ", ".join(sorted(vlanIsids[vlanId]))))
+
+    # XMC lookups for all devices, batched; site path and admin profile are then cached for when the devices run
+    queryList = []
+    for deviceVars in validList:
+        currentIp = deviceVars["deviceIP"]
+        queryList.append((currentIp + ' newIpInXmc', NBI_Query['checkSwitchXmcDb'], {'IP': deviceVars["userInput_ip"].strip()}))
+        queryList.append((currentIp + ' sitePath',   NBI_Query['getSitePath'],      {'IP': currentIp}))
+        queryList.append((currentIp + ' adminProfile', NBI_Query['getDeviceAdminProfile'], {'IP': currentIp}))
+    nbiFacts = {}
+    for start in range(0, len(queryList), NbiBatchSize):
+        batchFacts = nbiBatchQuery(queryList[start:start + NbiBatchSize], returnKeyError=True)
+        if batchFacts == None:
+            print "Pre-flight NO-GO: unable to query XMC: {}".format(deviceContext().lastNbiError)
+            emc_results.setStatus(emc_results.Status.ERROR)
+            return False
+        nbiFacts.update(batchFacts)
+    for deviceVars in validList:
+        currentIp = deviceVars["deviceIP"]
+        if nbiFacts[currentIp + ' newIpInXmc']:
+            errorDict[currentIp].append("Given IP address {} is already in XMC's database".format(deviceVars["userInput_ip"].strip()))
+        if not nbiFacts[currentIp + ' sitePath'] or not nbiFacts[currentIp + ' adminProfile']:
+            errorDict[currentIp].append("Unable to get site path and admin profile of device from XMC")
+
+    # Checks needing device facts are planned against the inventory, which only reads the facts of devices it holds stale;
+    # phaseValidate() re-checks them live, right before the device is changed
+    inventoryDict = inventoryRefresh(validList)
+    for deviceVars in validList:
+        currentIp = deviceVars["deviceIP"]
+        currentIpMask = inventoryDict.get(currentIp, {}).get('mgmtMask')
+        newIp = deviceVars["userInput_ip"].strip()
+        if currentIpMask and subnetMask(currentIp, currentIpMask)[0] == subnetMask(newIp, currentIpMask)[0]:
+            errorDict[currentIp].append("New IP {} seems to be in same subnet of existing IP {}/{}".format(newIp, currentIp, currentIpMask))
+
+    # All new IPs probed at once
+    newIpList = [x["userInput_ip"].strip() for x in validList]
+    print "Probing {} new IPs for up to 3secs".format(len(newIpList))
+    probeDict = reachabilityProbe(newIpList, deadline=3)
+    for deviceVars in validList:
+        if probeDict[deviceVars["userInput_ip"].strip()] != None:
+            errorDict[deviceVars["deviceIP"]].append("Given IP address {} is already on the network (replies to ping)".format(deviceVars["userInput_ip"].strip()))
+
+    failed = [x for x in errorDict if errorDict[x]]
+    for ip, errorList in errorDict.items():
+        print " - {:<16} {:<6} {}".format(ip, 'NO-GO' if errorList else 'GO', "; ".join(errorList))
+    if failed:
+        errorOutput = "Pre-flight NO-GO: {} of {} devices failed pre-flight checks; no device was touched".format(len(failed), len(errorDict))
+        print errorOutput
+        if 'workflowMessage' in emc_vars: # Workflow
+            emc_results.put("deviceMessage", errorOutput)
+            emc_results.put("activityMessage", errorOutput)
+            emc_results.put("workflowMessage", errorOutput)
+        emc_results.setStatus(emc_results.Status.ERROR)
+        return False
+    print "Pre-flight GO for all {} devices\n".format(len(errorDict))
+    return True
 
-    # Sys-name validation
-    if re.search(r'\s', newSysName):
-        exitError('System Name provided must not contain any spaces: "{}"'.format(newSysName))
+
+#
+# Main:
+#
+def phaseValidate(state): # v4 - VOSS version, IP, Sys-name, VLAN/I-SID & gateway validation; no change made to anything yet
+    dc = deviceContext()
+    currentIp = state['currentIp']
+    newIp = state['newIp']
+    family = dc.family
+    errorList = validateDeviceInput(dc.vars)
+    if errorList:
+        exitError(errorList[0])
+
+    # Get all we need from XMC in one go: is new IP already known, site path & admin profile in use for this device
+    nbiFacts = nbiBatchQuery([
+        ('checkNewIpInXmc', NBI_Query['checkSwitchXmcDb'],      {'IP': newIp}),
+        ('sitePath',        NBI_Query['getSitePath'],           {'IP': currentIp}),
+        ('adminProfile',    NBI_Query['getDeviceAdminProfile'], {'IP': currentIp}),
+    ])
+    state['sitePath'] = nbiFacts['sitePath']
+    state['adminProfile'] = nbiFacts['adminProfile']
 
     # Check if given IP is already in XMC
-    checkNewIpInXmc = nbiQuery(NBI_Query['checkSwitchXmcDb'], IP=newIp)
-    if checkNewIpInXmc:
+    if nbiFacts['checkNewIpInXmc']:
         exitError("Given IP address {} is already in XMC's database".format(newIp))
 
     # Check if given IP is already out there
-    response = os.system("ping -c 1 " + newIp)
-    if response == 0: # Response from ping
+    if reachabilityProbe([newIp], deadline=3)[newIp] != None: # Response from ping or SSH/Telnet port
         exitError("Given IP address {} is already on the network (replies to ping)".format(newIp))
 
-    # Get the site path for device
-    sitePath = nbiQuery(NBI_Query['getSitePath'], IP=currentIp)
-
-    # Find the Admin Profile which was in use for this device
-    adminProfile = nbiQuery(NBI_Query['getDeviceAdminProfile'], IP=currentIp)
-
-    # Disable more paging
-    sendCLI_showCommand(CLI_Dict[Family]['disable_more_paging'])
-
-    # Enter privExec
-    sendCLI_showCommand(CLI_Dict[Family]['enable_context'])
+    # Disable more paging & enter privExec
+    cliContext('privExec')
 
-    # Get the mask of the IP we are using now
-    currentIpMask = sendCLI_showRegex(CLI_Dict[Family]['get_mgmt_ip_mask'].format(currentIp))
+    # Get the mask of the IP we are using now; the TFTP state warpBuffer_execute() checks is fetched in the same round-trip, and
+    # so is the config extractMgmtState() reads, if CliPrefetchConfig
+    prefetchList = [CLI_Dict[family]['get_running_config']] if CliPrefetchConfig else []
+    currentIpMask, = sendCLI_showPlan([CLI_Dict[family]['get_mgmt_ip_mask'].format(currentIp)], prefetchList=prefetchList + [WarpTftpCheck[family]])
     if not currentIpMask:
         exitError("Cannot determine mask of existing IP {}".format(currentIp))
+    inventoryUpdate(currentIp, mgmtMask=currentIpMask, sitePath=state['sitePath'], adminProfile=state['adminProfile'])
 
     # Compare subnets for same mask (when moving from mgmt vlan IP to clip IP, ensure the clip IP is not in vlan IP subnet)
     if subnetMask(currentIp, currentIpMask)[0] == subnetMask(newIp, currentIpMask)[0]:
         exitError("New IP {} seems to be in same subnet of existing IP {}".format(newIp, currentIp))
 
+    # The change is pushed in commit-confirm mode; check once per software version that the switch deadman timer can be relied on
+    if inventoryFacts(currentIp).get('deadmanVerified') != dc.vars["deviceSoftwareVer"]:
+        deadmanFired = warpDeadmanTest(currentIp)
+        if deadmanFired == None:
+            exitError("Unable to run deadman self-test on {}: {}".format(currentIp, dc.lastError))
+        if not deadmanFired:
+            exitError("Switch did not fire the deadman self-test once its CLI session was gone; cannot push the change in commit-confirm mode")
+        inventoryUpdate(currentIp, deadmanVerified=dc.vars["deviceSoftwareVer"])
+
 #    # Verify whether mgmt clip is already set
-#    mgmtIfList = sendCLI_showRegex(CLI_Dict[Family]['list_mgmt_interfaces'])
-#    mgmtIpDict = sendCLI_showRegex(CLI_Dict[Family]['list_mgmt_ips'])
+#    mgmtIfList = sendCLI_showRegex(CLI_Dict[family]['list_mgmt_interfaces'])
+#    mgmtIpDict = sendCLI_showRegex(CLI_Dict[family]['list_mgmt_ips'])
+
+def phasePush(state): # v4 - Pushes the mgmt VLAN change to the switch in commit-confirm mode
+    dc = deviceContext()
+    family = dc.family
+    # Disable more paging & enter privExec; a resumed run starts here, on a fresh session
+    cliContext('privExec')
+
+    # Snapshot the current mgmt config, from which we generate the exact inverse of the change
+    mgmtState = extractMgmtState()
+    if not mgmtState['MgmtVlan']:
+        print "No mgmt VLAN configured on switch; rollback will only remove the new mgmt VLAN"
+    rollbackChain = mgmtRollbackChain(mgmtState, state['newVlanID'], state['newSysName'], state['snmpLoc'])
 
     # Enter Config context
-    sendCLI_configCommand(CLI_Dict[Family]['config_context'])
+    cliContext('config')
 
 #    if 'CLIP' in mgmtIfList: # Here a mgmt clip already exists, and we are trying to change it
 #        # Queue delete of existing mgmt clip
-#        warpBuffer_add(CLI_Dict[Family]['delete_mgmt_clip'])
+#        warpBuffer_add(CLI_Dict[family]['delete_mgmt_clip'])
 #
 #        # Queue creation of new mgmt clip
-#        warpBuffer_add(CLI_Dict[Family]['create_mgmt_clip'].format(newVrf, newIp))
+#        warpBuffer_add(CLI_Dict[family]['create_mgmt_clip'].format(newVrf, newIp))
 #
 #    else: # Here no mgmt clip exists, so we can take a safer approach...
 #        # For GRT + regular BEB + IP Shortcuts not enabled, we enable IP Shortcuts
 #        if (not dvrNodeType == 'leaf' and not spbmGlobalDict['IP'] == 'enable'):
-#            sendCLI_configChain(CLI_Dict[Family]['enable_ip_shortcuts'])
-#            rollbackCommand(CLI_Dict[Family]['disable_ip_shortcuts'])
+#            sendCLI_configChain(CLI_Dict[family]['enable_ip_shortcuts'])
+#            rollbackCommand(CLI_Dict[family]['disable_ip_shortcuts'])
 #
 #        # Go ahead and create the new mgmt clip
-#        sendCLI_configChain(CLI_Dict[Family]['create_mgmt_clip'].format(newVrf, newIp))
-#        rollbackCommand(CLI_Dict[Family]['delete_mgmt_clip'])
+#        sendCLI_configChain(CLI_Dict[family]['create_mgmt_clip'].format(newVrf, newIp))
+#        rollbackCommand(CLI_Dict[family]['delete_mgmt_clip'])
 #
 #        # Now check if the IP is reachable by XMC
 #        print "Waiting up to 10secs for new CLIP Mgmt IP to reply to ping"
     
     # Send commands to script to change the mgmt VLAN
-    warpBuffer_add(CLI_Dict[Family]['change_mgmt_vlan'].format(newVlanID, newVlanISID, newIp, subnet, newVlanDGW))
-#    rollbackCommand(CLI_Dict[Family]['revert_mgmt_vlan'].format(currentIP)) --> need to get current gw, id, id,...
-
+    warpBuffer_add(CLI_Dict[family]['change_mgmt_vlan'].format(state['newVlanID'], state['newVlanISID'], state['newIp'], state['subnet'], state['newVlanDGW']))
 
     # Queue change of sys-name
-    if newSysName:
-        warpBuffer_add(CLI_Dict[Family]['change_sys_name'].format(newSysName))
+    if state['newSysName']:
+        warpBuffer_add(CLI_Dict[family]['change_sys_name'].format(state['newSysName']))
 
     # Queue change of SNMP location
-    if snmpLoc:
-        warpBuffer_add(CLI_Dict[Family]['set_snmp_loc'].format(snmpLoc))
-
-    # Execute queued buffer
-    warpBuffer_execute(waitForPrompt=False)
-    addXmcSyslogEvent('info', "Changed IP address to {}".format(newIp), currentIp)
-
-    print "Waiting up to 10secs for new Mgmt IP to reply to ping"
-    
-    if not Sanity:
-        time.sleep(10)
-        retries = 0
-        response = None
-        while not retries > 10:
-            response = os.system("ping -c 1 " + newIp)
-            if response == 0: # Response from ping
-                break
-            retries += 1
-            print " - {} timeout".format(retries)
-        if response == 1: # No response from ping
-            abortError("ping {}".format(newIp), "Newly configured VLAN IP {} not reachable by XMC; rolling back changes".format(newIp))
-        print " - reply from {}".format(newIp)
+    if state['snmpLoc']:
+        warpBuffer_add(CLI_Dict[family]['set_snmp_loc'].format(state['snmpLoc']))
+
+    # Execute queued buffer in commit-confirm mode; we will no longer be able to reach the switch on the current IP to roll back,
+    # so the rollback is staged on the switch, which will source it by itself unless we confirm the change on the new IP in time
+    # The rollback is also pushed onto our rollback stack, once the switch has fetched the warp script and is about to source it
+    warpBuffer_execute(waitForPrompt=False, rollbackChain=rollbackChain, commitConfirm=DeadmanTimer, deadmanIp=state['newIp'])
+    addXmcSyslogEvent('info', "Changed IP address to {}".format(state['newIp']), state['currentIp'])
+
+def phaseVerifyReachability(state): # v2 - Checks that the new IP replies to ping; if not, the switch deadman timer reverts the change (see deadmanRevert)
+    newIp = state['newIp']
+    print "Waiting up to 30secs for new Mgmt IP to reply to ping"
     
-    # Close the connection
     if not Sanity:
-        emc_cli.close()
-
-    # Delete the old IP from XMC
+        replyTime = reachabilityProbe([newIp], deadline=30)[newIp]
+        if replyTime == None:
+            exitError("Newly configured VLAN IP {} not reachable by XMC".format(newIp))
+        print " - reply from {} in {:.0f}ms".format(newIp, replyTime * 1000)
+
+def deadmanRevert(state, reason): # v1 - The change was not confirmed: waits for the switch deadman timer to revert it, puts XMC back on the old IP, and exits with error
+    dc = deviceContext()
+    currentIp = state['currentIp']
+    newIp = state['newIp']
+    dc.deadmanArmed = False
+    rollBackPop() # The switch rolls back by itself; nothing for us to send
+    print "{}; waiting up to {}secs for switch deadman timer to revert the change".format(reason, DeadmanTimer + 30)
+    if reachabilityProbe([currentIp], deadline=DeadmanTimer + 30)[currentIp] == None:
+        exitError("{}, and switch did not revert to IP {}".format(reason, currentIp))
+
+    # XMC may already have been moved to the new IP; it must find the switch on its old IP again
+    if nbiQuery(NBI_Query['checkSwitchXmcDb'], IP=newIp):
+        if not nbiMutation(NBI_Query['delete_device'], IP=newIp):
+            exitError("{}; switch reverted the change, but new IP '{}' could not be deleted from XMC's database".format(reason, newIp))
+        print "Deleted device {} from XMC database".format(newIp)
+    if not nbiQuery(NBI_Query['checkSwitchXmcDb'], IP=currentIp):
+        if not nbiMutation(NBI_Query['create_device'], IP=currentIp, SITE=state['sitePath'], PROFILE=state['adminProfile']):
+            exitError("{}; switch reverted the change, but IP '{}' could not be re-added to XMC Site '{}'".format(reason, currentIp, state['sitePath']))
+        addXmcSyslogEvent('info', "Re-added device to XMC Site {} after switch reverted the change".format(state['sitePath']), currentIp)
+        print "Re-added device to XMC using its old IP {}".format(currentIp)
+    journalClear() # Switch and XMC are back where they started; a new run must start over
+    nacNote = "; it may have been removed from XMC Control and its Location Groups" if state.get('switchNacExists') else ""
+    exitError("{}; switch reverted the change and is reachable again on IP {}{}".format(reason, currentIp, nacNote))
+
+def phaseDeleteFromXmc(state): # v2 - Deletes the old IP from XMC, and from the inventory
+    currentIp = state['currentIp']
+    inventoryDrop(currentIp) # Facts under the new IP get read by the next run using it
     if not nbiMutation(NBI_Query['delete_device'], IP=currentIp):
-        exitError("Failed to delete IP '{}' from XMC's database".format(currentIp))
+        if nbiQuery(NBI_Query['checkSwitchXmcDb'], IP=currentIp): # Not already deleted by an interrupted run
+            exitError("Failed to delete IP '{}' from XMC's database".format(currentIp))
     addXmcSyslogEvent('info', "Deleted device from XMC database", currentIp)
     print "Deleted device {} from XMC database".format(currentIp)
 
+def phaseDeleteFromNac(state): # v2 - Deletes the old IP from AccessControl, and from the Location Groups it is in
+    dc = deviceContext()
+    currentIp = state['currentIp']
     # Check whether switch was added to AccessControl
     switchNacExists = nbiQuery(NBI_Query['checkSwitchNacConfig'], IP=currentIp)
     # Sample of what we should get back
@@ -1209,77 +3414,173 @@ def main():
     #         "ipAddress": "10.8.4.2"
     # }
     # Or we get None
+    state['switchNacExists'] = state.get('switchNacExists') or bool(switchNacExists) # An interrupted run may have deleted it already
     if switchNacExists:
+        # Check which NAC Location Groups the switch was added to; the group membership index is built once, for all devices
+        # The switch is removed from these before being deleted, so that a run interrupted in between can still find it
+        nacLocationGroupList = nacLocationGroups(currentIp)
+        if nacLocationGroupList == None: # Could not build the index, so try all Location Groups
+            print "Unable to index NAC Location Groups: {}; will try removing device from all of them".format(dc.lastNbiError)
+            nacLocationGroupList = nbiQuery(NBI_Query['getNacLocationGroups'])
+
+        # And then delete the switch from those groups, all in one go; it is only deleted from AccessControl once out of all of them
+        removedList, errorDict = nacLocationGroupsRemove(currentIp, nacLocationGroupList)
+        for group in removedList:
+            addXmcSyslogEvent('info', "Deleted device from XMC Control Location Group: {}".format(group), currentIp)
+            print "Deleted device {} from Location Group: {}".format(currentIp, group)
+        if errorDict:
+            exitError("Failed to remove IP '{}' from NAC Location Groups: {}".format(currentIp, "; ".join(["{}: {}".format(x, errorDict[x]) for x in sorted(errorDict)])))
+
         if not nbiMutation(NBI_Query['accessControlDeleteSwitch'], IP=currentIp): # Delete the switch from AccessControl
             exitError("Failed to delete existing switch IP '{}' in NAC Engine Group".format(currentIp))
         addXmcSyslogEvent('info', "Deleted device from XMC Control", currentIp)
         print "Deleted device {} from XMC NAC engine".format(currentIp)
 
-        # Check whether switch was added to any NAC Location Groups
-        # For this we need to get a list of all Location Groups
-        nacLocationGroups = nbiQuery(NBI_Query['getNacLocationGroups'])
-        # Sample of what we should get back
-        # "groupNamesByType": [
-        #   "Branch3",
-        #   "Branch2",
-        #   "Branch1",
-        # ]
-        # Or we get []
-
-        # And then we methodically delete the switch from all those groups
-        for group in nacLocationGroups:
-            # Delete the switch from Location Group
-            if nbiMutation(NBI_Query['accessControlRemoveSwitchFromLocation'], LOCATIONGROUP=group, IP=currentIp):
-                addXmcSyslogEvent('info', "Deleted device from XMC Control Location Group: {}".format(group), currentIp)
-                print "Deleted device {} from Location Group: {}".format(currentIp, group)
-            # We don't check for errors, as we don't expect to find the IP in all location groups
-
-    # Create the new IP device in XMC
-    deviceReAdded = False
-    addRetries = 0
-    while not deviceReAdded and addRetries < 2: # We can try twice, as sometimes XIQ-SE fails to add the device...
-        if not nbiMutation(NBI_Query['create_device'], IP=newIp, SITE=sitePath, PROFILE=adminProfile):
-            exitError("Failed to add new device IP '{}' to XMC Site '{}' with admin profile '{}'".format(newIp, sitePath, adminProfile))
-        addXmcSyslogEvent('info', "Added device to XMC Site {}".format(sitePath), newIp)
-        print "Re-added device to XMC using new CLIP IP {} and admin profile '{}'".format(newIp, adminProfile)
-        addRetries += 1
+def phaseReAdd(state): # v1 - Creates the new IP device in XMC
+    newIp = state['newIp']
+    if not nbiMutation(NBI_Query['create_device'], IP=newIp, SITE=state['sitePath'], PROFILE=state['adminProfile']):
+        if not nbiQuery(NBI_Query['checkSwitchXmcDb'], IP=newIp): # Not already added by an interrupted run
+            exitError("Failed to add new device IP '{}' to XMC Site '{}' with admin profile '{}'".format(newIp, state['sitePath'], state['adminProfile']))
+    addXmcSyslogEvent('info', "Added device to XMC Site {}".format(state['sitePath']), newIp)
+    print "Re-added device to XMC using new CLIP IP {} and admin profile '{}'".format(newIp, state['adminProfile'])
 
+def phaseWaitDiscovery(state): # v1 - Waits for XMC to process the newly re-added switch; re-adds it once more if it does not come up
+    newIp = state['newIp']
+    deviceReAdded = False
+    addRetries = 1
+    while True: # We can try twice, as sometimes XIQ-SE fails to add the device...
         # Wait enough time for XMC to process the newly re-added switch
         print "Waiting for device to be re-added to XMC's database"
         if Sanity:
             deviceReAdded = True
         else:
-            retries = 0
-            while not retries > 20:
-                time.sleep(5)
-                if nbiQuery(NBI_Query['check_device'], IP=newIp):
-                    # Sample of what we should get back
-                    # "device": {
-                    #   "down": false
-                    # }
-                    # Or we get null
-                    deviceReAdded = True
-                    break
-                retries += 1
-                print " - retry {}".format(retries)
+            discoveryTime = discoveryWait(newIp)
+            if discoveryTime != None:
+                print " - device up in XMC after {:.0f}secs".format(discoveryTime)
+                deviceReAdded = True
+            else:
+                print " - device not up in XMC after {}secs".format(DiscoveryTimeout)
         print
+        if deviceReAdded or addRetries >= 2:
+            break
+        phaseReAdd(state)
+        addRetries += 1
 
-    # Try and re-open session against the new CLIP IP
-    print "Device is re-added to XMC; attempting to re-connect on new VLAN IP"
-    if not Sanity:
-        emc_cli.setIpAddress(newIp)
-
-    # Enter privExec
-    sendCLI_showCommand(CLI_Dict[Family]['enable_context'])
+def phaseConfirm(state): # v1 - Confirms the change over a CLI session on the new IP, now that XMC knows the device by it
+    # XMC resolves the device profile & credentials by IP, so the session to the new IP is only opened once the device is re-added
+    # Confirming disarms the deadman timer on the switch; the session is then kept open, to save the config
+    dc = deviceContext()
+    newIp = state['newIp']
+    if not cliSessionReconnect(newIp):
+        exitError("Unable to establish CLI session on new VLAN IP {} to confirm the change: {}".format(newIp, dc.lastError))
+    if not warpBuffer_confirm():
+        exitError("Unable to confirm the change on new VLAN IP {}: {}".format(newIp, dc.lastError))
+
+def phaseSave(state): # v1 - Saves the config over the CLI session to the new IP
+    dc = deviceContext()
+    newIp = state['newIp']
+    if dc.session and dc.session['ip'] != newIp: # Resumed run, launched on the old IP
+        if not cliSessionReconnect(newIp):
+            exitError("Unable to establish CLI session on new VLAN IP {}: {}".format(newIp, dc.lastError))
+    # Carry on over the session already open on the new VLAN IP; it is still in privExec
+    print "Device is re-added to XMC; continuing on CLI session to new VLAN IP"
+    cliContext('privExec')
 
     # Save the config
-    vossSaveConfigRetry(waitTime=10, retries=3)
+    vossSaveConfigRetry(waitTime=10, retries=3, site=state['sitePath'])
+
+MainPhases = [ # Phases of main(), each checkpointed to the journal once completed
+    ('validate',            phaseValidate),
+    ('push',                phasePush),
+    ('verify-reachability', phaseVerifyReachability),
+    ('delete-from-XMC',     phaseDeleteFromXmc),
+    ('delete-from-NAC',     phaseDeleteFromNac),
+    ('re-add',              phaseReAdd),
+    ('wait-discovery',      phaseWaitDiscovery),
+    ('confirm',             phaseConfirm),
+    ('save',                phaseSave),
+]
+
+def main():
+    dc = deviceContext()
+    print "{} version {} on XMC version {}".format(scriptName(), __version__, dc.vars["serverVersion"])
+    nbiAccess = nbiQuery(NBI_Query['nbiAccess'], returnKeyError=True)
+    if nbiAccess == None:
+        exitError('This XMC Script requires access to the GraphQl North Bound Interface (NBI). Make sure that XMC is running with an Advanced license and that your user profile is authorized for Northbound API.')
+
+    #
+    # Obtain Info on switch and from XMC
+    #
+    setFamily() # Sets device context family
+    if not dc.worker: # Single device run; with multiple devices, preflightCheck() refreshes them all at once
+        inventoryRefresh([dc.vars])
+
+    # An earlier run which got interrupted resumes after the last phase it completed
+    journalRecord = journalEntry(dc.vars)
+    if journalRecord and journalRecord['phase'] == 'done':
+        print "Device {} was already completed by an earlier run of this batch".format(journalRecord['deviceIP'])
+        return
+    if journalRecord:
+        state = journalRecord['state']
+        if dc.vars["deviceIP"] != journalRecord['deviceIP']: # Launched on new IP; journal is kept under the old IP
+            dc.vars = dict(dc.vars)
+            dc.vars["deviceIP"] = journalRecord['deviceIP']
+        print "Resuming interrupted run of device {} after phase '{}'".format(state['currentIp'], journalRecord['phase'])
+        phaseNames = [x[0] for x in MainPhases]
+        phaseIndex = phaseNames.index(journalRecord['phase'])
+        # Until the change is confirmed, the switch reverts it by itself, or already did
+        dc.deadmanArmed = phaseNames.index('push') <= phaseIndex < phaseNames.index('confirm')
+        phaseList = MainPhases[phaseIndex + 1:]
+    else:
+        state = {
+            'currentIp'   : dc.vars["deviceIP"],
+            'newIp'       : dc.vars["userInput_ip"].strip(),
+            'newSysName'  : dc.vars["userInput_sysname"].strip(),
+            'newVlanID'   : dc.vars["userInput_vid"].strip(),
+            'newVlanISID' : dc.vars["userInput_isid"].strip(),
+            'newVlanDGW'  : dc.vars["userInput_dgw"].strip(),
+            'snmpLoc'     : dc.vars["userInput_snmpLoc"].strip(),
+            'subnet'      : dc.vars["userInput_subnet"].strip(),
+        }
+        phaseList = MainPhases
+    
+    print "Information provided by User:"
+    print " - New VLAN IP = {}".format(state['newIp'])
+    print " - Subnetmask = {}".format(state['subnet'])
+    print " - New VLAN ID = {}".format(state['newVlanID'])
+    print " - New VLAN I-SID = {}".format(state['newVlanISID'])
+    print " - New VLAN Gateway = {}".format(state['newVlanDGW'])
+    print " - New System Name = {}".format(state['newSysName'])
+    print " - SNMP Location = {}".format(state['snmpLoc'])
+    
+
+    vossVersion = dc.vars["deviceSoftwareVer"]
+
+    print "Switch information:"
+    print " - VOSS software version = {}".format(vossVersion)
+    print
+
+    for phase, phaseFunc in phaseList:
+        dc.phase = phase
+        dc.phaseStart = time.time()
+        try:
+            phaseFunc(state)
+        except RuntimeError as e:
+            if dc.deadmanArmed: # Switch reverts the unconfirmed change by itself; wait for that and put XMC back as it was
+                deadmanRevert(state, str(e))
+            raise
+        dc.phaseTimes.append((phase, time.time() - dc.phaseStart))
+        if phase != MainPhases[-1][0]:
+            journalCheckpoint(phase, state)
+    journalDone()
 
     # Print summary of config performed
     printConfigSummary()
-    print "Deleted IP '{}' from XMC's database".format(currentIp)
-    if switchNacExists:
-        print "Deleted IP '{}' in NAC Engine Group".format(currentIp)
-    print "Added new device IP '{}' to XMC Site '{}' with admin profile '{}'".format(newIp, sitePath, adminProfile)
-
-main()
+    print "Deleted IP '{}' from XMC's database".format(state['currentIp'])
+    if state.get('switchNacExists'):
+        print "Deleted IP '{}' in NAC Engine Group".format(state['currentIp'])
+    print "Added new device IP '{}' to XMC Site '{}' with admin profile '{}'".format(state['newIp'], state['sitePath'], state['adminProfile'])
+
+if execution == 'xmc' or __name__ == '__main__': # Not when loaded as module by the dev tools in tests/
+    if len(EmcVarsList) == 1 or preflightCheck(EmcVarsList): # Multiple devices are all checked before any is touched
+        threadPoolRun(EmcVarsList, main)
@@ -0,0 +1,588 @@
+#!/usr/bin/env python
+#
+# Dev tools for change-mgmt-vlan.py: benchmarks and record / replay of runs, without a lab
+# Runs locally (not on XMC), against own local replicas of emc_cli, emc_nbi & emc_results in the current directory if any,
+# else against the simulated switch & XMC of the replicas in tests/replicas
+#
+# Usage: python tests/change_mgmt_vlan_dev.py <emc_vars.json> benchmark [<name> ...]
+#        python tests/change_mgmt_vlan_dev.py <emc_vars.json> record <file>
+#        python tests/change_mgmt_vlan_dev.py <emc_vars.json> replay <file> [<number of devices>]
+#        python tests/change_mgmt_vlan_dev.py <emc_vars.json> preflight
+#
+import sys
+import os
+import re
+import json
+import time
+import threading
+import imp                          # Used by loadScript
+import tempfile                     # Used by loadScript & replayInstall
+ScriptFile = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'change-mgmt-vlan.py')
+ReplicaDir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'replicas')
+Script = None # The script, loaded as module by loadScript()
+
+def loadScript(emcVars): # v2 - Loads the script as module, without running it; emcVars is the path of an emc_vars json file, or a list of emc_vars dicts
+    global Script
+    if not isinstance(emcVars, basestring): # Script reads its emc_vars from the json file given as 1st argv
+        emcVarsFile = os.path.join(tempfile.mkdtemp(), 'emc_vars.json')
+        with open(emcVarsFile, 'w') as f:
+            json.dump(emcVars, f)
+        emcVars = emcVarsFile
+    for replicaDir in (ReplicaDir, os.getcwd()): # Where the local replicas are; own ones in the current directory come first
+        if replicaDir in sys.path:
+            sys.path.remove(replicaDir)
+        sys.path.insert(0, replicaDir)
+    sys.modules.pop('change_mgmt_vlan', None) # Loaded afresh; reloading into the same module would keep emc_vars, as if running on XMC
+    argv = sys.argv
+    sys.argv = [ScriptFile, emcVars]
+    try:
+        Script = imp.load_source('change_mgmt_vlan', ScriptFile)
+    finally:
+        sys.argv = argv
+    return Script
+
+#
+# Benchmarks: change_mgmt_vlan_dev.py <emc_vars.json> benchmark [<name> ...]
+# Run against the local emc_cli/emc_nbi replicas, over all devices in the emc_vars json list
+#
+def benchmarkNbiBatch(): # v2 - NBI round-trips to get pre-change device facts of all devices: one query per fact vs batched; returns both counts
+    ipList = [(x["deviceIP"], x["userInput_ip"].strip()) for x in Script.EmcVarsList]
+    Script.NbiCache.clear() # Both passes must query XMC, not the cache
+    startCount, startTime = Script.NbiRoundTrips, time.time()
+    for currentIp, newIp in ipList:
+        Script.nbiQuery(Script.NBI_Query['checkSwitchXmcDb'], IP=newIp)
+        Script.nbiQuery(Script.NBI_Query['getSitePath'], IP=currentIp)
+        Script.nbiQuery(Script.NBI_Query['getDeviceAdminProfile'], IP=currentIp)
+    perFactCount = Script.NbiRoundTrips - startCount
+    print " - one query per fact : {} round-trips in {:.3f} secs".format(perFactCount, time.time() - startTime)
+    queryList = []
+    for index, (currentIp, newIp) in enumerate(ipList):
+        queryList.append(('checkNewIpInXmc{}'.format(index), Script.NBI_Query['checkSwitchXmcDb'],      {'IP': newIp}))
+        queryList.append(('sitePath{}'.format(index),        Script.NBI_Query['getSitePath'],           {'IP': currentIp}))
+        queryList.append(('adminProfile{}'.format(index),    Script.NBI_Query['getDeviceAdminProfile'], {'IP': currentIp}))
+    Script.NbiCache.clear()
+    startCount, startTime = Script.NbiRoundTrips, time.time()
+    Script.nbiBatchQuery(queryList)
+    batchedCount = Script.NbiRoundTrips - startCount
+    print " - batched            : {} round-trips in {:.3f} secs".format(batchedCount, time.time() - startTime)
+    return perFactCount, batchedCount
+
+BenchmarkCorpus = { # Recorded VOSS outputs (as returned by emc_cli, with echoed command and prompt)
+    'show mgmt ip': '''show mgmt ip
+================================================================================
+                                Mgmt IP Information
+================================================================================
+Inst  Form           Ip Address                   Origin      Status
+--------------------------------------------------------------------------------
+1     vlan           10.8.255.101/24              MANUAL      ACTIVE
+2     clip           10.8.0.101/32                MANUAL      ACTIVE
+VSP-8284XSQ:1#''',
+    'show dvr': '''show dvr
+================================================================================
+                                DVR Summary Info
+================================================================================
+Domain ID                : 1
+Domain ISID              : 16678216
+Role                     : Leaf
+My SYS ID                : 82:bb:00:00:11:84
+Operational State        : Up
+Inband Mgmt IP           : 10.8.0.101
+VSP-8284XSQ:1#''',
+    'show ip vrf': '''show ip vrf
+================================================================================
+                                  VRF INFORMATION
+================================================================================
+                        VRF      VRF     VLAN    ArpThresh   Max
+VRF NAME               ID       COUNT   COUNT               Routes
+--------------------------------------------------------------------------------
+GlobalRouter           0        2       0       500         0
+MgmtRouter             512      1       0       500         0
+blue                   1        3       0       500         0
+red                    2        1       0       500         0
+All 4 out of 4 Total Num of VRF Entries displayed.
+VSP-8284XSQ:1#''',
+    'show isis spbm': '''show isis spbm
+================================================================================
+                                ISIS SPBM Info
+================================================================================
+SPBM         B-VID    PRIMARY   NICK     LSDB   IP    IPV6   MULTICAST
+INSTANCE              VLAN      NAME     TRAP
+--------------------------------------------------------------------------------
+1            4051-4052    4051  0.00.75  disable enable  disable disable
+--------------------------------------------------------------------------------
+SPBM         SMLT-SPLIT-BEB   SMLT-VIRTUAL-BMAC    SMLT-PEER-SYSTEM-ID
+INSTANCE
+--------------------------------------------------------------------------------
+1            primary          00:00:00:00:00:00
+VSP-8284XSQ:1#''',
+}
+
+def benchmarkCliSpec(iterations=2000): # v1 - Regex extraction over the recorded VOSS outputs: parse & findall each time vs compiled CliSpec
+    cmdRegexList = [
+        Script.CLI_Dict['VSP Series']['get_mgmt_ip_mask'].template.format('10.8.255.101'),
+        Script.CLI_Dict['VSP Series']['list_mgmt_ips'].template,
+        Script.CLI_Dict['VSP Series']['get_dvr_type'].template,
+        Script.CLI_Dict['VSP Series']['check_vrf_exists'].template.format('blue'),
+        'list://show isis spbm||(?:(B-VID) +PRIMARY +(NICK) +LSDB +(IP)(?: +(IPV6))?(?: +(MULTICAST))?|^\d+ +(?:(\d+)-(\d+) +\d+ +)?(?:([\da-f]\.[\da-f]{2}\.[\da-f]{2}) +)?(?:disable|enable) +(disable|enable)(?: +(disable|enable))?(?: +(disable|enable))?|^\d+ +(?:primary|secondary) +([\da-f:]+)(?: +([\da-f\.]+))?)',
+    ]
+    outputDict = dict((x, Script.cleanOutput(y)) for x, y in BenchmarkCorpus.items())
+    startTime = time.time()
+    for _ in xrange(iterations):
+        for cmdRegexStr in cmdRegexList:
+            mode, cmdList, regex = Script.parseRegexInput(cmdRegexStr)
+            Script.formatOutputData(re.findall(regex, outputDict[cmdList[0]], re.MULTILINE), mode)
+    print " - parsed on every call : {:.3f} secs".format(time.time() - startTime)
+    specList = [Script.cliSpec(x) for x in cmdRegexList]
+    startTime = time.time()
+    for _ in xrange(iterations):
+        for spec in specList:
+            Script.formatOutputData(spec.regexObj.findall(outputDict[spec.cmdList[0]]), spec.mode)
+    print " - compiled CliSpec     : {:.3f} secs".format(time.time() - startTime)
+
+def refIpToNumber(dottedDecimalStr): # v1 - ipToNumber() as it was before the IPv4 toolkit; per-address path benchmarkIpv4 compares against
+    try: # bytearray ensures that IP bytes are valid (1-255)
+        ipByte = list(bytearray([int(byte) for byte in dottedDecimalStr.split('.')]))
+    except:
+        return None
+    if len(ipByte) != 4:
+        return None
+    Script.debug("ipByte = {}".format(ipByte))
+    ipNumber = (ipByte[0]<<24) + (ipByte[1]<<16) + (ipByte[2]<<8) + ipByte[3]
+    Script.debug("dottedDecimalStr {} = ipNumber {}".format(dottedDecimalStr, hex(ipNumber)))
+    return ipNumber
+
+def refNumberToIp(ipNumber): # v1 - numberToIp() as it was before the IPv4 toolkit
+    dottedDecimalStr = '.'.join( [ str(ipNumber >> (i<<3) & 0xFF) for i in range(4)[::-1] ] )
+    Script.debug("ipNumber {} = dottedDecimalStr {}".format(hex(ipNumber), dottedDecimalStr))
+    return dottedDecimalStr
+
+def refMaskToNumber(mask): # v1 - maskToNumber() as it was before the IPv4 toolkit
+    if isinstance(mask, int) or re.match(r'^\d+$', mask): # Mask as number
+        if int(mask) > 0 and int(mask) <= 32:
+            maskNumber = (2**32-1) ^ (2**(32-int(mask))-1)
+        else:
+            maskNumber = None
+    else:
+        maskNumber = refIpToNumber(mask)
+    if maskNumber:
+        Script.debug("maskNumber = {}".format(hex(maskNumber)))
+    return maskNumber
+
+def refSubnetMask(ip, mask): # v1 - subnetMask() as it was before the IPv4 toolkit
+    ipNumber = refIpToNumber(ip)
+    maskNumber = refMaskToNumber(mask)
+    subnetNumber = ipNumber & maskNumber
+    ipSubnet = refNumberToIp(subnetNumber)
+    ipDottedMask = refNumberToIp(maskNumber)
+    ipCidrMask = bin(maskNumber).count('1')
+    Script.debug("ipSubnet = {} / ipDottedMask = {} / ipCidrMask = {}".format(ipSubnet, ipDottedMask, ipCidrMask))
+    return ipSubnet, ipDottedMask, ipCidrMask
+
+def benchmarkIpv4(subnetCount=500, ipCount=5000): # v2 - IPv4 toolkit vs the per-address functions it replaced (ref*), asserting both give the same results
+    subnetList = [("10.{}.{}.0".format(x // 256, x % 256), '24') for x in range(subnetCount)]
+    ipList = ["10.{}.{}.{}".format(x % (subnetCount // 256 + 1), x % 256, x % 254 + 1) for x in range(ipCount)]
+    maskList = [str(x) for x in range(33)] + [Script.numberToIp(Script.MaskNumbers[x]) for x in range(1, 33)] + [x for x in range(1, 33)]
+    badList = ['10.0.0', '10.0.0.256', '10.0.0.-1', '10.0.0.1.1', 'a.b.c.d', '']
+
+    # Per address conversions, as used all over the script
+    for name, refFunc, func, argsList in [
+        ('ipToNumber()  ', refIpToNumber,  Script.ipToNumber,   [(x,) for x in ipList + badList]),
+        ('numberToIp()  ', refNumberToIp,  Script.numberToIp,   [(refIpToNumber(x),) for x in ipList]),
+        ('maskToNumber()', refMaskToNumber, Script.maskToNumber, [(x,) for x in maskList]),
+        ('subnetMask()  ', refSubnetMask,  Script.subnetMask,   [(x, y) for x in ipList for y in ('24', '255.255.0.0', 30)]),
+        ]:
+        startTime = time.time()
+        refResult = [refFunc(*x) for x in argsList]
+        refTime = time.time() - startTime
+        startTime = time.time()
+        result = [func(*x) for x in argsList]
+        print " - {} x {:<6}: {:.3f} secs before, {:.3f} secs now".format(name, len(argsList), refTime, time.time() - startTime)
+        assert result == refResult, "{} results differ from those before the IPv4 toolkit".format(name.strip())
+
+    # Which of many subnets do many IPs fall in
+    startTime = time.time()
+    naiveResult = []
+    for ip in ipList:
+        match = None
+        for subnet, mask in subnetList:
+            if refSubnetMask(ip, mask)[0] == subnet:
+                match = (subnet, mask)
+                break
+        naiveResult.append(match)
+    print " - subnet lookup, subnetMask() per IP & subnet : {:.3f} secs".format(time.time() - startTime)
+    startTime = time.time()
+    indexResult = Script.SubnetIndex(subnetList).lookupMany(ipList)
+    print " - subnet lookup, SubnetIndex                  : {:.3f} secs".format(time.time() - startTime)
+    assert indexResult == naiveResult, "SubnetIndex results differ from subnetMask() per IP & subnet"
+
+def benchmarkConfigChain(vlanCount=5000, iterations=5): # v1 - Splitting a 10k command config chain: regex mask/split/unmask vs single pass configChain(), and ChainTemplate rendering
+    chainStr = "\n".join("vlan create {0} name V{0} type port-mstprstp 0\nvlan i-sid {0} {1}".format(x + 2, x + 20000) for x in range(vlanCount))
+    chainStr += "\nno spanning-tree mstp msti 1\ny;vlan members remove 1 1/1-1/48 portmember\ny"
+    startTime = time.time()
+    for _ in xrange(iterations):
+        maskedStr = re.sub(r'\n(\w)(\n|\s*;|$)', chr(0) + r'\1\2', chainStr)
+        regexResult = [re.sub(r'\x00(\w)(\n|$)', r'\n\1\2', x) for x in filter(None, map(str.strip, re.split(r'[;\n]', maskedStr)))]
+    print " - regex mask/split/unmask : {:.3f} secs".format(time.time() - startTime)
+    startTime = time.time()
+    for _ in xrange(iterations):
+        chainResult = Script.configChain(chainStr)
+    print " - single pass configChain : {:.3f} secs".format(time.time() - startTime)
+    if chainResult != regexResult:
+        print " - results differ!"
+    template = Script.CLI_Dict['VSP Series']['change_mgmt_vlan']
+    argsList = [(x + 2, x + 20000, '10.8.{}.{}'.format(x // 250, x % 250 + 1), '24', '10.8.0.1') for x in range(vlanCount // 5)]
+    startTime = time.time()
+    for args in argsList:
+        Script.configChain(template.template.format(*args))
+    print " - template format & split : {:.3f} secs".format(time.time() - startTime)
+    startTime = time.time()
+    for args in argsList:
+        template.format(*args)
+    print " - ChainTemplate rendering : {:.3f} secs".format(time.time() - startTime)
+
+def benchmarkReplay(deviceCounts=(1, 10, 500)): # v1 - End-to-end runs of main() replayed from ReplayFile recording, over 1, 10 & 500 devices
+    if not os.path.exists(ReplayFile):
+        print " - no recording in {}; make one with: <script> <emc_vars.json> record {}".format(ReplayFile, ReplayFile)
+        return
+    recording = json.load(open(ReplayFile))
+    nullOutput = open(os.devnull, 'w')
+    for count in deviceCounts:
+        replayReset()
+        replay = Replay(recording, count)
+        replayInstall(replay)
+        stdout, sys.stdout = sys.stdout, nullOutput # Silence the device runs
+        startTime = time.time()
+        try:
+            results = Script.threadPoolRun(replay.deviceVarsList, Script.main, sessionFactory=replay.cliSession)
+        finally:
+            sys.stdout = stdout
+        elapsed = time.time() - startTime
+        failed = len([x for x in results if x['status'] != 'SUCCESS'])
+        print " - {:>4} devices: {:7.2f} secs end-to-end, {} failed, {} NBI round-trips".format(count, elapsed, failed, Script.NbiRoundTrips)
+        summary = Script.timingSummary()
+        for phase in sorted(summary.keys()):
+            print "   - {:<16} total {:8.2f}s  p50 {:7.3f}s  p95 {:7.3f}s".format(phase, summary[phase]['total'], summary[phase]['p50'], summary[phase]['p95'])
+
+Benchmarks = {
+    'nbi-batch'   : benchmarkNbiBatch,
+    'cli-spec'    : benchmarkCliSpec,
+    'config-chain': benchmarkConfigChain,
+    'ipv4'        : benchmarkIpv4,
+    'replay'      : benchmarkReplay,
+}
+
+def runBenchmarks(nameList): # v1 - Runs the named benchmarks, or all of them
+    for name in nameList or sorted(Benchmarks.keys()):
+        print "Benchmark {} over {} devices:".format(name, len(Script.EmcVarsList))
+        Script.deviceContextInit(Script.emc_cli, Script.emc_vars)
+        Script.setFamily()
+        Benchmarks[name]()
+        print
+
+#
+# Record / replay: change_mgmt_vlan_dev.py <emc_vars.json> record <file> | replay <file> [<number of devices>]
+# Records the CLI transcripts & NBI responses of a run, then replays them against any number of simulated devices, without a lab
+#
+import random                       # Used by Replay
+ReplayFile = 'replay.json' # Recording used by the replay benchmark
+ReplayLatency = {'cli': 0.05, 'nbi': 0.1} # Simulated secs per CLI command / NBI query
+ReplayFailures = { # Failure injection
+    'cliTimeout' : 0.0, # Probability of any CLI command timing out
+    'saveBusy'   : 0,   # Number of save config attempts per device answered with "Another show or save in progress"
+    'addFailure' : 0,   # Number of create_device per device which XIQ-SE accepts, but never discovers
+}
+ReplayCliTimeout = "Error: session exceeded timeout: 30 secs"
+ReplaySaveBusy = "Another show or save in progress.  Please try the command later."
+RecordTranscripts = {} # Device IP: list of [cmd, success, output, error]
+RecordNbiFields = []   # List of [rootField, field text, response]
+RecordLock = threading.Lock()
+
+def nbiQueryTokens(text): # v1 - Splits GraphQl text into its top level tokens: names, ':' and whole (...) / {...} groups
+    tokens = []
+    index = 0
+    while index < len(text):
+        char = text[index]
+        if char in '({':
+            start, depth = index, 0
+            while True:
+                char = text[index]
+                if char == '"':
+                    index = text.index('"', index + 1)
+                elif char in '({':
+                    depth += 1
+                elif char in ')}':
+                    depth -= 1
+                    if depth == 0:
+                        break
+                index += 1
+            tokens.append(text[start:index + 1])
+        elif char == ':':
+            tokens.append(char)
+        elif re.match(r'\w', char):
+            nameMatch = Script.regexCompile(r'\w+', 0).match(text, index)
+            tokens.append(nameMatch.group(0))
+            index = nameMatch.end() - 1
+        index += 1
+    return tokens
+
+def nbiQueryFields(jsonQuery): # v1 - Returns list of (rootField, alias, field text without alias) for every field under the root fields of a GraphQl query
+    tokens = nbiQueryTokens(re.sub(r'^\s*mutation\s*', '', jsonQuery.strip())[1:-1]) # Strip mutation keyword & outer braces
+    fieldList = []
+    for index in range(len(tokens) - 1):
+        if tokens[index + 1][0] != '{' or not re.match(r'\w', tokens[index]):
+            continue
+        fieldTokens = nbiQueryTokens(tokens[index + 1][1:-1])
+        position = 0
+        while position < len(fieldTokens):
+            alias = None
+            if fieldTokens[position + 1:position + 2] == [':']:
+                alias = fieldTokens[position]
+                position += 2
+            parts = [fieldTokens[position]]
+            position += 1
+            while position < len(fieldTokens) and fieldTokens[position][0] in '({':
+                parts.append(" ".join(fieldTokens[position].split()))
+                position += 1
+            fieldList.append((tokens[index], alias, "".join(parts)))
+    return fieldList
+
+def jsonable(obj): # v1 - Converts NBI responses (Java LinkedHashMap & lists on XMC) into plain dicts & lists
+    if isinstance(obj, (dict, Script.LinkedHashMap)):
+        return dict((x, jsonable(y)) for x, y in obj.items())
+    if isinstance(obj, (list, tuple)) or (hasattr(obj, 'iterator') and not isinstance(obj, basestring)):
+        return [jsonable(x) for x in obj]
+    return obj
+
+def ipSubstitute(text, ipMap): # v1 - Replaces IPs in text as per ipMap of IP: new IP; also in underscored form, as in warp TFTP file names
+    if not ipMap or not text:
+        return text
+    regex = Script.regexCompile(r'(?<!\d)(?<!\d\.)(' + "|".join(sorted([re.escape(x) for x in ipMap] + [re.escape(x.replace('.', '_')) for x in ipMap], key=len, reverse=True)) + r')(?![\d])', 0)
+    return regex.sub(lambda x: ipMap[x.group(1)] if x.group(1) in ipMap else ipMap[x.group(1).replace('_', '.')].replace('.', '_'), text)
+
+class RecordingCliSession(object): # v1 - Wraps an emc_cli session, recording the transcript of all commands sent
+    def __init__(self, cli, deviceIp):
+        self.cli = cli
+        with RecordLock:
+            self.transcript = RecordTranscripts.setdefault(deviceIp, [])
+
+    def send(self, cmd, waitForPrompt=True):
+        resultObj = self.cli.send(cmd, waitForPrompt)
+        success = bool(resultObj.isSuccess())
+        self.transcript.append([cmd, success, resultObj.getOutput() if success else None, None if success else resultObj.getError()])
+        return resultObj
+
+    def setIpAddress(self, ip):
+        self.cli.setIpAddress(ip)
+
+    def close(self):
+        self.cli.close()
+
+class RecordingNbi(object): # v1 - Wraps emc_nbi, recording the response of every field queried
+    def __init__(self, nbi):
+        self.nbi = nbi
+
+    def query(self, jsonQuery):
+        response = self.nbi.query(jsonQuery)
+        if 'errors' not in response:
+            with RecordLock:
+                for rootField, alias, fieldText in nbiQueryFields(jsonQuery):
+                    fieldName = alias or re.match(r'\w+', fieldText).group(0)
+                    RecordNbiFields.append([rootField, fieldText, jsonable(response[rootField][fieldName])])
+        return response
+
+def recordInstall(): # v2 - Makes the script's run record its CLI & NBI exchanges
+    Script.emc_cli = RecordingCliSession(Script.emc_cli, Script.emc_vars["deviceIP"])
+    Script.emc_nbi = RecordingNbi(Script.emc_nbi)
+    if Script.CliSessionFactory:
+        factory = Script.CliSessionFactory
+        Script.CliSessionFactory = lambda deviceIp: RecordingCliSession(factory(deviceIp), deviceIp)
+
+def recordSave(fileName): # v1 - Saves recorded CLI & NBI exchanges
+    deviceVarsDict = dict((x["deviceIP"], x) for x in Script.EmcVarsList)
+    recording = {
+        'devices': dict((x, {'vars': deviceVarsDict[x], 'cli': y}) for x, y in RecordTranscripts.items() if x in deviceVarsDict),
+        'nbi'    : RecordNbiFields,
+    }
+    with open(fileName, 'w') as f:
+        json.dump(recording, f, indent=1)
+    print "Recorded {} devices and {} NBI fields into {}".format(len(recording['devices']), len(RecordNbiFields), fileName)
+
+class ReplayCliResult(object): # v1 - Same interface as emc_cli.send() results
+    def __init__(self, success, output=None, error=None):
+        self.success, self.output, self.error = success, output, error
+    def isSuccess(self):
+        return self.success
+    def getOutput(self):
+        return self.output
+    def getError(self):
+        return self.error
+
+class ReplayCliSession(object): # v2 - emc_cli like session answering from a recorded transcript; unknown commands get an empty output
+    # Pipelined show commands are also answered one by one, and pipelines not in the transcript from the answers of each of their
+    # commands, as the script pipelines different commands depending on what it already has memoized or in inventory
+    def __init__(self, replay, template, ipMap):
+        self.replay, self.ipMap = replay, ipMap
+        self.answers = {}
+        for cmd, success, output, error in template['cli']:
+            cmd, output = ipSubstitute(cmd, ipMap), ipSubstitute(output, ipMap)
+            self.answers.setdefault(cmd, []).append((success, output, error))
+            cmdList = cmd.split('\n')
+            segments = Script.cliOutputSplit(output, cmdList) if success and len(cmdList) > 1 else None
+            for pipelinedCmd, segment in zip(cmdList, segments or []):
+                lines = segment.split('\n')
+                self.answers.setdefault(pipelinedCmd, []).append((True, "\n".join([pipelinedCmd] + lines[1:]), None)) # Echoed after the prompt in a pipeline
+        self.prompt = next((x[2].splitlines()[-1] for x in template['cli'] if x[1] and x[2] and Script.RegexPrompt.match(x[2].splitlines()[-1])), 'VSP:1#')
+        self.saveBusy = ReplayFailures['saveBusy']
+
+    def send(self, cmd, waitForPrompt=True):
+        time.sleep(ReplayLatency['cli'])
+        if random.random() < ReplayFailures['cliTimeout']:
+            return ReplayCliResult(False, error=ReplayCliTimeout)
+        if cmd.startswith('source .script.src'): # Device moves to its new IP
+            self.replay.deviceMoved(self.ipMap)
+        if cmd == 'save config' and self.saveBusy > 0:
+            self.saveBusy -= 1
+            return ReplayCliResult(True, "{}\n{}\n{}".format(cmd, ReplaySaveBusy, self.prompt))
+        if cmd not in self.answers and '\n' in cmd: # Pipeline not in transcript
+            resultList = [self.answer(x) for x in cmd.split('\n')]
+            failed = [x for x in resultList if not x.isSuccess()]
+            return failed[0] if failed else ReplayCliResult(True, "".join([x.getOutput() for x in resultList])) # Next echo follows the prompt
+        return self.answer(cmd)
+
+    def answer(self, cmd):
+        answers = self.answers.get(cmd)
+        if not answers:
+            return ReplayCliResult(True, "{}\n{}".format(cmd, self.prompt))
+        success, output, error = answers.pop(0) if len(answers) > 1 else answers[0]
+        return ReplayCliResult(success, output, error)
+
+    def setIpAddress(self, ip):
+        pass
+
+    def close(self):
+        pass
+
+class Replay(object): # v1 - Replays a recording over deviceCount simulated devices; acts as emc_nbi, CLI session factory and reachability probe
+    def __init__(self, recording, deviceCount):
+        templateList = sorted(recording['devices'].values(), key=lambda x: x['vars']["deviceIP"])
+        self.lock = threading.Lock()
+        self.deviceVarsList = []
+        self.sessions = {}  # Current IP: (template, ipMap)
+        self.live = set()   # IPs which reply to reachability probes
+        self.lost = {}      # New IP: number of create_device left which XIQ-SE will drop
+        self.fields = {}    # Root field + field text: list of responses, consumed in order (last one repeats)
+        templateIps = set()
+        for index in range(deviceCount):
+            template = templateList[index % len(templateList)]
+            templateVars = template['vars']
+            deviceVars = dict(templateVars) # Simulated devices get their own IPs, in the benchmarking ranges
+            deviceVars["deviceIP"]         = Script.numberToIp(Script.ipParse('198.18.0.0') + index + 1)
+            deviceVars["userInput_ip"]     = "198.19.{}.{}".format(index // 250, index % 250 + 1)
+            deviceVars["userInput_dgw"]    = "198.19.{}.254".format(index // 250)
+            deviceVars["userInput_subnet"] = '24'
+            ipMap = {
+                templateVars["deviceIP"]                  : deviceVars["deviceIP"],
+                templateVars["userInput_ip"].strip()      : deviceVars["userInput_ip"],
+                templateVars["userInput_dgw"].strip()     : deviceVars["userInput_dgw"],
+            }
+            templateIps.update(ipMap.keys())
+            self.deviceVarsList.append(deviceVars)
+            self.sessions[deviceVars["deviceIP"]] = (template, ipMap)
+            self.live.add(deviceVars["deviceIP"])
+            self.lost[deviceVars["userInput_ip"]] = ReplayFailures['addFailure']
+            for rootField, fieldText, response in recording['nbi']:
+                if ipSubstitute(fieldText, ipMap) != fieldText: # Field of this device
+                    key = rootField + ' ' + ipSubstitute(fieldText, ipMap)
+                    self.fields.setdefault(key, []).append(json.loads(ipSubstitute(json.dumps(response), ipMap)))
+        for rootField, fieldText, response in recording['nbi']: # Fields common to all devices
+            if ipSubstitute(fieldText, dict((x, '-') for x in templateIps)) == fieldText:
+                self.fields.setdefault(rootField + ' ' + fieldText, []).append(response)
+
+    def cliSession(self, deviceIp): # CliSessionFactory
+        template, ipMap = self.sessions[deviceIp]
+        return ReplayCliSession(self, template, ipMap)
+
+    def deviceMoved(self, ipMap):
+        currentIp = [x for x in self.sessions if self.sessions[x][1] is ipMap][0]
+        with self.lock:
+            self.live.discard(currentIp)
+            self.live.add([x for x in self.deviceVarsList if x["deviceIP"] == currentIp][0]["userInput_ip"])
+
+    def probe(self, ipList, deadline=10, **kwargs): # reachabilityProbe
+        with self.lock:
+            return dict((x, ReplayLatency['cli'] if x in self.live else None) for x in ipList)
+
+    def query(self, jsonQuery): # emc_nbi.query
+        time.sleep(ReplayLatency['nbi'])
+        response = {}
+        with self.lock:
+            for rootField, alias, fieldText in nbiQueryFields(jsonQuery):
+                fieldName = alias or re.match(r'\w+', fieldText).group(0)
+                ipMatch = re.search(r'(?:ip|ipAddress)\s*:\s*"([\d.]+)"', fieldText)
+                ip = ipMatch.group(1) if ipMatch else None
+                if fieldText.startswith('createDevices') and self.lost.get(ip, 0) > 0:
+                    self.lost[ip] = -self.lost[ip] # XIQ-SE accepts it, but the device never comes up
+                    value = {'status': 'SUCCESS', 'message': None}
+                elif fieldText.startswith('createDevices') and self.lost.get(ip, 0) < 0:
+                    self.lost[ip] = -self.lost[ip] - 1
+                    value = self.fieldAnswer(rootField, fieldText)
+                elif fieldText.startswith('device(') and self.lost.get(ip, 0) < 0:
+                    value = None
+                else:
+                    value = self.fieldAnswer(rootField, fieldText)
+                response.setdefault(rootField, {})[fieldName] = value
+        return response
+
+    def fieldAnswer(self, rootField, fieldText):
+        answers = self.fields.get(rootField + ' ' + fieldText)
+        if not answers:
+            Script.debug("Replay: no recorded answer for {} {}".format(rootField, fieldText))
+            return None
+        return answers.pop(0) if len(answers) > 1 else answers[0]
+
+def replayReset(): # v6 - Clears the script's run wide state (caches, timings, counters, journal, inventory), so that successive replays start afresh
+    Script.NbiRoundTrips = 0
+    Script.NbiCache.clear()
+    Script.NbiCacheStats.update((x, 0) for x in Script.NbiCacheStats)
+    Script.CliMemoStats.update((x, 0) for x in Script.CliMemoStats)
+    Script.NacLocationIndexBuilt[0] = False
+    Script.CliSessions.clear()
+    del Script.TimingSpans[:]
+    del Script.DiscoveryTimes[:]
+    Script.JournalEntries.clear()
+    Script.JournalLoaded[0] = False
+    Script.JournalBatch[0] = None
+    Script.InventoryRecords.clear()
+    Script.InventoryLoaded[0] = False
+    Script.InventoryChanged.clear()
+
+def replayInstall(replay): # v4 - Points NBI, CLI sessions, reachability probes, TFTP root & journal of the script's run at a Replay
+    Script.emc_nbi = replay
+    Script.CliSessionFactory = replay.cliSession
+    Script.reachabilityProbe = Script.timed('wait.probe')(replay.probe)
+    if Script.XmcTftpRoot == '/tftpboot':
+        Script.XmcTftpRoot = tempfile.mkdtemp()
+    if Script.JournalDir:
+        Script.JournalDir = tempfile.mkdtemp() # Each replay is a batch of its own, with nothing to resume
+    Script.InventoryDir = None # Recordings hold the exchanges of the change itself, not those reading device facts
+
+if __name__ == '__main__':
+    loadScript(sys.argv[1] if sys.argv[1:] else 'emc_vars.json')
+    if sys.argv[2:3] == ['benchmark']:
+        runBenchmarks(sys.argv[3:])
+    elif sys.argv[2:3] == ['record']:
+        recordInstall()
+        try:
+            if len(Script.EmcVarsList) == 1 or Script.preflightCheck(Script.EmcVarsList):
+                Script.threadPoolRun(Script.EmcVarsList, Script.main)
+        finally:
+            recordSave(sys.argv[3])
+    elif sys.argv[2:3] == ['replay']:
+        replay = Replay(json.load(open(sys.argv[3])), int(sys.argv[4]) if sys.argv[4:] else 1)
+        replayInstall(replay)
+        if len(replay.deviceVarsList) == 1 or Script.preflightCheck(replay.deviceVarsList):
+            Script.threadPoolRun(replay.deviceVarsList, Script.main)
+    elif sys.argv[2:3] == ['preflight']:
+        Script.preflightCheck(Script.EmcVarsList)
+    else:
+        print "Usage: {} <emc_vars.json> benchmark [<name> ...] | record <file> | replay <file> [<number of devices>] | preflight".format(sys.argv[0])
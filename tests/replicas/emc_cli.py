@@ -0,0 +1,193 @@
+#
+# Local replica of XMC's emc_cli, for change_mgmt_vlan_dev.py & the tests
+# Simulates a VSP switch: canned show outputs, a /intflash file system fed by TFTP from TftpRoot, and sourced scripts
+#
+import re
+import time
+import threading
+
+Show = { # Canned outputs of show commands, as returned by emc_cli (with echoed command and prompt); {ip} is the switch's IP
+    'show mgmt ip': '''show mgmt ip
+================================================================================
+                                Mgmt IP Information
+================================================================================
+Inst  Form           Ip Address                   Origin      Status
+--------------------------------------------------------------------------------
+2     vlan           {ip}/24                     MANUAL      ACTIVE
+VSP-8284:1#''',
+    'show dvr': '''show dvr
+Role                     : Leaf
+VSP:1#''',
+    'show boot config flags': '''show boot config flags
+flags tftpd false
+VSP:1#''',
+    'show isis spbm': '''show isis spbm
+================================================================================
+                                ISIS SPBM Info
+================================================================================
+SPBM        B-VID    PRIMARY   NICK     LSDB    IP        IPV6      MULTICAST
+INSTANCE             VLAN      NAME     TRAP
+--------------------------------------------------------------------------------
+1           4051-4052    4051  0.00.75  disable  enable  disable  disable
+--------------------------------------------------------------------------------
+SPBM        SMLT-SPLIT-BEB   SMLT-VIRTUAL-BMAC    SMLT-PEER-SYSTEM-ID
+INSTANCE
+--------------------------------------------------------------------------------
+1           primary          00:00:00:00:00:00
+VSP:1#''',
+}
+RunningConfig = '''vlan create 10 name "Mgmt" type port-mstprstp 0
+vlan i-sid 10 1000010
+snmp-server name "oldname"
+snmp-server location "Old Loc"
+router isis
+sys-name "oldname"
+exit
+mgmt vlan 10
+ip address 10.0.0.1/24
+ip route 0.0.0.0/0 next-hop 10.0.0.254 weight 200
+enable
+exit'''
+UsersHeader = '''=======================================================================================================
+                                        Sessions
+=======================================================================================================
+SESSION   USER            ACCESS    IP ADDRESS                   SESSION   TIME      TIMEOUT
+-------------------------------------------------------------------------------------------------------
+'''
+Prompt = 'VSP:1#'
+
+# Simulation settings; lists, so that tests can change them in place
+Delay = [0.0]                   # Secs per command sent
+TftpRoot = ['/tftpboot']        # Where copy "server:file" fetches files from
+PingScale = [0.1]               # Secs per ping count, for ping commands in sourced scripts
+SourceDiesWithSession = [False] # If True, a sourced script stops once the session which launched it is closed
+SaveBusy = [0]                  # Number of save config answered with "Another show or save in progress"
+OtherUsers = [0]                # Number of show users listing another session
+
+RegexCopyTftp = re.compile(r'^copy "[^:]+:([^"]+)" /intflash/(\S+) -y$')
+RegexCopyLocal = re.compile(r'^copy /intflash/(\S+) /intflash/(\S+) -y$')
+RegexDelete = re.compile(r'^delete /intflash/(\S+) -y$')
+RegexSource = re.compile(r'^source (\S+)')
+RegexPing = re.compile(r'^ping \S+ count (\d+)')
+
+def reset(): # Restores the default simulation settings, with a fresh switch to launch on
+    global Session
+    Session = CliSession()
+    Delay[0] = 0.0
+    TftpRoot[0] = '/tftpboot'
+    PingScale[0] = 0.1
+    SourceDiesWithSession[0] = False
+    SaveBusy[0] = 0
+    OtherUsers[0] = 0
+
+class Result(object): # Same interface as emc_cli.send() results
+    def __init__(self, output, success=True, error=None):
+        self.output, self.success, self.error = output, success, error
+    def isSuccess(self):
+        return self.success
+    def getOutput(self):
+        return self.output
+    def getError(self):
+        return self.error
+
+class CliSession(object): # One simulated switch, as seen through an emc_cli session
+    def __init__(self, ip='10.0.0.1'):
+        self.ip = ip
+        self.sent = []      # Commands sent, in order
+        self.files = {}     # Files on /intflash: content
+        self.sourced = []   # Lines run by sourced scripts
+        self.generation = 0 # Bumped on close; sourced scripts launched by an earlier generation may die with it
+
+    def send(self, cmd, waitForPrompt=True):
+        self.sent.append(cmd)
+        if Delay[0]:
+            time.sleep(Delay[0])
+        return self.execute(cmd, self.generation, waitForPrompt)
+
+    def source(self, fileName, generation):
+        for line in self.files[fileName].splitlines():
+            if SourceDiesWithSession[0] and generation != self.generation:
+                return
+            match = RegexPing.match(line)
+            if match:
+                time.sleep(int(match.group(1)) * PingScale[0])
+                continue
+            self.sourced.append(line)
+            self.execute(line, generation)
+
+    def execute(self, cmd, generation, waitForPrompt=True):
+        if '; ' in cmd: # Chained on one line
+            for chainedCmd in cmd.split('; '):
+                self.execute(chainedCmd, generation, waitForPrompt)
+            return Result(cmd + '\n' + Prompt)
+        match = RegexCopyTftp.match(cmd)
+        if match:
+            try:
+                self.files[match.group(2)] = open(TftpRoot[0] + '/' + match.group(1)).read()
+            except IOError:
+                return Result(cmd + '\nError: TFTP transfer failed\n' + Prompt)
+            return Result(cmd + '\n' + Prompt)
+        match = RegexCopyLocal.match(cmd)
+        if match:
+            if match.group(1) not in self.files:
+                return Result(cmd + '\nError: File not found\n' + Prompt)
+            self.files[match.group(2)] = self.files[match.group(1)]
+            return Result(cmd + '\n' + Prompt)
+        match = RegexDelete.match(cmd)
+        if match:
+            if self.files.pop(match.group(1), None) == None:
+                return Result(cmd + '\nError: File not found\n' + Prompt)
+            return Result(cmd + '\n' + Prompt)
+        match = RegexSource.match(cmd)
+        if match:
+            fileName = match.group(1)
+            if fileName not in self.files:
+                return Result(cmd + '\nError: File not found\n' + Prompt)
+            if waitForPrompt:
+                self.source(fileName, generation)
+            else: # Keeps running on the switch after the command returns
+                thread = threading.Thread(target=self.source, args=(fileName, generation))
+                thread.daemon = True
+                thread.start()
+            return Result(cmd + '\n' + Prompt)
+        cmdList = cmd.split('\n')
+        if len(cmdList) > 1 and all(x.startswith('show') for x in cmdList): # Pipelined show commands
+            outputList = []
+            for index, showCmd in enumerate(cmdList):
+                output = self.execute(showCmd, generation).getOutput().rsplit('\n', 1)[0]
+                outputList.append(Prompt + output if index else output)
+            return Result('\n'.join(outputList) + '\n' + Prompt)
+        cmd = cmdList[0]
+        if cmd in Show:
+            return Result(Show[cmd].format(ip=self.ip))
+        if cmd == 'save config':
+            if SaveBusy[0] > 0:
+                SaveBusy[0] -= 1
+                return Result(cmd + '\nAnother show or save in progress.  Please try the command later.\n' + Prompt)
+            return Result(cmd + '\nSave config to file /intflash/config.cfg successful.\n' + Prompt)
+        if cmd.startswith('show running-config'):
+            return Result(cmd + '\n' + RunningConfig + '\n' + Prompt)
+        if cmd == 'show users':
+            output = UsersHeader + 'SSH0      rwa             rwa       10.0.0.250                   0 days 00:00:05    0      (current)\n'
+            if OtherUsers[0] > 0:
+                OtherUsers[0] -= 1
+                output += 'SSH1      nms             ro        10.0.0.99                    0 days 00:01:05    0\n'
+            return Result(cmd + '\n' + output + Prompt)
+        return Result(cmd + '\n' + Prompt)
+
+    def setIpAddress(self, ip):
+        self.ip = ip
+
+    def close(self):
+        self.generation += 1
+
+Session = CliSession() # The switch the script was launched on
+
+def send(cmd, waitForPrompt=True):
+    return Session.send(cmd, waitForPrompt)
+
+def setIpAddress(ip):
+    Session.setIpAddress(ip)
+
+def close(): # The next command opens a new session
+    Session.close()
@@ -0,0 +1,128 @@
+#
+# Local replica of XMC's emc_nbi, for change_mgmt_vlan_dev.py & the tests
+# Answers the GraphQl queries & mutations the script sends, from an in-memory XMC database & NAC
+#
+import re
+import time
+import random
+
+Calls = []        # GraphQl text of every query sent, in order
+Delay = [0.0]     # Secs per query
+Devices = {}      # XMC database: IP: device
+Nac = {}          # NAC switches: IP: switch
+Groups = {}       # NAC groups: name: list of values
+FailGroups = {}   # NAC group: GraphQl error message for removeEntryFromGroup on it; the other aliases still go through
+Discover = [0.0, 0.0] # Min, max secs for created devices to come up
+
+def knownDevice(): # An existing device, as in XMC's database
+    return {'id': 1, 'sitePath': '/World/Site', 'down': False, 'sysUpTime': 1000, 'deviceData': {'profileName': 'public_v2'}}
+
+def reset(): # Empties XMC's database & NAC but for the device of tests/emc_vars.json, and restores the default simulation settings
+    del Calls[:]
+    Delay[0] = 0.0
+    Devices.clear()
+    Devices['10.0.0.1'] = knownDevice()
+    Nac.clear()
+    Groups.clear()
+    FailGroups.clear()
+    Discover[:] = [0.0, 0.0]
+
+class Error(object): # GraphQl error, as returned by XMC's emc_nbi
+    def __init__(self, message, path=None):
+        self.message, self.path = message, path
+
+RegexField = re.compile(r'\s*(?:(\w+)\s*:\s*)?(\w+)\s*(\(([^)]*)\))?\s*')
+
+def fields(body): # Returns list of (alias, name, arguments, sub-body) of the fields in a GraphQl body
+    fieldList = []
+    index = 0
+    while index < len(body):
+        match = RegexField.match(body, index)
+        if not match or match.end() == index:
+            break
+        alias, name, args = match.group(1), match.group(2), match.group(4)
+        index = match.end()
+        subBody = None
+        if index < len(body) and body[index] == '{':
+            depth, end = 0, index
+            while True:
+                if body[end] == '{':
+                    depth += 1
+                elif body[end] == '}':
+                    depth -= 1
+                    if depth == 0:
+                        break
+                end += 1
+            subBody = body[index + 1:end]
+            index = end + 1
+        fieldList.append((alias or name, name, args or '', subBody))
+    return fieldList
+
+def argument(args, key):
+    match = re.search(key + r'\s*:\s*"([^"]*)"', args)
+    return match.group(1) if match else None
+
+def select(obj, subBody): # Returns the fields of obj the sub-body asks for
+    if obj is None or subBody is None:
+        return obj
+    return dict((alias, select(obj.get(name) if isinstance(obj, dict) else None, sub)) for alias, name, args, sub in fields(subBody))
+
+def mutate(name, args): # Applies one mutation; returns its result, or an Error
+    for ip in re.findall(r'ipAddress:\s*"([^"]+)"', args):
+        if name == 'createDevices':
+            Devices[ip] = {'id': 2, 'sitePath': '/World/Site', 'down': False, 'upAt': time.time() + random.uniform(*Discover), 'sysUpTime': 5, 'deviceData': {'profileName': 'public_v2'}}
+        elif name == 'deleteDevices':
+            Devices.pop(ip, None)
+    if name == 'removeEntryFromGroup':
+        group, value = argument(args, 'group'), argument(args, 'value')
+        if group in FailGroups:
+            return Error(FailGroups[group])
+        if value not in Groups.get(group, []):
+            return {'status': 'ERROR', 'message': 'not in group'}
+        Groups[group].remove(value)
+    elif name == 'deleteSwitch':
+        Nac.pop(argument(args, 'searchKey'), None)
+    return {'status': 'SUCCESS', 'message': None}
+
+def answer(name, args, subBody): # Returns the value of one query field
+    if name == 'serverInfo':
+        return {'version': '22.3'}
+    if name == 'device':
+        ip = argument(args, 'ip')
+        device = Devices.get(ip)
+        if device and 'upAt' in device:
+            device['down'] = time.time() < device['upAt']
+        return select(device, subBody)
+    if name == 'switch':
+        return select(Nac.get(argument(args, 'ipAddress')), subBody)
+    if name == 'groupNamesByType':
+        return sorted(Groups.keys())
+    if name == 'group':
+        group = argument(args, 'name')
+        return select({'name': group, 'values': Groups[group]}, subBody) if group in Groups else None
+    return None
+
+def query(jsonQuery):
+    Calls.append(jsonQuery)
+    if Delay[0]:
+        time.sleep(Delay[0])
+    jsonQuery = jsonQuery.strip()
+    isMutation = jsonQuery.startswith('mutation')
+    if isMutation:
+        jsonQuery = jsonQuery[len('mutation'):].strip()
+    response = {}
+    errors = []
+    for rootAlias, rootName, rootArgs, rootBody in fields(jsonQuery[1:-1]):
+        rootResponse = response[rootAlias] = {}
+        for alias, name, args, subBody in fields(rootBody):
+            value = mutate(name, args) if isMutation else answer(name, args, subBody)
+            if isinstance(value, Error):
+                value.path = [rootAlias, alias]
+                errors.append(value)
+                value = None
+            rootResponse[alias] = value
+    if errors:
+        response['errors'] = errors
+    return response
+
+reset()
@@ -0,0 +1,19 @@
+#
+# Local replica of XMC's emc_results, for change_mgmt_vlan_dev.py & the tests
+#
+class Status:
+    ERROR = 'ERROR'
+    SUCCESS = 'SUCCESS'
+
+Store = {}           # Results put by the script
+StatusValue = [None] # Status set by the script
+
+def reset():
+    Store.clear()
+    StatusValue[0] = None
+
+def put(key, value):
+    Store[key] = value
+
+def setStatus(status):
+    StatusValue[0] = status
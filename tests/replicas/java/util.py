@@ -0,0 +1,5 @@
+#
+# Local replica of the java.util classes XMC's Jython hands to the script
+#
+class LinkedHashMap(dict): # What a dict is in XMC's Jython
+    pass
@@ -0,0 +1,497 @@
+#
+# Tests of change-mgmt-vlan.py, via the dev tools in change_mgmt_vlan_dev.py
+# Run against the simulated switch & XMC of the replicas in tests/replicas, from the repo directory:
+#     python -m unittest discover -s tests
+#
+import os
+import sys
+import json
+import Queue
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import unittest
+import StringIO
+import change_mgmt_vlan_dev as dev
+
+TestDir = os.path.dirname(os.path.abspath(__file__))
+EmcVarsFile = os.path.join(TestDir, 'emc_vars.json')
+ReplayFixture = os.path.join(TestDir, 'replay.json') # Recorded run of EmcVarsFile device against the replicas
+
+class FailingNbi(object): # emc_nbi answering all queries with a GraphQl error
+    def query(self, jsonQuery):
+        import emc_nbi
+        return {'errors': [emc_nbi.Error("Not authorized")]}
+
+
+class ScriptTest(unittest.TestCase): # Loads the script afresh against reset replicas, with its files in a temp directory
+    emcVars = EmcVarsFile
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.loadScript()
+        import emc_cli, emc_nbi, emc_results # The replicas the script just imported
+        self.emc_cli, self.emc_nbi, self.emc_results = emc_cli, emc_nbi, emc_results
+        for replica in (emc_cli, emc_nbi, emc_results):
+            replica.reset()
+        self.emc_cli.TftpRoot[0] = self.tmpDir
+        self.stdout, sys.stdout = sys.stdout, StringIO.StringIO()
+
+    def loadScript(self): # Loads the script afresh, as a new run on XMC would; the replicas keep their state
+        self.script = dev.loadScript(self.emcVars)
+        self.script.XmcTftpRoot = self.tmpDir
+        self.script.JournalDir = self.script.InventoryDir = self.tmpDir
+        self.script.Sanity = False
+        self.script.CliSessionFactory = self.script.emc_cli.CliSession
+        self.script.reachabilityProbe = self.probe
+        self.script.DeadmanTestTimer = 1
+        self.script.DeadmanTestGrace = 0
+        self.script.DiscoveryMinInterval = 0.1
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+        shutil.rmtree(self.tmpDir, ignore_errors=True)
+
+    def probe(self, ipList, deadline=10, **kwargs): # New IPs are not on the network before the change (3 secs probes), and reply after it
+        return dict((x, None if deadline <= 3 else 0.01) for x in ipList)
+
+    def output(self):
+        return sys.stdout.getvalue()
+
+    def devices(self, count, subnet='10.9.0', first=1): # Returns emc_vars of count devices known to XMC, all moving to new IPs in the same subnet
+        baseVars = json.load(open(EmcVarsFile))
+        varsList = []
+        for number in range(first, first + count):
+            deviceVars = dict(baseVars)
+            deviceVars["deviceIP"] = '10.0.2.{}'.format(number)
+            deviceVars["userInput_ip"] = '{}.{}'.format(subnet, number)
+            deviceVars["userInput_dgw"] = '{}.254'.format(subnet)
+            varsList.append(deviceVars)
+            self.emc_nbi.Devices[deviceVars["deviceIP"]] = self.emc_nbi.knownDevice()
+        return varsList
+
+    def runMain(self): # Runs main() against the launch device, as XMC does; returns the error, or None on success
+        try:
+            self.script.threadPoolRun(self.script.EmcVarsList, self.script.main)
+        except RuntimeError as e:
+            return str(e)
+        return None
+
+
+class BenchmarkNbiBatchTest(unittest.TestCase):
+    def setUp(self):
+        dev.loadScript(EmcVarsFile)
+
+    def testBatchedRoundTrips(self):
+        perFactCount, batchedCount = dev.benchmarkNbiBatch()
+        self.assertEqual(perFactCount, 3 * len(dev.Script.EmcVarsList))
+        self.assertTrue(0 < batchedCount < perFactCount)
+
+    def testBatchedRoundTripsAfterCacheFilled(self):
+        dev.benchmarkNbiBatch()
+        perFactCount, batchedCount = dev.benchmarkNbiBatch() # Cache already holds all responses of the previous run
+        self.assertEqual(perFactCount, 3 * len(dev.Script.EmcVarsList))
+        self.assertTrue(batchedCount > 0)
+
+
+class BenchmarkIpv4Test(unittest.TestCase):
+    def setUp(self):
+        dev.loadScript(EmcVarsFile)
+
+    def testSameResultsAsPerAddressFunctions(self): # benchmarkIpv4 asserts these
+        dev.benchmarkIpv4(subnetCount=300, ipCount=1000)
+
+
+class ReplayTest(ScriptTest):
+    def setUp(self):
+        ScriptTest.setUp(self)
+        self.latency = dict(dev.ReplayLatency)
+        dev.ReplayLatency.update({'cli': 0, 'nbi': 0})
+
+    def tearDown(self):
+        dev.ReplayLatency.update(self.latency)
+        ScriptTest.tearDown(self)
+
+    def replay(self, recording, deviceCount):
+        dev.replayReset()
+        replay = dev.Replay(recording, deviceCount)
+        dev.replayInstall(replay)
+        return replay, self.script.threadPoolRun(replay.deviceVarsList, self.script.main, sessionFactory=replay.cliSession)
+
+    def testReplayFixture(self):
+        replay, results = self.replay(json.load(open(ReplayFixture)), 5)
+        self.assertEqual([x['status'] for x in results], ['SUCCESS'] * 5)
+        self.assertEqual(replay.live, set(x["userInput_ip"] for x in replay.deviceVarsList)) # All devices moved to their new IP
+
+    def testRecordThenReplay(self):
+        dev.recordInstall()
+        self.assertEqual(self.runMain(), None)
+        self.assertEqual(self.emc_results.StatusValue[0], None)
+        recordFile = os.path.join(self.tmpDir, 'replay.json')
+        dev.recordSave(recordFile)
+        recording = json.load(open(recordFile))
+        self.assertEqual(recording['devices'].keys(), ["10.0.0.1"])
+        self.assertIn('source .script.src debug', [x[0] for x in recording['devices']["10.0.0.1"]['cli']])
+        replay, results = self.replay(recording, 3)
+        self.assertEqual([x['status'] for x in results], ['SUCCESS'] * 3)
+
+    def testReplayPipelineNotInTranscript(self): # The run pipelines other show commands than the recorded one
+        recording = json.load(open(ReplayFixture))
+        for cmd, success, output, error in recording['devices']["10.0.0.1"]['cli']:
+            if '\n' in cmd:
+                break
+        else:
+            self.fail("No pipelined show commands in {}".format(ReplayFixture))
+        session = dev.Replay(recording, 1).cliSession('198.18.0.1')
+        cmdList = cmd.split('\n')[::-1]
+        resultObj = session.send("\n".join(cmdList))
+        self.assertTrue(resultObj.isSuccess())
+        segments = self.script.cliOutputSplit(resultObj.getOutput(), cmdList)
+        self.assertEqual(len(segments or []), len(cmdList))
+        for cmd, segment in zip(cmdList, segments):
+            self.assertTrue(segment.split('\n')[0].endswith(cmd))
+            self.assertTrue(len(segment.split('\n')) > 2, "No recorded output for {}".format(cmd))
+
+
+class PreflightTest(ScriptTest):
+    def setUp(self):
+        ScriptTest.setUp(self)
+        self.sessions = []
+        self.script.CliSessionFactory = self.cliSession
+
+    def cliSession(self, deviceIp):
+        self.sessions.append(self.emc_cli.CliSession(deviceIp))
+        return self.sessions[-1]
+
+    def preflight(self, varsList): # Returns go/no-go, and dict of device IP: (verdict, errors) from the report
+        go = self.script.preflightCheck(varsList)
+        report = {}
+        for line in self.output().splitlines():
+            fields = line.split(None, 3)
+            if len(fields) >= 3 and fields[0] == '-' and fields[2] in ('GO', 'NO-GO'):
+                report[fields[1]] = (fields[2], fields[3] if len(fields) > 3 else '')
+        return go, report
+
+    def assertNothingTouched(self):
+        self.assertEqual([x for x in self.emc_nbi.Calls if x.strip().startswith('mutation')], [])
+        for session in self.sessions: # Facts are read, nothing is configured
+            self.assertEqual([x for x in session.sent if not x.startswith(('show', 'terminal', 'enable'))], [])
+
+    def testGo(self):
+        go, report = self.preflight(self.devices(4))
+        self.assertTrue(go)
+        self.assertEqual(report, dict(('10.0.2.{}'.format(x + 1), ('GO', '')) for x in range(4)))
+        self.assertIn("Pre-flight GO for all 4 devices", self.output())
+        self.assertEqual(self.emc_results.StatusValue[0], None)
+        self.assertNothingTouched()
+
+    def testNoGoOnInputErrors(self):
+        varsList = self.devices(5)
+        varsList[0]["userInput_sysname"] = 'a b'
+        varsList[1]["deviceSoftwareVer"] = '8.1.0.0'
+        varsList[2]["userInput_isid"] = '99999999'
+        varsList[3]["userInput_dgw"] = '10.8.0.1'
+        go, report = self.preflight(varsList)
+        self.assertFalse(go)
+        self.assertEqual(report['10.0.2.1'], ('NO-GO', 'System Name provided must not contain any spaces: "a b"'))
+        self.assertEqual(report['10.0.2.2'], ('NO-GO', 'This script only works on VSPs running VOSS 8.2 or later'))
+        self.assertEqual(report['10.0.2.3'], ('NO-GO', 'Invalid I-SID 99999999; must be 1-15999999'))
+        self.assertEqual(report['10.0.2.4'], ('NO-GO', 'Gateway 10.8.0.1 is outside of new VLAN IP subnet 10.9.0.0/24'))
+        self.assertEqual(report['10.0.2.5'], ('GO', ''))
+        self.assertIn("Pre-flight NO-GO: 4 of 5 devices failed pre-flight checks; no device was touched", self.output())
+        self.assertEqual(self.emc_results.StatusValue[0], 'ERROR')
+        self.assertNothingTouched()
+
+    def testNoGoOnClashingInputs(self):
+        varsList = self.devices(3)
+        varsList[1]["userInput_ip"] = '10.9.0.1' # Same new IP as 1st device
+        varsList += self.devices(2, subnet='10.9.1', first=4)
+        varsList[4]["userInput_vid"] = '30' # Other VLAN than 10.0.2.4, in the same subnet
+        go, report = self.preflight(varsList)
+        self.assertFalse(go)
+        for deviceIp, otherIp in (('10.0.2.1', '10.0.2.2'), ('10.0.2.2', '10.0.2.1')):
+            self.assertEqual(report[deviceIp], ('NO-GO', 'New IP 10.9.0.1 also given for device(s) {}'.format(otherIp)))
+        self.assertEqual(report['10.0.2.3'], ('GO', ''))
+        for deviceIp in ('10.0.2.4', '10.0.2.5'):
+            self.assertEqual(report[deviceIp], ('NO-GO', 'Devices in subnet 10.9.1.0/24 have mismatching VLAN/I-SID: VLAN 20 I-SID 1000020, VLAN 30 I-SID 1000020'))
+        self.assertNothingTouched()
+
+    def testNoGoOnXmcAndNetwork(self):
+        varsList = self.devices(4)
+        self.emc_nbi.Devices['10.9.0.1'] = self.emc_nbi.knownDevice() # New IP already in XMC
+        self.script.reachabilityProbe = lambda ipList, deadline=10, **kwargs: dict((x, 0.01 if x == '10.9.0.2' else None) for x in ipList)
+        varsList[2]["userInput_ip"] = '10.0.2.200' # In the /24 subnet the inventory holds for its current IP
+        varsList[2]["userInput_dgw"] = '10.0.2.254'
+        go, report = self.preflight(varsList)
+        self.assertFalse(go)
+        self.assertEqual(report['10.0.2.1'], ('NO-GO', "Given IP address 10.9.0.1 is already in XMC's database"))
+        self.assertEqual(report['10.0.2.2'], ('NO-GO', "Given IP address 10.9.0.2 is already on the network (replies to ping)"))
+        self.assertEqual(report['10.0.2.3'], ('NO-GO', "New IP 10.0.2.200 seems to be in same subnet of existing IP 10.0.2.3/24"))
+        self.assertEqual(report['10.0.2.4'], ('GO', ''))
+        self.assertNothingTouched()
+
+    def testNoGoWhenXmcUnreachable(self):
+        self.script.emc_nbi = FailingNbi()
+        go, report = self.preflight(self.devices(2))
+        self.assertFalse(go)
+        self.assertIn("Pre-flight NO-GO: unable to query XMC", self.output())
+        self.assertEqual(self.emc_results.StatusValue[0], 'ERROR')
+        self.assertEqual(self.sessions, [])
+
+
+class SyslogTest(ScriptTest):
+    def setUp(self):
+        ScriptTest.setUp(self)
+        self.receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.receiver.bind(('127.0.0.1', 0))
+        self.receiver.settimeout(2)
+        self.script.SyslogServer = self.receiver.getsockname()
+        self.script.SyslogJsonFile = os.path.join(self.tmpDir, 'syslog.jsonl')
+
+    def tearDown(self):
+        self.receiver.close()
+        ScriptTest.tearDown(self)
+
+    def received(self): # Returns the messages the receiver got, until none comes for 0.2 secs
+        messageList = []
+        self.receiver.settimeout(0.2)
+        try:
+            while True:
+                messageList.append(self.receiver.recv(65535))
+        except socket.timeout:
+            return messageList
+
+    def event(self, **fields):
+        event = {'time': 1700000000.5, 'severity': 6, 'host': '10.0.0.250', 'script': 'change-mgmt-vlan', 'device': '10.0.0.1',
+                 'phase': 'push', 'duration': 1.5, 'outcome': 'success', 'message': 'Changed IP address'}
+        event.update(fields)
+        return event
+
+    def testSyslogFormat(self):
+        self.assertEqual(self.script.syslogFormat(self.event()),
+            '<14>1 2023-11-14T22:13:20.500Z 10.0.0.250 change-mgmt-vlan - audit [xmcScript@1916 device="10.0.0.1" phase="push" '
+            'duration="1.5" outcome="success"] XMC Script change-mgmt-vlan / Device: 10.0.0.1 / Changed IP address')
+
+    def testSyslogFormatEscapesAndOmits(self):
+        message = self.script.syslogFormat(self.event(severity=3, host=None, script='my script', device=None, phase='a"b]c\\d', duration=None))
+        self.assertEqual(message, '<11>1 2023-11-14T22:13:20.500Z - my_script - audit [xmcScript@1916 phase="a\\"b\\]c\\\\d" '
+            'outcome="success"] XMC Script my script / Changed IP address')
+
+    def testEventsSent(self):
+        for number in range(3):
+            self.script.addXmcSyslogEvent('warning', "Event {}".format(number), '10.0.0.1', phase='validate')
+        self.script.syslogFlush()
+        messageList = self.received()
+        self.assertEqual(len(messageList), 3)
+        for number, message in enumerate(messageList):
+            self.assertTrue(message.startswith('<12>1 '))
+            self.assertIn('[xmcScript@1916 device="10.0.0.1" phase="validate" outcome="success"]', message)
+            self.assertTrue(message.endswith("Device: 10.0.0.1 / Event {}".format(number)))
+        self.assertEqual(self.script.SyslogStats, {'sent': 3, 'dropped': 0, 'errors': 0})
+        jsonList = [json.loads(x) for x in open(self.script.SyslogJsonFile)]
+        self.assertEqual([x['message'] for x in jsonList], ["Event 0", "Event 1", "Event 2"])
+
+    def testEventsOfRun(self):
+        self.assertEqual(self.runMain(), None)
+        messageList = self.received()
+        self.assertTrue([x for x in messageList if x.endswith("Device: 10.0.0.1 / Changed IP address to 10.1.0.5") and 'phase="push"' in x])
+        self.assertTrue([x for x in messageList if x.endswith("Device: 10.0.0.1 / Completed") and 'outcome="success"' in x and 'phase="save"' in x])
+        self.assertEqual(self.script.SyslogStats['sent'], len(messageList))
+
+    def testDroppedCounted(self): # Queue full: events are dropped and counted, never blocking the device threads
+        self.script.SyslogSender[0] = threading.Thread() # No sender draining the queue
+        self.script.SyslogQueue = Queue.Queue(10)
+        def addEvents():
+            for number in range(100):
+                self.script.addXmcSyslogEvent('info', "Event {}".format(number), phase='push')
+        threadList = [threading.Thread(target=addEvents) for _ in range(8)]
+        for thread in threadList:
+            thread.start()
+        for thread in threadList:
+            thread.join()
+        self.assertEqual(self.script.SyslogStats['dropped'], 790)
+        self.script.syslogFlush(timeout=0)
+        self.assertIn("Syslog: 790 events dropped, 10 not sent", self.output())
+        self.assertEqual(self.received(), [])
+
+
+class InterruptingNbi(object): # emc_nbi which goes away once asked to create a device
+    def __init__(self, nbi):
+        self.nbi = nbi
+
+    def query(self, jsonQuery):
+        if 'createDevices' in jsonQuery:
+            raise IOError("Connection to XMC lost")
+        return self.nbi.query(jsonQuery)
+
+
+class JournalTest(ScriptTest):
+    def interruptedRun(self): # Runs main() until it gets interrupted in the re-add phase, once the old IP is gone from XMC & NAC
+        self.script.emc_nbi = InterruptingNbi(self.emc_nbi)
+        self.assertRaises(IOError, self.script.threadPoolRun, self.script.EmcVarsList, self.script.main)
+        return json.load(open(self.script.journalPath('10.0.0.1')))
+
+    def testResumeAfterInterruption(self):
+        record = self.interruptedRun()
+        self.assertEqual(record['phase'], 'delete-from-NAC')
+        self.assertEqual(record['state']['newIp'], '10.1.0.5')
+        self.assertNotIn('10.0.0.1', self.emc_nbi.Devices)
+        self.assertIn('.rollback.src', self.emc_cli.Session.files) # Deadman still armed on the switch
+        sentCount = len(self.emc_cli.Session.sent)
+        self.loadScript() # Re-run of the same batch
+        self.assertEqual(self.runMain(), None)
+        self.assertIn("Resuming interrupted run of device 10.0.0.1 after phase 'delete-from-NAC'", self.output())
+        resumedList = self.emc_cli.Session.sent[sentCount:]
+        self.assertNotIn('source .script.src', " ".join(resumedList)) # Not pushed again
+        self.assertIn('delete /intflash/.rollback.src -y', resumedList) # Confirmed, once re-added
+        self.assertNotIn('.rollback.src', self.emc_cli.Session.files)
+        self.assertIn('10.1.0.5', self.emc_nbi.Devices)
+        self.assertFalse(os.path.exists(self.script.journalPath('10.0.0.1'))) # Done, so dropped at the end of the run
+
+    def testResumeLaunchedOnNewIp(self): # Once in XMC under its new IP, the device can be run against from there
+        self.interruptedRun()
+        self.emc_nbi.Devices['10.1.0.5'] = self.emc_nbi.knownDevice()
+        self.loadScript()
+        resumeVars = dict(self.script.emc_vars, deviceIP='10.1.0.5')
+        record = self.script.journalEntry(resumeVars)
+        self.assertEqual((record['deviceIP'], record['phase']), ('10.0.0.1', 'delete-from-NAC'))
+
+    def testOtherInputsNotResumed(self):
+        self.interruptedRun()
+        self.loadScript()
+        self.assertNotEqual(self.script.journalEntry(self.script.emc_vars), None)
+        self.assertEqual(self.script.journalEntry(dict(self.script.emc_vars, userInput_ip='10.1.0.6')), None)
+
+    def testExpiredRecordDeleted(self):
+        record = self.interruptedRun()
+        record['time'] -= self.script.JournalMaxAge + 1
+        json.dump(record, open(self.script.journalPath('10.0.0.1'), 'w'))
+        self.loadScript()
+        self.assertEqual(self.script.journalEntry(self.script.emc_vars), None)
+        self.assertFalse(os.path.exists(self.script.journalPath('10.0.0.1')))
+
+
+class CliMemoTest(ScriptTest):
+    def setUp(self):
+        ScriptTest.setUp(self)
+        self.script.deviceContext().family = 'VSP Series'
+        self.script.cliContext('privExec')
+        self.showList = ['show mgmt ip', 'show boot config flags', 'show vlan basic', 'show running-config']
+        for cmd in self.showList:
+            self.script.sendCLI_showCommand(cmd)
+
+    def sent(self): # Returns the commands sent since last called
+        sentList = list(self.emc_cli.Session.sent)
+        del self.emc_cli.Session.sent[:]
+        return sentList
+
+    def resent(self): # Returns the show commands of showList which get sent again, i.e. which were no longer memoized
+        self.sent()
+        for cmd in self.showList:
+            self.script.sendCLI_showCommand(cmd)
+        return self.sent()
+
+    def testShowMemoized(self):
+        self.assertEqual(self.resent(), [])
+        self.script.sendCLI_showCommand('show  mgmt   ip') # Same command, other spacing
+        self.assertEqual(self.sent(), [])
+        self.script.sendCLI_showCommand('show mgmt ip', memo=False)
+        self.assertEqual(self.sent(), ['show mgmt ip'])
+
+    def testConfigInvalidatesAreasChanged(self):
+        self.script.cliContext('config')
+        self.script.sendCLI_configCommand('vlan create 30 type port-mstprstp 0')
+        self.assertEqual(self.resent(), ['show vlan basic', 'show running-config'])
+        self.script.sendCLI_configChain('mgmt vlan 20\nenable\nexit') # Inside the mgmt vlan sub-context, "enable" changes mgmt
+        self.assertEqual(self.resent(), ['show mgmt ip', 'show running-config'])
+        self.script.sendCLI_configCommand('boot config flags tftpd')
+        self.assertEqual(self.resent(), ['show boot config flags', 'show running-config'])
+        self.script.sendCLI_configCommand('save config') # Changes no config
+        self.assertEqual(self.resent(), [])
+
+    def testUnknownConfigInvalidatesAll(self):
+        self.script.cliContext('config')
+        self.script.sendCLI_configCommand('spanning-tree mstp priority 4096')
+        self.assertEqual(self.resent(), self.showList)
+
+    def testWarpInvalidatesAreasOfScript(self):
+        self.script.cliContext('config')
+        self.script.warpBuffer_add('vlan create 40 type port-mstprstp 0')
+        self.script.warpBuffer_execute()
+        self.assertIn('source .script.src', " ".join(self.sent()))
+        self.assertEqual(self.resent(), ['show boot config flags', 'show vlan basic', 'show running-config']) # TFTP got enabled for the script
+
+    def testMemoPerSession(self):
+        self.assertTrue(self.script.cliSessionReconnect('10.0.0.1'))
+        self.assertEqual(self.resent(), self.showList)
+
+
+class DeadmanTest(ScriptTest):
+    def setUp(self):
+        ScriptTest.setUp(self)
+        self.confirmList = [] # (IP of session, IPs in XMC) when confirm was sent
+        self.confirmError = None
+        session = self.emc_cli.Session
+        send = session.send
+        def confirmSend(cmd, waitForPrompt=True):
+            if cmd == 'delete /intflash/.rollback.src -y' and '.script.src' in session.files:
+                self.confirmList.append((session.ip, sorted(self.emc_nbi.Devices)))
+                if self.confirmError:
+                    return self.emc_cli.Result("{}\n{}\n{}".format(cmd, self.confirmError, self.emc_cli.Prompt))
+            return send(cmd, waitForPrompt)
+        session.send = confirmSend
+
+    def waitSourced(self, line, timeout=5): # Waits for the switch to run a line of a sourced script; returns True if it did
+        deadline = time.time() + timeout
+        while line not in self.emc_cli.Session.sourced and time.time() < deadline:
+            time.sleep(0.05)
+        return line in self.emc_cli.Session.sourced
+
+    def testConfirmAfterReAdd(self): # XMC resolves the credentials of the session to the new IP from the re-added device
+        self.assertEqual(self.runMain(), None)
+        self.assertEqual(self.confirmList, [('10.1.0.5', ['10.1.0.5'])])
+        self.assertNotIn('.rollback.src', self.emc_cli.Session.files)
+        self.assertEqual(self.emc_cli.Session.sent[-1], 'save config')
+
+    def testConfirmFailureRestoresXmc(self):
+        self.script.DeadmanTimer = 5
+        self.confirmError = 'Error: File not found'
+        error = self.runMain()
+        self.assertEqual(error, "Unable to confirm the change on new VLAN IP 10.1.0.5: {}; switch reverted the change and is "
+                                "reachable again on IP 10.0.0.1".format(self.confirmError))
+        self.assertEqual(len(self.confirmList), 1)
+        self.assertTrue(self.waitSourced('ip address 10.0.0.1/24')) # Deadman sourced the staged rollback
+        self.assertEqual(sorted(self.emc_nbi.Devices), ['10.0.0.1'])
+        self.assertEqual(self.emc_nbi.Devices['10.0.0.1']['sitePath'], '/World/Site')
+        self.assertNotIn('save config', self.emc_cli.Session.sent)
+        self.assertFalse(self.script.deviceContext().deadmanArmed)
+        self.assertFalse(os.path.exists(self.script.journalPath('10.0.0.1'))) # A new run starts over
+
+    def testSelfTestFailsWhenSourceDiesWithSession(self):
+        self.emc_cli.SourceDiesWithSession[0] = True
+        error = self.runMain()
+        self.assertEqual(error, "Switch did not fire the deadman self-test once its CLI session was gone; cannot push the change in commit-confirm mode")
+        self.assertEqual(self.emc_cli.Session.sent.count('source .script.src debug'), 1) # Only the self-test; change never pushed
+        self.assertNotIn('mgmt vlan 20', self.emc_cli.Session.sourced)
+        self.assertEqual(self.emc_cli.Session.files.keys(), ['.script.src']) # Self-test rollback deleted, and it never created the flag
+        self.assertEqual(sorted(self.emc_nbi.Devices), ['10.0.0.1'])
+
+    def testSelfTestOncePerSoftwareVersion(self):
+        flagCopy = self.script.WarpDeadmanFlag['VSP Series'][0]
+        self.script.setFamily()
+        self.script.inventoryRefresh([self.script.emc_vars])
+        state = {'currentIp': '10.0.0.1', 'newIp': '10.1.0.5'}
+        self.script.phaseValidate(state)
+        self.assertTrue(self.waitSourced(flagCopy))
+        self.assertEqual(self.script.inventoryFacts('10.0.0.1')['deadmanVerified'], '8.5.0.0')
+        self.script.phaseValidate(state)
+        self.assertEqual(self.emc_cli.Session.sourced.count(flagCopy), 1)
+        self.script.deviceContext().vars = dict(self.script.emc_vars, deviceSoftwareVer='8.6.0.0') # Upgraded since
+        self.script.phaseValidate(state)
+        self.assertEqual(self.emc_cli.Session.sourced.count(flagCopy), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()